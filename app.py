@@ -6,18 +6,23 @@ import os
 import json
 import time
 import argparse
+import collections
 import torch
 from pydantic import BaseModel
 from typing import List, Dict, Optional, Any
 
 from src.client.client_factory import ClientFactory
 from src.speaker_identification.preprocess.text_preprocess import TextPreprocessor
-from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering
-from src.speaker_identification.csi.evaluate.cmrc2018_output import write_predictions
-from src.speaker_identification.csi.tokenizations import official_tokenization as tokenization
+from src.speaker_identification.preprocess.sentence_cache import SentenceTokenCache
+from src.speaker_identification.preprocess.rule_attribution import RuleAttributor
 from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import json2features
-from src.speaker_identification.csi.preprocess import utils
-from src.speaker_identification.csi.test_si import evaluate
+from src.speaker_identification.csi.test_si import evaluate, evaluate_stream
+from src.speaker_identification.csi.evaluate.name_decoding import CastList
+from src.speaker_identification.csi.preprocess.shared_window import predict_shared_windows
+from src.speaker_identification.csi.models.pytorch_modeling import TruncatedQuestionAnswering, \
+    EarlyExitQuestionAnswering
+from src.speaker_identification.model_registry import ModelRegistry
+from src.speaker_identification.result_store import ResultStore
 from src.utils import get_text_from_file, WebSocketTqdm
 
 
@@ -37,6 +42,13 @@ os.makedirs(TEXT_DIR, exist_ok=True)
 PRED_DIR = os.path.join(ROOT_DIR, "cache", "speaker_identification")
 os.makedirs(PRED_DIR, exist_ok=True)
 
+MODEL_DIR = os.path.join(ROOT_DIR, "model", "chinese-roberta-wwm-ext-large-csi-v1")
+
+DEBUG = True
+
+# 说话人识别模型在进程内只加载一次，所有请求共享
+model_registry = ModelRegistry(MODEL_DIR, checkpoint_name="csi-v1.pth", gpu_ids='0')
+
 
 class TTSConfig(BaseModel):
     text: str
@@ -124,14 +136,56 @@ def split_sentences():
 def identify_speaker():
     """
     识别说话人API
-    请求体格式: {"sentences_dir": "分句后的文本文件路径"}
+    请求体格式: {"base_dir": "书名", "pre_size": 前文句数, "post_size": 后文句数,
+                "n_batch": 每个batch的最大样本数(可选), "max_batch_tokens": 每个batch的最大token数(可选),
+                "backend": 推理后端 fp32/int8/torchscript/onnx/early_exit(可选，int8为CPU量化模型，torchscript/onnx为导出的计算图，
+                           early_exit为带中间层退出头的模型),
+                "exit_threshold": early_exit后端提前退出的置信度阈值(可选，默认0.9；
+                                  起止位置最大概率之积达到该值的样本在当前退出层结束计算),
+                "debug_dump": 是否把中间的数据集、样例和特征写入文件以便调试(可选，默认false),
+                "preprocess_workers": 特征提取使用的进程数(可选，默认1即单进程),
+                "stream": 是否边提取特征边推理(可选，默认true；debug_dump或preprocess_workers大于1时不使用；
+                          流式时在前瞻窗口内按长度分桶，同样受max_batch_tokens限制),
+                "adaptive_context": 是否按token预算逐句调整上下文窗口(可选，默认false；
+                                    为true时pre_size/post_size为初始窗口，超出预算时收缩，每条引文只需一个doc span),
+                "grow_context": adaptive_context时是否在预算内扩展窗口(可选，默认false；
+                                扩展会把窗口撑满预算，每条引文的计算量成倍增加),
+                "cast": 已知的角色名列表，或角色名到别名列表的字典(可选；给出时只在上下文中出现的角色名里
+                        选择说话人，直接返回角色名，上下文中没有任何角色名的引文仍按原方式识别),
+                "rule_fast_path": 是否先用规则识别紧邻叙述句中"张三说："、"李四笑道"这类明确归属的引文(可选，默认false；
+                                  需要同时给出cast，只接受其中的角色名，规则能确定说话人的引文不再送入模型),
+                "cascade_layers": 级联识别时廉价模型使用的编码器层数(可选，默认0即不级联；
+                                  先用early_exit权重的前cascade_layers层和该层的退出头识别所有引文，
+                                  置信度低的再交给backend指定的完整模型，backend可以是任意后端；
+                                  early_exit权重中没有该层的退出头时返回错误；廉价模型是另一份权重，
+                                  内存映射加载时只额外占用嵌入层和前cascade_layers层的内存，否则额外占用一份完整BERT),
+                "cascade_threshold": 廉价模型n-best首选答案的概率低于该值时交给完整模型(可选，默认0.9；
+                                     廉价模型不使用cast解码，给出cast时首选答案不是其中的角色名也交给完整模型),
+                "shared_window": 是否用共享窗口模型一次前向识别上下文重叠的多条引文(可选，默认false；
+                                 需要run_si --marker_training训练的权重，没有该权重或其中没有训练过的引文标记头时
+                                 按原方式逐条识别；窗口使用pre_size/post_size，不随adaptive_context调整；
+                                 放不进一个窗口的引文，以及给出cast时答案不是其中角色名的引文，仍按原方式识别),
+                "max_quotes_per_window": 共享窗口中最多的引文数(可选，默认8)}
     返回格式: {
         "success": true/false,
         "nbest_dir": "识别结果文件路径"
-        "prediction_dir": "预测结果文件路径"
+        "speakers_dir": "预测结果文件路径",
+        "reused": 复用之前结果的样本数,
+        "inferred": 本次送入模型识别的样本数,
+        "rule_resolved": 规则直接确定说话人的样本数,
+        "rule_fraction": 规则直接确定说话人的样本比例,
+        "shared_window": 共享窗口识别的统计(未请求时为null): {"used": 是否使用了共享窗口模型,
+                         "reason": 未使用的原因, "windows": 窗口数, "resolved": 由共享窗口确定说话人的样本数,
+                         "fallback": 仍按原方式识别的样本数, "time": 共享窗口识别耗时},
+        "cascade": 级联识别的统计(未级联时为null): {"layers", "threshold", "escalated": 交给完整模型的样本数,
+                   "escalation_rate": 交给完整模型的样本比例, "cheap_time": 廉价模型耗时, "full_time": 完整模型耗时},
+        "early_exit": 提前退出的统计(early_exit后端时给出，否则为null): {"threshold",
+                      "exit_layers": 各层退出的特征数, "average_layers": 平均执行的层数, "num_layers": 总层数},
+        "elapsed": 请求的端到端耗时(秒)
     }
     """
     try:
+        request_start = time.time()
         data = request.json
         if not data or 'base_dir' not in data:
             return jsonify({'success': False, 'error': 'api缺少参数'})
@@ -139,6 +193,48 @@ def identify_speaker():
         base_dir = data['base_dir']
         pre_size = data['pre_size']
         post_size = data['post_size']
+        n_batch = int(data.get('n_batch', 8))
+        max_batch_tokens = int(data.get('max_batch_tokens', 8192))
+        backend = data.get('backend', 'fp32')
+        debug_dump = bool(data.get('debug_dump', False))
+        preprocess_workers = int(data.get('preprocess_workers', 1))
+        # 流式特征提取在单进程中进行，需要多进程预处理时使用非流式路径
+        stream = bool(data.get('stream', True)) and not debug_dump and preprocess_workers <= 1
+        adaptive_context = bool(data.get('adaptive_context', False))
+        grow_context = bool(data.get('grow_context', False))
+        cast = CastList(data['cast']) if data.get('cast') else None
+        rule_fast_path = bool(data.get('rule_fast_path', False))
+        if rule_fast_path and cast is None:
+            # 没有角色名表时规则会把"于是说"之类的词当成名字，结果又不经过模型，只在给出cast时使用
+            return jsonify({'success': False, 'error': 'rule_fast_path需要同时给出cast'})
+        cascade_layers = int(data.get('cascade_layers', 0))
+        cascade_threshold = float(data.get('cascade_threshold', 0.9))
+        exit_threshold = float(data.get('exit_threshold', 0.9))
+        shared_window = bool(data.get('shared_window', False))
+        max_quotes_per_window = int(data.get('max_quotes_per_window', 8))
+        marker_loaded = None
+        shared_window_stats = None
+        if shared_window:
+            # 引文标记头没有训练时窗口内所有引文的答案相同，只能逐条识别
+            if not os.path.exists(model_registry.marker_restore_dir):
+                shared_window_stats = {'used': False,
+                                       'reason': f'没有共享窗口模型权重: {model_registry.marker_restore_dir}'}
+            else:
+                marker_loaded = model_registry.get(ModelRegistry.SHARED_WINDOW)
+                if not marker_loaded.model.has_marker_head():
+                    marker_loaded = None
+                    shared_window_stats = {'used': False,
+                                           'reason': '共享窗口模型权重中没有训练过的引文标记头(run_si --marker_training)'}
+        if cascade_layers:
+            # 廉价模型的置信度只有用对应层训练过的退出头才可靠
+            if not os.path.exists(model_registry.exit_restore_dir):
+                return jsonify({'success': False,
+                                'error': f'级联识别需要带退出头的模型权重: {model_registry.exit_restore_dir}'})
+            cheap_loaded = model_registry.get('early_exit')
+            if str(cascade_layers) not in cheap_loaded.model.exit_outputs:
+                return jsonify({'success': False,
+                                'error': f'第{cascade_layers}层没有退出头，可用的cascade_layers: '
+                                         f'{cheap_loaded.model.exit_layers}'})
         
         sentences_dir = os.path.join(TEXT_DIR, base_dir + '_sentences.json')
         
@@ -148,27 +244,96 @@ def identify_speaker():
             sentences = sentences_data['sentences']
             quotes_idx = sentences_data['quotes_idx']
             
-        # 构造CMRC格式数据集
+        checkpoint_dir=os.path.join(PRED_DIR, base_dir)
+        # 准备评估参数
+        eval_args = argparse.Namespace(
+            n_batch=n_batch,
+            bucket_by_length=True,
+            max_batch_tokens=max_batch_tokens,
+            max_ans_length=50,
+            n_best=6,
+            dev_dir1=os.path.join(TEXT_DIR, base_dir + '_examples.json'),
+            dev_dir2=os.path.join(TEXT_DIR, base_dir + '_features.json'),
+            dev_file=os.path.join(TEXT_DIR, base_dir + '_dataset.json'),
+            # 中间结果只保存在内存中，最终结果在合并后统一写入
+            checkpoint_dir=None,
+            cast=cast
+        )
+        
+        # 获取常驻内存的模型和分词器
+        loaded = model_registry.get(backend)
+        bert_config = loaded.bert_config
+        tokenizer = loaded.tokenizer
+        model = loaded.model
+        device = loaded.device
+        if backend == 'early_exit':
+            # 每个请求单独统计各层退出的样本数
+            model = EarlyExitQuestionAnswering(model, exit_threshold)
+        
+        # 按样本内容哈希复用之前的识别结果，模型或解码参数变化时结果失效
+        model_tag = f"{loaded.backend}:{loaded.checkpoint_mtime}:{eval_args.n_best}:{eval_args.max_ans_length}"
+        if cast is not None:
+            model_tag += f":cast-{cast.tag}"
+        if cascade_layers:
+            model_tag += f":cascade-{cascade_layers}-{cascade_threshold}-{cheap_loaded.checkpoint_mtime}"
+        if backend == 'early_exit':
+            model_tag += f":exit-{exit_threshold}"
+        if marker_loaded is not None:
+            model_tag += f":shared-{max_quotes_per_window}-{marker_loaded.checkpoint_mtime}"
+        result_store = ResultStore(os.path.join(checkpoint_dir, 'result_store.json'), model_tag)
+        
+        # 构造CMRC格式数据集，只包含需要重新识别的样本
         dataset = {
             "version": "v1.0",
             "data": []
         }
         
+        qid_to_key = collections.OrderedDict()
+        # 规则确定的说话人，计算代价很小，不写入结果存储
+        rule_predictions = {}
+        if rule_fast_path:
+            rule_attributor = RuleAttributor({alias: cast.names[i] for alias, i in cast.alias_to_name.items()},
+                                             matcher=cast.matcher)
+        pending_keys = set()
+        pending_idxs = []
+        sentence_cache = SentenceTokenCache(sentences, tokenizer)
+        # 上下文的token预算：去掉最长的问题和[CLS]、[SEP]、[SEP]后整个窗口放进一个doc span
+        max_context_tokens = bert_config.max_position_embeddings - 64 - 3
+        context_sizes = {}
         for idx in quotes_idx:
             # 获取上下文
-            pre_context, quote_sentence, post_context, question_context = TextPreprocessor.get_context(sentences=sentences, quote_idx=idx, pre_size=pre_size, post_size=post_size)
+            if adaptive_context:
+                context_sizes[idx] = TextPreprocessor.select_context_sizes(
+                    sentences, idx, max_context_tokens, pre_size=pre_size, post_size=post_size,
+                    count_tokens=sentence_cache.count_tokens, grow=grow_context)
+            else:
+                context_sizes[idx] = (pre_size, post_size)
+            pre_context, quote_sentence, post_context, question_context = TextPreprocessor.get_context(sentences=sentences, quote_idx=idx, pre_size=context_sizes[idx][0], post_size=context_sizes[idx][1])
             
             # 构造完整上下文
             full_context = f"{pre_context} {quote_sentence} {post_context}"
             
+            qid = f"sentence_{idx}"
+            if rule_fast_path:
+                speaker = rule_attributor.attribute(sentences, idx)
+                if speaker is not None:
+                    rule_predictions[qid] = speaker
+                    continue
+            key = ResultStore.sample_key(full_context, question_context)
+            qid_to_key[qid] = key
+            if key in result_store or key in pending_keys:
+                continue
+            pending_keys.add(key)
+            pending_idxs.append(idx)
+            
             # 构造数据样本
             sample = {
                 "paragraphs": [{
-                    "id": f"sentence_{idx}",
+                    "id": qid,
                     "context": full_context,
                     "qas": [{
                         "question": question_context,
-                        "id": f"sentence_{idx}",
+                        "id": qid,
                         "answers": [{
                             "text": "说话人",
                             "answer_start": 1
@@ -177,82 +342,192 @@ def identify_speaker():
                 }]
             }
             dataset["data"].append(sample)
-            
-        # 保存数据集
-        dataset_dir = os.path.join(TEXT_DIR, base_dir + '_dataset.json')
-        with open(dataset_dir, 'w', encoding='utf-8') as f:
-            json.dump(dataset, f, ensure_ascii=False, indent=2)
-        
-        checkpoint_dir=os.path.join(PRED_DIR, base_dir)
-        # 准备评估参数
-        eval_args = argparse.Namespace(
-            gpu_ids='0',
-            n_batch=1,
-            max_ans_length=50,
-            n_best=6,
-            vocab_size=21128,
-            dev_dir1=os.path.join(TEXT_DIR, base_dir + '_examples.json'),
-            dev_dir2=os.path.join(TEXT_DIR, base_dir + '_features.json'),
-            dev_file=dataset_dir,
-            bert_config_file=os.path.join(ROOT_DIR, "model/chinese-roberta-wwm-ext-large-csi-v1/config.json"),
-            vocab_file=os.path.join(ROOT_DIR, "model/chinese-roberta-wwm-ext-large-csi-v1/vocab.txt"),
-            init_restore_dir=os.path.join(ROOT_DIR, "model/chinese-roberta-wwm-ext-large-csi-v1/csi-v1.pth"),
-            checkpoint_dir=checkpoint_dir
-        )
-        
-        # 设置GPU
-        os.environ["CUDA_VISIBLE_DEVICES"] = eval_args.gpu_ids
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         
-        # 加载BERT配置
-        bert_config = BertConfig.from_json_file(eval_args.bert_config_file)
+        prediction_path = os.path.join(checkpoint_dir, "predictions.json")
+        nbest_path = os.path.join(checkpoint_dir, "nbest.json")
         
-        # 加载分词器
-        tokenizer = tokenization.BertTokenizer(vocab_file=eval_args.vocab_file, do_lower_case=True)
+        def run_tier(tier_model, idxs, tier_args=eval_args, tier_device=device, dump=False):
+            """用tier_model识别idxs对应的引文，返回{qid: (prediction, nbest)}"""
+            # 生成唯一的任务ID
+            task_id = str(time.time())
+            if stream:
+                # 特征提取、推理和解码流水线执行，逐条得到结果
+                # 每个句子只分词一次，相邻引文共用句子的分词结果
+                feature_stream = sentence_cache.iter_features(idxs, context_sizes=context_sizes,
+                                                              max_seq_length=bert_config.max_position_embeddings)
+                results = evaluate_stream(tier_model, tier_args, feature_stream, tier_device)
+                return {qid: (prediction, nbest)
+                        for qid, prediction, nbest in WebSocketTqdm(results, total=len(idxs), desc="Evaluating",
+                                                                    socketio=socketio, task_id=task_id)}
+            qids = {f"sentence_{idx}" for idx in idxs}
+            tier_dataset = {"version": dataset["version"],
+                            "data": [sample for sample in dataset["data"] if sample["paragraphs"][0]["id"] in qids]}
+            if dump:
+                # 调试时保存数据集、样例和特征
+                with open(eval_args.dev_file, 'w', encoding='utf-8') as f:
+                    json.dump(tier_dataset, f, ensure_ascii=False, indent=2)
+                feature_files = [eval_args.dev_dir1, eval_args.dev_dir2]
+            else:
+                feature_files = None
+            
+            # 直接在内存中进行特征提取
+            if feature_files is None and preprocess_workers <= 1:
+                dev_examples, dev_features = sentence_cache.json2features(
+                    idxs, context_sizes=context_sizes, max_seq_length=bert_config.max_position_embeddings)
+            else:
+                dev_examples, dev_features = json2features(tier_dataset,
+                                                           feature_files,
+                                                           tokenizer,
+                                                           is_training=False,
+                                                           max_seq_length=bert_config.max_position_embeddings,
+                                                           num_workers=preprocess_workers)
+            
+            # 进行评估，传入socketio和task_id
+            predictions, nbest_json = evaluate(tier_model, tier_args, dev_examples, dev_features, tier_device,
+                                               socketio=socketio, task_id=task_id)
+            return {qid: (prediction, nbest_json[qid]) for qid, prediction in predictions.items()}
         
-        # if not os.path.exists(eval_args.dev_dir1) or not os.path.exists(eval_args.dev_dir2):
-        #     print('Converting examples to features...')
-        #     # 进行特征提取
-        #     json2features(eval_args.dev_file, 
-        #                 [eval_args.dev_dir1, eval_args.dev_dir2], 
-        #                 tokenizer, 
-        #                 is_training=False,
-        #                 max_seq_length=bert_config.max_position_embeddings)
-        # 进行特征提取
-        json2features(eval_args.dev_file, 
-                    [eval_args.dev_dir1, eval_args.dev_dir2], 
-                    tokenizer, 
-                    is_training=False,
-                    max_seq_length=bert_config.max_position_embeddings)
+        new_results = {}
+        # 需要逐条识别的样本
+        model_idxs = pending_idxs
+        if pending_idxs and marker_loaded is not None:
+            # 共享窗口识别：上下文重叠的相邻引文放进同一个窗口，一次前向得到所有引文的答案
+            shared_start = time.time()
+            shared_predictions, shared_nbest, fallback_idxs, num_windows = predict_shared_windows(
+                marker_loaded.model, sentences, pending_idxs, tokenizer, marker_loaded.device,
+                pre_size=pre_size, post_size=post_size, max_seq_length=bert_config.max_position_embeddings,
+                max_quotes_per_window=max_quotes_per_window, n_batch=n_batch, n_best=eval_args.n_best,
+                max_ans_length=eval_args.max_ans_length)
+            for qid, prediction in shared_predictions.items():
+                if cast is not None:
+                    # 给出cast时只接受角色名，并换成规范名字
+                    alias = "".join(prediction.split())
+                    if alias not in cast.alias_to_name:
+                        continue
+                    prediction = cast.names[cast.alias_to_name[alias]]
+                new_results[qid] = (prediction, shared_nbest[qid])
+            model_idxs = [idx for idx in pending_idxs if f"sentence_{idx}" not in new_results]
+            shared_window_stats = {
+                'used': True,
+                'windows': num_windows,
+                'resolved': len(new_results),
+                'fallback': len(model_idxs),
+                'time': time.time() - shared_start
+            }
         
-        # 加载开发集数据
-        dev_examples = json.load(open(eval_args.dev_dir1, 'r', encoding='utf-8'))
-        dev_features = json.load(open(eval_args.dev_dir2, 'r', encoding='utf-8'))
+        cascade_stats = None
+        if model_idxs and cascade_layers:
+            # 级联识别：廉价模型识别所有样本，首选答案置信度低的样本再由完整模型识别
+            # cast解码只在上下文中出现的角色名之间归一化概率，不能作为置信度，廉价模型按原方式解码
+            cheap_args = argparse.Namespace(**dict(vars(eval_args), cast=None))
+            cheap_start = time.time()
+            cheap_results = run_tier(TruncatedQuestionAnswering(cheap_loaded.model, cascade_layers), model_idxs,
+                                     tier_args=cheap_args, tier_device=cheap_loaded.device, dump=debug_dump)
+            cheap_time = time.time() - cheap_start
+            escalated_idxs = []
+            for idx in model_idxs:
+                qid = f"sentence_{idx}"
+                prediction, nbest = cheap_results[qid]
+                if not nbest or nbest[0]["probability"] < cascade_threshold:
+                    escalated_idxs.append(idx)
+                elif cast is not None:
+                    # 给出cast时只接受角色名，并换成规范名字
+                    alias = "".join(prediction.split())
+                    if alias in cast.alias_to_name:
+                        cheap_results[qid] = (cast.names[cast.alias_to_name[alias]], nbest)
+                    else:
+                        escalated_idxs.append(idx)
+            full_start = time.time()
+            if escalated_idxs:
+                cheap_results.update(run_tier(model, escalated_idxs))
+            new_results.update(cheap_results)
+            cascade_stats = {
+                'layers': cascade_layers,
+                'threshold': cascade_threshold,
+                'escalated': len(escalated_idxs),
+                'escalation_rate': len(escalated_idxs) / len(model_idxs),
+                'cheap_time': cheap_time,
+                'full_time': time.time() - full_start
+            }
+        elif model_idxs:
+            new_results.update(run_tier(model, model_idxs, dump=debug_dump))
         
-        # 初始化模型
-        model = BertForQuestionAnswering(bert_config)
-        utils.torch_init_model(model, eval_args.init_restore_dir)
-        model.to(device)
+        # 把新的识别结果写入存储
+        for qid, (prediction, nbest) in new_results.items():
+            result_store.put(qid_to_key[qid], prediction, nbest)
         
-        # 生成唯一的任务ID
-        task_id = str(time.time())
-        # 进行评估，传入socketio和task_id
-        evaluate(model, eval_args, dev_examples, dev_features, device, socketio=socketio, task_id=task_id)
+        # 合并复用的和新识别的结果，按引文顺序输出
+        all_predictions = collections.OrderedDict()
+        all_nbest = collections.OrderedDict()
+        for idx in quotes_idx:
+            qid = f"sentence_{idx}"
+            if qid in rule_predictions:
+                all_predictions[qid] = rule_predictions[qid]
+                all_nbest[qid] = RuleAttributor.nbest(rule_predictions[qid])
+                continue
+            result = result_store.get(qid_to_key[qid])
+            all_predictions[qid] = result['prediction']
+            all_nbest[qid] = result['nbest']
+        result_store.prune(qid_to_key.values())
+        result_store.save()
         
-        # 返回结果路径
-        prediction_path = os.path.join(checkpoint_dir, "predictions.json")
-        nbest_path = os.path.join(checkpoint_dir, "nbest.json")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(prediction_path, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n")
+        with open(nbest_path, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_nbest, indent=4, ensure_ascii=False) + "\n")
         
         return jsonify({
             'success': True,
             'speakers_dir': prediction_path,
-            'nbest_dir': nbest_path
+            'nbest_dir': nbest_path,
+            'reused': len(qid_to_key) - len(dataset["data"]),
+            'inferred': len(dataset["data"]),
+            'rule_resolved': len(rule_predictions),
+            'rule_fraction': len(rule_predictions) / len(quotes_idx) if quotes_idx else 0.0,
+            'shared_window': shared_window_stats,
+            'cascade': cascade_stats,
+            'early_exit': model.stats() if backend == 'early_exit' else None,
+            'elapsed': time.time() - request_start
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/api/model/status', methods=['GET'])
+def model_status():
+    """
+    说话人识别模型状态API
+    返回格式: {
+        "success": true/false,
+        "status": {"loaded": 已加载的推理后端列表(按名称排序), "checkpoint": 模型权重文件路径,
+                   "resident_memory_mb": 进程常驻内存,
+                   "models": {后端名: {"backend", "device", "loaded_at", "checkpoint_mtime", "load_time": 加载耗时,
+                                       "warmup_time": 预热耗时, "model_memory_mb": 加载模型增加的内存}}}
+    }
+    """
+    try:
+        return jsonify({'success': True, 'status': model_registry.status()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/model/reload', methods=['POST'])
+def model_reload():
+    """
+    强制重新加载说话人识别模型
+    请求体格式: {"backend": 需要重新加载的推理后端(可选，默认重新加载所有已加载的后端)}
+    返回格式: {"success": true/false, "status": 模型状态}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        model_registry.reload(data.get('backend'))
+        return jsonify({'success': True, 'status': model_registry.status()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
 @app.route('/api/voices')
 def get_voices():
     # 这里可以扩展为动态获取可用声音列表
@@ -271,9 +546,15 @@ def serve_audio(filename):
     return send_file(os.path.join(AUDIO_DIR, filename))
 
 if __name__ == '__main__':
+    # 启动时预加载模型；debug模式下只在实际提供服务的子进程中加载
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        try:
+            model_registry.get()
+        except Exception as e:
+            print(f"预加载说话人识别模型失败，将在首次请求时重试: {e}")
     
     app.run(
         host='127.0.0.1',  
         port=10032,
-        debug=True
+        debug=DEBUG
     )
\ No newline at end of file
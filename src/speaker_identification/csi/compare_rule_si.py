@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import argparse
+import torch
+
+from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering
+from src.speaker_identification.csi.tokenizations import official_tokenization as tokenization
+from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import json2features
+from src.speaker_identification.csi.preprocess import utils
+from src.speaker_identification.csi.evaluate.name_decoding import CastList
+from src.speaker_identification.csi.test_si import evaluate
+from src.speaker_identification.csi.compare_shared_si import build_per_quote_dataset, accuracy, agreement
+from src.speaker_identification.preprocess.rule_attribution import RuleAttributor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the rule-based fast path against the per-quote model on a reference book')
+    parser.add_argument('--gpu_ids', type=str, default='0')
+    parser.add_argument('--sentences_file', type=str, required=True,
+                        help='Sentences json of a book ({"sentences": [...], "quotes_idx": [...]})')
+    parser.add_argument('--labels_file', type=str, default=None,
+                        help='Optional json mapping "sentence_{idx}" to the annotated speaker')
+    parser.add_argument('--cast_file', type=str, default=None,
+                        help='Optional json cast list (a list of names, or a dict of name to aliases); '
+                             'when given the rules only accept these names')
+    parser.add_argument('--bert_config_file', type=str, required=True)
+    parser.add_argument('--vocab_file', type=str, required=True)
+    parser.add_argument('--init_restore_dir', type=str, required=True,
+                        help='Per-quote BertForQuestionAnswering checkpoint')
+    parser.add_argument('--pre_size', type=int, default=3)
+    parser.add_argument('--post_size', type=int, default=3)
+    parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--n_best', type=int, default=6)
+    parser.add_argument('--max_ans_length', type=int, default=50)
+    parser.add_argument('--output_file', type=str, default='rule_fast_path_report.json')
+
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_ids
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    with open(args.sentences_file, 'r', encoding='utf-8') as f:
+        sentences_data = json.load(f)
+    sentences = sentences_data['sentences']
+    quotes_idx = sentences_data['quotes_idx']
+    labels = {}
+    if args.labels_file:
+        with open(args.labels_file, 'r', encoding='utf-8') as f:
+            labels = json.load(f)
+    cast = None
+    if args.cast_file:
+        with open(args.cast_file, 'r', encoding='utf-8') as f:
+            cast = CastList(json.load(f))
+
+    bert_config = BertConfig.from_json_file(args.bert_config_file)
+    tokenizer = tokenization.get_tokenizer(args.vocab_file, do_lower_case=True)
+    model = BertForQuestionAnswering(bert_config)
+    utils.torch_init_model(model, args.init_restore_dir)
+    model.to(device)
+
+    # 规则：只统计能确定说话人的引文
+    start_time = time.time()
+    if cast is not None:
+        rule_attributor = RuleAttributor({alias: cast.names[i] for alias, i in cast.alias_to_name.items()},
+                                         matcher=cast.matcher)
+    else:
+        # 没有角色名表时按人名模式匹配，只用于评估这种模式的误判
+        rule_attributor = RuleAttributor()
+    rule_predictions = {}
+    for idx in quotes_idx:
+        speaker = rule_attributor.attribute(sentences, idx)
+        if speaker is not None:
+            rule_predictions[f"sentence_{idx}"] = speaker
+    rule_time = time.time() - start_time
+
+    # 模型：所有引文逐条识别
+    eval_args = argparse.Namespace(n_batch=args.n_batch, bucket_by_length=True, max_batch_tokens=0,
+                                   n_best=args.n_best, max_ans_length=args.max_ans_length, checkpoint_dir=None,
+                                   cast=cast)
+    start_time = time.time()
+    dataset = build_per_quote_dataset(sentences, quotes_idx, args.pre_size, args.post_size)
+    examples, features = json2features(dataset, None, tokenizer, is_training=False,
+                                       max_seq_length=bert_config.max_position_embeddings)
+    model_predictions, _ = evaluate(model, eval_args, examples, features, device)
+    model_time = time.time() - start_time
+
+    # 快速路径：规则确定的引文用规则结果，其余用模型结果
+    fast_path_predictions = dict(model_predictions)
+    fast_path_predictions.update(rule_predictions)
+    model_on_rule_quotes = {qid: model_predictions[qid] for qid in rule_predictions}
+
+    n_quotes = len(quotes_idx)
+    report = {
+        'n_quotes': n_quotes,
+        'rule': {'time': rule_time,
+                 'resolved': len(rule_predictions),
+                 'coverage': len(rule_predictions) / n_quotes if n_quotes else 0.0,
+                 'agreement_with_model': agreement(model_on_rule_quotes, rule_predictions),
+                 'accuracy': accuracy(rule_predictions, labels),
+                 'model_accuracy_on_same_quotes': accuracy(model_on_rule_quotes, labels)},
+        'model': {'time': model_time,
+                  'quotes_per_second': n_quotes / model_time if model_time else None,
+                  'accuracy': accuracy(model_predictions, labels)},
+        'fast_path': {'accuracy': accuracy(fast_path_predictions, labels),
+                      'agreement_with_model': agreement(model_predictions, fast_path_predictions)},
+    }
+    with open(args.output_file, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
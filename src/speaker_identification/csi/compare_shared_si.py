@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import argparse
+import collections
+import torch
+
+from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering, \
+    BertForMultiQuoteQA
+from src.speaker_identification.csi.tokenizations import official_tokenization as tokenization
+from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import json2features
+from src.speaker_identification.csi.preprocess import utils, shared_window
+from src.speaker_identification.csi.test_si import evaluate
+from src.speaker_identification.preprocess.text_preprocess import TextPreprocessor
+
+
+def build_per_quote_dataset(sentences, quotes_idx, pre_size, post_size):
+    """与identify-speaker接口相同的逐条引文数据集"""
+    dataset = {"version": "v1.0", "data": []}
+    for idx in quotes_idx:
+        pre_context, quote_sentence, post_context, question_context = TextPreprocessor.get_context(
+            sentences=sentences, quote_idx=idx, pre_size=pre_size, post_size=post_size)
+        qid = f"sentence_{idx}"
+        dataset["data"].append({
+            "paragraphs": [{
+                "id": qid,
+                "context": f"{pre_context} {quote_sentence} {post_context}",
+                "qas": [{"question": question_context, "id": qid,
+                         "answers": [{"text": "说话人", "answer_start": 1}]}]
+            }]
+        })
+    return dataset
+
+
+def accuracy(predictions, labels):
+    """预测与标注说话人一致的比例，只统计有标注的引文"""
+    qids = [qid for qid in predictions if qid in labels]
+    if not qids:
+        return None
+    return sum(1 for qid in qids if predictions[qid] == labels[qid]) / len(qids)
+
+
+def agreement(reference, candidate):
+    return sum(1 for qid, text in reference.items() if candidate.get(qid) == text) / len(reference) \
+        if reference else 1.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare shared-window multi-quote inference against the per-quote mode')
+    parser.add_argument('--gpu_ids', type=str, default='0')
+    parser.add_argument('--sentences_file', type=str, required=True,
+                        help='Sentences json of a book ({"sentences": [...], "quotes_idx": [...]})')
+    parser.add_argument('--labels_file', type=str, default=None,
+                        help='Optional json mapping "sentence_{idx}" to the annotated speaker')
+    parser.add_argument('--bert_config_file', type=str, required=True)
+    parser.add_argument('--vocab_file', type=str, required=True)
+    parser.add_argument('--init_restore_dir', type=str, required=True,
+                        help='Per-quote BertForQuestionAnswering checkpoint')
+    parser.add_argument('--marker_restore_dir', type=str, required=True,
+                        help='BertForMultiQuoteQA checkpoint trained with run_si --marker_training')
+    parser.add_argument('--pre_size', type=int, default=3)
+    parser.add_argument('--post_size', type=int, default=3)
+    parser.add_argument('--max_quotes_per_window', type=int, default=8)
+    parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--n_best', type=int, default=6)
+    parser.add_argument('--max_ans_length', type=int, default=50)
+    parser.add_argument('--output_file', type=str, default='shared_window_report.json')
+
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_ids
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    with open(args.sentences_file, 'r', encoding='utf-8') as f:
+        sentences_data = json.load(f)
+    sentences = sentences_data['sentences']
+    quotes_idx = sentences_data['quotes_idx']
+    labels = {}
+    if args.labels_file:
+        with open(args.labels_file, 'r', encoding='utf-8') as f:
+            labels = json.load(f)
+
+    bert_config = BertConfig.from_json_file(args.bert_config_file)
+    tokenizer = tokenization.get_tokenizer(args.vocab_file, do_lower_case=True)
+
+    per_quote_model = BertForQuestionAnswering(bert_config)
+    utils.torch_init_model(per_quote_model, args.init_restore_dir)
+    per_quote_model.to(device)
+    marker_model = BertForMultiQuoteQA(bert_config)
+    utils.torch_init_model(marker_model, args.marker_restore_dir)
+    marker_model.to(device)
+
+    # 逐条引文模式：特征提取+推理+解码的总耗时
+    eval_args = argparse.Namespace(n_batch=args.n_batch, bucket_by_length=True, max_batch_tokens=0,
+                                   n_best=args.n_best, max_ans_length=args.max_ans_length, checkpoint_dir=None)
+    start_time = time.time()
+    dataset = build_per_quote_dataset(sentences, quotes_idx, args.pre_size, args.post_size)
+    examples, features = json2features(dataset, None, tokenizer, is_training=False,
+                                       max_seq_length=bert_config.max_position_embeddings)
+    per_quote_predictions, _ = evaluate(per_quote_model, eval_args, examples, features, device)
+    per_quote_time = time.time() - start_time
+
+    # 共享窗口模式：放不进一个窗口的引文退回逐条模式的结果
+    start_time = time.time()
+    shared_predictions, _, fallback_idxs, n_windows = shared_window.predict_shared_windows(
+        marker_model, sentences, quotes_idx, tokenizer, device, pre_size=args.pre_size, post_size=args.post_size,
+        max_seq_length=bert_config.max_position_embeddings, max_quotes_per_window=args.max_quotes_per_window,
+        n_batch=args.n_batch, n_best=args.n_best, max_ans_length=args.max_ans_length)
+    shared_time = time.time() - start_time
+    for idx in fallback_idxs:
+        qid = f"sentence_{idx}"
+        shared_predictions[qid] = per_quote_predictions[qid]
+    shared_predictions = collections.OrderedDict(
+        (f"sentence_{idx}", shared_predictions[f"sentence_{idx}"]) for idx in quotes_idx)
+
+    n_quotes = len(quotes_idx)
+    report = {
+        'n_quotes': n_quotes,
+        'per_quote': {'time': per_quote_time,
+                      'quotes_per_second': n_quotes / per_quote_time if per_quote_time else None,
+                      'accuracy': accuracy(per_quote_predictions, labels)},
+        'shared_window': {'time': shared_time,
+                          'quotes_per_second': (n_quotes - len(fallback_idxs)) / shared_time if shared_time else None,
+                          'windows': n_windows,
+                          'quotes_per_window': (n_quotes - len(fallback_idxs)) / n_windows if n_windows else 0,
+                          'fallback_quotes': len(fallback_idxs),
+                          'accuracy': accuracy(shared_predictions, labels)},
+        'agreement_with_per_quote': agreement(per_quote_predictions, shared_predictions),
+    }
+    with open(args.output_file, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
@@ -0,0 +1,15 @@
+import argparse
+
+from src.speaker_identification.csi.preprocess import utils
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a .pth checkpoint into a memory-mappable checkpoint (e.g. csi-v1.mmap.pth)')
+    parser.add_argument('--init_restore_dir', type=str, required=True,
+                        help='Path to the model checkpoint file')
+    parser.add_argument('--output_file', type=str, default=None,
+                        help='Path of the converted checkpoint (defaults to next to the checkpoint)')
+
+    args = parser.parse_args()
+    utils.convert_checkpoint_to_mmap(args.init_restore_dir, args.output_file)
@@ -3,8 +3,10 @@ import sys
 
 sys.path.append('../tokenizations')
 from src.speaker_identification.csi.tokenizations.official_tokenization import BasicTokenizer
+from src.speaker_identification.csi.preprocess.feature_store import as_feature_store
 import math
 import json
+import numpy as np
 from tqdm import tqdm
 
 
@@ -159,102 +161,117 @@ def write_predictions_topk(FLAGS, all_examples, all_features, all_results, n_bes
 
 def write_predictions(all_examples, all_features, all_results, n_best_size,
                       max_answer_length, do_lower_case, output_prediction_file,
-                      output_nbest_file, version_2_with_negative=False, null_score_diff_threshold=0.):
-    """Write final predictions to the json file and log-odds of null if needed."""
-    print("Writing predictions to: %s" % (output_prediction_file))
-    print("Writing nbest to: %s" % (output_nbest_file))
-
+                      output_nbest_file, version_2_with_negative=False, null_score_diff_threshold=0.,
+                      show_progress=True, only_examples=None):
+    """Write final predictions to the json file and log-odds of null if needed.
+
+    Pass None as the output files to skip writing; the predictions and n-best lists
+    are returned either way. `all_features` is a FeatureStore or a list of feature
+    dicts, which is converted to one. The logits of a result may be lists or arrays.
+    `only_examples` optionally restricts decoding to a set of example indexes.
+
+    The (start, end) candidates of a feature are checked as one n_best x n_best
+    matrix and the candidates of an example are ranked with one stable argsort, in
+    the same order as the original nested loops and sort.
+    """
+    if output_prediction_file is not None:
+        print("Writing predictions to: %s" % (output_prediction_file))
+        print("Writing nbest to: %s" % (output_nbest_file))
+
+    feature_store = as_feature_store(all_features)
     example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature['example_index']].append(feature)
+    for feature_id, example_index in enumerate(feature_store.example_index.tolist()):
+        example_index_to_features[example_index].append(feature_id)
 
     unique_id_to_result = {}
     for result in all_results:
         unique_id_to_result[result.unique_id] = result
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
-
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
     scores_diff_json = collections.OrderedDict()
 
-    for (example_index, example) in enumerate(tqdm(all_examples)):
+    for (example_index, example) in enumerate(tqdm(all_examples, disable=not show_progress)):
+        if only_examples is not None and example_index not in only_examples:
+            continue
         features = example_index_to_features[example_index]
-        prelim_predictions = []
+        # candidate columns, one array per feature
+        prelim_feature_index = []
+        prelim_start_index = []
+        prelim_end_index = []
+        prelim_start_logit = []
+        prelim_end_logit = []
         # keep track of the minimum score of null start+end of position 0
         score_null = 1000000  # large and positive
         min_null_feature_index = 0  # the paragraph slice with min null score
         null_start_logit = 0  # the start logit at the slice with min null score
         null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature['unique_id']]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
+        for (feature_index, feature_id) in enumerate(features):
+            result = unique_id_to_result[int(feature_store.unique_id[feature_id])]
+            # float64 like the Python floats of .tolist(), so the sums and ranking match
+            start_logits = np.asarray(result.start_logits, dtype=np.float64)
+            end_logits = np.asarray(result.end_logits, dtype=np.float64)
+            num_tokens = feature_store.length(feature_id)
+            token_to_orig = feature_store.feature_token_to_orig(feature_id)
+            max_context = feature_store.feature_max_context(feature_id)
+            start_indexes = _get_best_indexes(start_logits, n_best_size)
+            end_indexes = _get_best_indexes(end_logits, n_best_size)
             # if we could have irrelevant answers, get the min score of irrelevant
             if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
+                feature_null_score = start_logits[0] + end_logits[0]
                 if feature_null_score < score_null:
                     score_null = feature_null_score
                     min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature['tokens']):
-                        continue
-                    if end_index >= len(feature['tokens']):
-                        continue
-                    if str(start_index) not in feature['token_to_orig_map'] and \
-                            start_index not in feature['token_to_orig_map']:
-                        continue
-                    if str(end_index) not in feature['token_to_orig_map'] and \
-                            end_index not in feature['token_to_orig_map']:
-                        continue
-                    if not feature['token_is_max_context'].get(str(start_index), False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
+                    null_start_logit = start_logits[0]
+                    null_end_logit = end_logits[0]
+
+            # We could hypothetically create invalid predictions, e.g., predict
+            # that the start of the span is in the question. We throw out all
+            # invalid predictions.
+            valid_start = start_indexes < num_tokens
+            valid_start[valid_start] = (token_to_orig[start_indexes[valid_start]] >= 0) & \
+                max_context[start_indexes[valid_start]]
+            valid_end = end_indexes < num_tokens
+            valid_end[valid_end] = token_to_orig[end_indexes[valid_end]] >= 0
+            length = end_indexes[None, :] - start_indexes[:, None] + 1
+            valid = valid_start[:, None] & valid_end[None, :] & (length >= 1) & (length <= max_answer_length)
+            # row-major, i.e. the order of the start/end loops
+            rows, cols = np.nonzero(valid)
+            prelim_feature_index.append(np.full(len(rows), feature_index, dtype=np.int64))
+            prelim_start_index.append(start_indexes[rows])
+            prelim_end_index.append(end_indexes[cols])
+            prelim_start_logit.append(start_logits[start_indexes[rows]])
+            prelim_end_logit.append(end_logits[end_indexes[cols]])
         if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit))
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
+            prelim_feature_index.append(np.array([min_null_feature_index], dtype=np.int64))
+            prelim_start_index.append(np.zeros(1, dtype=np.int64))
+            prelim_end_index.append(np.zeros(1, dtype=np.int64))
+            prelim_start_logit.append(np.array([null_start_logit], dtype=np.float64))
+            prelim_end_logit.append(np.array([null_end_logit], dtype=np.float64))
+        prelim_feature_index = _concat(prelim_feature_index, np.int64)
+        prelim_start_index = _concat(prelim_start_index, np.int64)
+        prelim_end_index = _concat(prelim_end_index, np.int64)
+        prelim_start_logit = _concat(prelim_start_logit, np.float64)
+        prelim_end_logit = _concat(prelim_end_logit, np.float64)
+        # stable, so equal scores keep their candidate order like sorted(..., reverse=True)
+        prelim_order = np.argsort(-(prelim_start_logit + prelim_end_logit), kind='stable')
 
         _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
             "NbestPrediction", ["text", "start_logit", "end_logit"])
 
         seen_predictions = {}
         nbest = []
-        for pred in prelim_predictions:
+        for k in prelim_order:
             if len(nbest) >= n_best_size:
                 break
-            feature = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = feature['tokens'][pred.start_index:(pred.end_index + 1)]
-                orig_doc_start = feature['token_to_orig_map'][str(pred.start_index)]
-                orig_doc_end = feature['token_to_orig_map'][str(pred.end_index)]
+            feature_id = features[prelim_feature_index[k]]
+            start_index = int(prelim_start_index[k])
+            end_index = int(prelim_end_index[k])
+            if start_index > 0:  # this is a non-null prediction
+                tok_tokens = feature_store.feature_tokens(feature_id, start_index, end_index + 1)
+                token_to_orig = feature_store.feature_token_to_orig(feature_id)
+                orig_doc_start = int(token_to_orig[start_index])
+                orig_doc_end = int(token_to_orig[end_index])
                 orig_tokens = example['doc_tokens'][orig_doc_start:(orig_doc_end + 1)]
                 tok_text = "".join(tok_tokens)
 
@@ -279,8 +296,8 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
             nbest.append(
                 _NbestPrediction(
                     text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit))
+                    start_logit=float(prelim_start_logit[k]),
+                    end_logit=float(prelim_end_logit[k])))
         # if we didn't include the empty option in the n-best, include it
         if version_2_with_negative:
             if "" not in seen_predictions:
@@ -336,11 +353,15 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
                 all_predictions[example['qid']] = best_non_null_entry.text
             all_nbest_json[example['qid']] = nbest_json
 
-    with open(output_prediction_file, "w", encoding='utf8') as writer:
-        writer.write(json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n")
+    if output_prediction_file is not None:
+        with open(output_prediction_file, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n")
 
-    with open(output_nbest_file, "w", encoding='utf8') as writer:
-        writer.write(json.dumps(all_nbest_json, indent=4, ensure_ascii=False) + "\n")
+    if output_nbest_file is not None:
+        with open(output_nbest_file, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_nbest_json, indent=4, ensure_ascii=False) + "\n")
+
+    return all_predictions, all_nbest_json
 
 
 def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
@@ -438,15 +459,12 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 
 def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+    """Get the indexes of the n-best logits, ties in position order, as an array."""
+    return np.argsort(-np.asarray(logits, dtype=np.float64), kind='stable')[:n_best_size]
+
+
+def _concat(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.zeros(0, dtype=dtype)
 
 
 def _compute_softmax(scores):
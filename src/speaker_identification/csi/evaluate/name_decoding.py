@@ -0,0 +1,181 @@
+"""Name-constrained span decoding.
+
+Once the cast of a book is known, the speaker of a quote can only be one of its
+characters. Instead of searching the n_best x n_best span candidates and mapping
+the winner back to text, only the spans where a character name or alias occurs
+in the context are scored (start logit + end logit), and the canonical name of
+the best one is returned directly.
+"""
+import json
+import hashlib
+import collections
+
+import numpy as np
+from tqdm import tqdm
+
+from src.speaker_identification.csi.evaluate.cmrc2018_output import write_predictions, _compute_softmax
+from src.speaker_identification.csi.preprocess.feature_store import as_feature_store
+from src.speaker_identification.preprocess.name_matcher import NameMatcher
+
+
+class CastList(object):
+    """Character names of a book and their aliases.
+
+    `cast` is a list of names or a dict mapping each canonical name to a list of
+    aliases. Names and aliases are matched without whitespace, like doc tokens.
+    """
+
+    def __init__(self, cast):
+        items = cast.items() if isinstance(cast, dict) else [(name, ()) for name in cast]
+        self.names = []
+        name_index = {}
+        self.alias_to_name = {}
+        for name, aliases in items:
+            name = name.strip()
+            if not name:
+                continue
+            if name not in name_index:
+                name_index[name] = len(self.names)
+                self.names.append(name)
+            for alias in [name] + list(aliases or ()):
+                alias = "".join(alias.split())
+                if alias and alias not in self.alias_to_name:
+                    self.alias_to_name[alias] = name_index[name]
+        self.matcher = NameMatcher(self.alias_to_name)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def tag(self):
+        """Content hash of the cast, for keying cached results."""
+        content = json.dumps([self.names, sorted(self.alias_to_name.items())], ensure_ascii=False)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+
+    def doc_matches(self, doc_tokens):
+        """(name_index, start_doc, end_doc) of every alias occurrence that starts and
+        ends on doc token boundaries."""
+        starts = {}
+        ends = {}
+        offset = 0
+        for (i, token) in enumerate(doc_tokens):
+            starts[offset] = i
+            offset += len(token)
+            ends[offset] = i
+        matches = []
+        for alias, start, end in self.matcher.find_names("".join(doc_tokens)):
+            if start in starts and end in ends:
+                matches.append((self.alias_to_name[alias], starts[start], ends[end]))
+        return matches
+
+    def feature_spans(self, doc_matches, token_to_orig, max_context, max_answer_length=50):
+        """Token offsets of the name occurrences inside one feature.
+
+        Args:
+            doc_matches: result of doc_matches for the feature's example
+            token_to_orig: doc token index of every feature token, -1 where unmapped
+            max_context: whether every feature token is in its max-context span
+        Returns:
+            (starts, ends, name_indexes) arrays; like the span decoder, a start must be
+            in its max context and the span no longer than max_answer_length
+        """
+        token_to_orig = np.asarray(token_to_orig)
+        positions = np.nonzero(token_to_orig >= 0)[0]
+        first = {}
+        last = {}
+        for position, doc_index in zip(positions.tolist(), token_to_orig[positions].tolist()):
+            first.setdefault(doc_index, position)
+            last[doc_index] = position
+        starts, ends, name_indexes = [], [], []
+        for name_index, start_doc, end_doc in doc_matches:
+            if start_doc not in first or end_doc not in last:
+                continue
+            start, end = first[start_doc], last[end_doc]
+            if not max_context[start] or end - start + 1 > max_answer_length:
+                continue
+            starts.append(start)
+            ends.append(end)
+            name_indexes.append(name_index)
+        return (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                np.array(name_indexes, dtype=np.int64))
+
+
+def write_name_predictions(all_examples, all_features, all_results, cast, n_best_size, max_answer_length,
+                           do_lower_case, output_prediction_file, output_nbest_file, show_progress=True):
+    """Decodes every example to the canonical name of its best scoring cast span.
+
+    Same arguments, outputs and n-best format as write_predictions, with the
+    character names as the n-best texts. Examples whose context mentions no one
+    from `cast` (a CastList) fall back to write_predictions.
+    """
+    feature_store = as_feature_store(all_features)
+    example_index_to_features = collections.defaultdict(list)
+    for feature_id, example_index in enumerate(feature_store.example_index.tolist()):
+        example_index_to_features[example_index].append(feature_id)
+
+    unique_id_to_result = {}
+    for result in all_results:
+        unique_id_to_result[result.unique_id] = result
+
+    name_predictions = {}
+    name_nbest_json = {}
+    fallback_examples = set()
+    for (example_index, example) in enumerate(tqdm(all_examples, disable=not show_progress)):
+        doc_matches = cast.doc_matches(example['doc_tokens'])
+        # name index -> (score, start_logit, end_logit) of its best span
+        best = {}
+        for feature_id in example_index_to_features[example_index] if doc_matches else ():
+            starts, ends, name_indexes = cast.feature_spans(
+                doc_matches, feature_store.feature_token_to_orig(feature_id),
+                feature_store.feature_max_context(feature_id), max_answer_length)
+            if not len(starts):
+                continue
+            result = unique_id_to_result[int(feature_store.unique_id[feature_id])]
+            start_logits = np.asarray(result.start_logits, dtype=np.float64)[starts]
+            end_logits = np.asarray(result.end_logits, dtype=np.float64)[ends]
+            scores = start_logits + end_logits
+            for name_index, score, start_logit, end_logit in zip(name_indexes.tolist(), scores.tolist(),
+                                                                 start_logits.tolist(), end_logits.tolist()):
+                if name_index not in best or score > best[name_index][0]:
+                    best[name_index] = (score, start_logit, end_logit)
+        if not best:
+            fallback_examples.add(example_index)
+            continue
+
+        ranked = sorted(best.items(), key=lambda item: item[1][0], reverse=True)[:n_best_size]
+        probs = _compute_softmax([score for _, (score, _, _) in ranked])
+        nbest_json = []
+        for (i, (name_index, (_, start_logit, end_logit))) in enumerate(ranked):
+            output = collections.OrderedDict()
+            output["text"] = cast.names[name_index]
+            output["probability"] = float(probs[i])
+            output["start_logit"] = float(start_logit)
+            output["end_logit"] = float(end_logit)
+            nbest_json.append(output)
+        name_predictions[example['qid']] = nbest_json[0]["text"]
+        name_nbest_json[example['qid']] = nbest_json
+
+    if fallback_examples:
+        fallback_predictions, fallback_nbest_json = write_predictions(
+            all_examples, feature_store, all_results, n_best_size=n_best_size,
+            max_answer_length=max_answer_length, do_lower_case=do_lower_case,
+            output_prediction_file=None, output_nbest_file=None, show_progress=False,
+            only_examples=fallback_examples)
+        name_predictions.update(fallback_predictions)
+        name_nbest_json.update(fallback_nbest_json)
+
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    for example in all_examples:
+        all_predictions[example['qid']] = name_predictions[example['qid']]
+        all_nbest_json[example['qid']] = name_nbest_json[example['qid']]
+
+    if output_prediction_file is not None:
+        with open(output_prediction_file, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n")
+
+    if output_nbest_file is not None:
+        with open(output_nbest_file, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_nbest_json, indent=4, ensure_ascii=False) + "\n")
+
+    return all_predictions, all_nbest_json
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import argparse
+import torch
+
+from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering
+from src.speaker_identification.csi.models import exported
+from src.speaker_identification.csi.preprocess import utils
+
+
+def measure_latency(model, inputs, n_runs):
+    """返回每个特征的平均推理耗时(毫秒)"""
+    with torch.no_grad():
+        model(*inputs)  # warmup
+        start_time = time.time()
+        for _ in range(n_runs):
+            model(*inputs)
+    return 1000 * (time.time() - start_time) / (n_runs * inputs[0].size(0))
+
+
+def max_logit_diff(reference_model, model, inputs):
+    """两个模型在真实token上start/end logits的最大绝对误差"""
+    with torch.no_grad():
+        ref_start, ref_end = reference_model(*inputs)
+        start, end = model(*inputs)
+    mask = inputs[2].bool()
+    return max((ref_start - start).abs()[mask].max().item(),
+               (ref_end - end).abs()[mask].max().item())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the speaker identification model to a graph-optimized TorchScript/ONNX artifact')
+    parser.add_argument('--format', type=str, default='torchscript', choices=sorted(exported.EXPORT_FORMATS))
+    parser.add_argument('--bert_config_file', type=str, required=True,
+                        help='Path to the bert config file')
+    parser.add_argument('--init_restore_dir', type=str, required=True,
+                        help='Path to the model checkpoint file')
+    parser.add_argument('--output_file', type=str, default=None,
+                        help='Path of the exported artifact (defaults to next to the checkpoint)')
+    parser.add_argument('--atol', type=float, default=1e-3,
+                        help='Maximum absolute logit difference accepted against the eager model')
+    parser.add_argument('--seq_lengths', type=int, nargs='+', default=[48, 128, 256],
+                        help='Sequence lengths used for verification and benchmarking')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--n_runs', type=int, default=5)
+
+    args = parser.parse_args()
+    output_file = args.output_file or exported.exported_model_path(args.init_restore_dir, args.format)
+
+    bert_config = BertConfig.from_json_file(args.bert_config_file)
+    start_time = time.time()
+    model = BertForQuestionAnswering(bert_config)
+    utils.torch_init_model(model, args.init_restore_dir)
+    model.eval()
+    eager_load_time = time.time() - start_time
+
+    print(f'Exporting {args.format} model to {output_file}...')
+    exported.export_model(model, output_file, args.format, vocab_size=bert_config.vocab_size)
+
+    start_time = time.time()
+    exported_model = exported.load_exported_model(output_file, args.format)
+    exported_load_time = time.time() - start_time
+
+    report = {'format': args.format, 'artifact': output_file,
+              'eager_load_time': eager_load_time, 'exported_load_time': exported_load_time,
+              'lengths': []}
+    passed = True
+    for seq_length in args.seq_lengths:
+        inputs = exported.example_inputs(args.batch_size, seq_length, bert_config.vocab_size)
+        diff = max_logit_diff(model, exported_model, inputs)
+        passed = passed and diff <= args.atol
+        report['lengths'].append({
+            'seq_length': seq_length,
+            'max_abs_diff': diff,
+            'eager_ms_per_feature': measure_latency(model, inputs, args.n_runs),
+            'exported_ms_per_feature': measure_latency(exported_model, inputs, args.n_runs),
+        })
+    report['passed'] = passed
+
+    report_file = os.path.splitext(output_file)[0] + '.export_report.json'
+    with open(report_file, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if not passed:
+        raise SystemExit(f'Exported logits differ from the eager model by more than {args.atol}')
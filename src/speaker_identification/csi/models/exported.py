@@ -0,0 +1,128 @@
+"""Graph-optimized (TorchScript / ONNX) inference backends for the BERT QA model."""
+from __future__ import print_function
+
+import os
+import logging
+
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {'torchscript': '.ts', 'onnx': '.onnx'}
+INPUT_NAMES = ['input_ids', 'segment_ids', 'input_mask']
+OUTPUT_NAMES = ['start_logits', 'end_logits']
+
+
+def exported_model_path(init_checkpoint, export_format):
+    """Path of the exported artifact saved next to a checkpoint, e.g. csi-v1.ts or csi-v1.onnx."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unsupported export format: {}".format(export_format))
+    return os.path.splitext(init_checkpoint)[0] + EXPORT_FORMATS[export_format]
+
+
+def example_inputs(batch_size=2, seq_length=64, vocab_size=21128, device='cpu'):
+    """Dummy (input_ids, segment_ids, input_mask) used for tracing and verification."""
+    generator = torch.Generator().manual_seed(batch_size * 1000 + seq_length)
+    input_ids = torch.randint(1, vocab_size, (batch_size, seq_length), generator=generator)
+    segment_ids = torch.zeros_like(input_ids)
+    segment_ids[:, seq_length // 2:] = 1
+    input_mask = torch.ones_like(input_ids)
+    # the last row is padded so that masking is exercised as well
+    input_mask[-1, seq_length * 3 // 4:] = 0
+    return input_ids.to(device), segment_ids.to(device), input_mask.to(device)
+
+
+def export_torchscript(model, output_file, vocab_size=21128):
+    """Traces, freezes and optimizes the model into a TorchScript artifact.
+
+    Sizes are traced symbolically, so the artifact accepts any batch and sequence length.
+    """
+    model = model.cpu().eval()
+    inputs = example_inputs(vocab_size=vocab_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs, check_trace=False)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    torch.jit.save(frozen, output_file)
+    logger.info("Saved TorchScript model to %s", output_file)
+    return output_file
+
+
+def export_onnx(model, output_file, vocab_size=21128, opset_version=14):
+    """Exports the model to ONNX with dynamic batch and sequence axes."""
+    model = model.cpu().eval()
+    inputs = example_inputs(vocab_size=vocab_size)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in INPUT_NAMES + OUTPUT_NAMES}
+    with torch.no_grad():
+        torch.onnx.export(model, inputs, output_file,
+                          input_names=INPUT_NAMES,
+                          output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes,
+                          opset_version=opset_version,
+                          do_constant_folding=True)
+    logger.info("Saved ONNX model to %s", output_file)
+    return output_file
+
+
+def export_model(model, output_file, export_format, vocab_size=21128):
+    if export_format == 'torchscript':
+        return export_torchscript(model, output_file, vocab_size=vocab_size)
+    if export_format == 'onnx':
+        return export_onnx(model, output_file, vocab_size=vocab_size)
+    raise ValueError("Unsupported export format: {}".format(export_format))
+
+
+class TorchScriptQA(object):
+    """Runs a frozen TorchScript artifact with the BertForQuestionAnswering call signature."""
+
+    def __init__(self, model_file, device='cpu'):
+        self.module = torch.jit.load(model_file, map_location=device)
+        self.module.eval()
+
+    def eval(self):
+        return self
+
+    def parameters(self):
+        return self.module.parameters()
+
+    def __call__(self, input_ids, token_type_ids, attention_mask):
+        return self.module(input_ids, token_type_ids, attention_mask)
+
+
+class OnnxQA(object):
+    """Runs an ONNX artifact under onnxruntime with the BertForQuestionAnswering call signature."""
+
+    def __init__(self, model_file, num_threads=0):
+        if onnxruntime is None:
+            raise ImportError("The onnx backend requires onnxruntime, install it with `pip install onnxruntime`.")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+
+    def eval(self):
+        return self
+
+    def parameters(self):
+        return iter(())
+
+    def __call__(self, input_ids, token_type_ids, attention_mask):
+        feeds = {'input_ids': input_ids.cpu().numpy(),
+                 'segment_ids': token_type_ids.cpu().numpy(),
+                 'input_mask': attention_mask.cpu().numpy()}
+        start_logits, end_logits = self.session.run(OUTPUT_NAMES, feeds)
+        return torch.from_numpy(start_logits), torch.from_numpy(end_logits)
+
+
+def load_exported_model(model_file, export_format):
+    """Loads an exported artifact as a callable QA model (CPU only)."""
+    if export_format == 'torchscript':
+        return TorchScriptQA(model_file)
+    if export_format == 'onnx':
+        return OnnxQA(model_file)
+    raise ValueError("Unsupported export format: {}".format(export_format))
@@ -19,6 +19,7 @@ from __future__ import print_function
 import os
 import copy
 import json
+import collections
 import math
 import logging
 import tarfile
@@ -353,6 +354,11 @@ class BertSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # use torch's fused scaled-dot-product attention kernel instead of materialising
+        # the [batch, heads, seq, seq] score tensor
+        self.use_fused_attention = False
+        if 'use_fused_attention' in config.__dict__:
+            self.use_fused_attention = config.use_fused_attention
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -368,20 +374,28 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
+        if self.use_fused_attention:
+            # The additive padding mask [batch_size, 1, 1, seq_length] broadcasts over heads
+            # and query positions; the kernel applies the same 1/sqrt(head_size) scaling.
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask.to(dtype=query_layer.dtype),
+                dropout_p=self.dropout.p if self.training else 0.0)
+        else:
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            attention_scores = attention_scores + attention_mask
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+            # Normalize the attention scores to probabilities.
+            attention_probs = attention_scores.softmax(dim=-1)
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            attention_probs = self.dropout(attention_probs)
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+            context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
@@ -487,9 +501,10 @@ class BertEncoder(nn.Module):
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, num_layers=None):
+        # num_layers: only run the first num_layers layers (all of them if None)
         all_encoder_layers = []
-        for layer_module in self.layer:
+        for layer_module in (self.layer if num_layers is None else self.layer[:num_layers]):
             hidden_states = layer_module(hidden_states, attention_mask)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
@@ -741,7 +756,8 @@ class BertModel(PreTrainedBertModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                num_layers=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -766,7 +782,8 @@ class BertModel(PreTrainedBertModel):
         embedding_output = self.embeddings(input_ids, token_type_ids)
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+                                      output_all_encoded_layers=output_all_encoded_layers,
+                                      num_layers=num_layers)
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
@@ -1119,6 +1136,262 @@ class BertForQuestionAnswering(PreTrainedBertModel):
             return start_logits, end_logits
 
 
+class BertForQuestionAnsweringEarlyExit(BertForQuestionAnswering):
+    """BertForQuestionAnswering with span heads after intermediate encoder layers.
+
+    `config.exit_layers` lists the (1-based) encoder layers followed by an exit head,
+    an nn.Linear(hidden_size, 2) like qa_outputs; the last layer always exits through
+    qa_outputs. The heads are stored as `exit_outputs.<layer>`, so a checkpoint tells
+    which layers it has heads for, and a BertForQuestionAnswering checkpoint loads
+    unchanged with only the exit heads left to learn (run_si --exit_training).
+
+    Inputs:
+        `start_positions` / `end_positions`: if given, returns the mean span loss of
+            the exit heads.
+        `exit_layer`: if given, only the first `exit_layer` layers run and the span
+            logits come from the exit head of that layer.
+        `exit_threshold`: if given, every input stops at the first exit whose
+            confidence (max start probability * max end probability) reaches it, and
+            (start_logits, end_logits, layers) is returned, `layers` being a LongTensor
+            [batch_size] with the number of encoder layers run for each input.
+            Otherwise the output is the same as BertForQuestionAnswering.
+    """
+    def __init__(self, config):
+        super(BertForQuestionAnsweringEarlyExit, self).__init__(config)
+        exit_layers = sorted(set(config.exit_layers)) if 'exit_layers' in config.__dict__ else []
+        for layer in exit_layers:
+            if not 0 < layer < config.num_hidden_layers:
+                raise ValueError("Exit layers must be in [1, %d), got %d" % (config.num_hidden_layers, layer))
+        self.exit_layers = exit_layers
+        self.exit_outputs = nn.ModuleDict({str(layer): nn.Linear(config.hidden_size, 2) for layer in exit_layers})
+        self.exit_outputs.apply(self.init_bert_weights)
+
+    @staticmethod
+    def exit_layers_from_state_dict(state_dict):
+        """Encoder layers that have an exit head in a saved state dict."""
+        layers = set()
+        for key in state_dict:
+            parts = key.split('.')
+            if 'exit_outputs' in parts[:-2]:
+                layers.add(int(parts[parts.index('exit_outputs') + 1]))
+        return sorted(layers)
+
+    @staticmethod
+    def span_confidence(start_logits, end_logits, attention_mask):
+        """Max start probability * max end probability over the real tokens."""
+        padding = (1.0 - attention_mask.to(dtype=start_logits.dtype)) * -10000.0
+        start_probs = (start_logits + padding).softmax(dim=-1)
+        end_probs = (end_logits + padding).softmax(dim=-1)
+        return start_probs.max(dim=-1)[0] * end_probs.max(dim=-1)[0]
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, start_positions=None, end_positions=None,
+                exit_layer=None, exit_threshold=None):
+        if start_positions is not None and end_positions is not None:
+            return self._exit_loss(input_ids, token_type_ids, attention_mask, start_positions, end_positions)
+        if exit_layer is not None:
+            return self._exit_at(input_ids, token_type_ids, attention_mask, exit_layer)
+        if exit_threshold is None:
+            return super(BertForQuestionAnsweringEarlyExit, self).forward(input_ids, token_type_ids, attention_mask)
+        return self._early_exit(input_ids, token_type_ids, attention_mask, exit_threshold)
+
+    def _exit_at(self, input_ids, token_type_ids, attention_mask, exit_layer):
+        if str(exit_layer) not in self.exit_outputs:
+            raise ValueError("No exit head at layer %d, exit layers are %s" % (exit_layer, self.exit_layers))
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False,
+                                       num_layers=exit_layer)
+        start_logits, end_logits = self.exit_outputs[str(exit_layer)](sequence_output).split(1, dim=-1)
+        return start_logits.squeeze(-1), end_logits.squeeze(-1)
+
+    def _exit_loss(self, input_ids, token_type_ids, attention_mask, start_positions, end_positions):
+        if not self.exit_layers:
+            raise ValueError("No exit heads to train, set config.exit_layers to at least one layer in [1, %d)"
+                             % len(self.bert.encoder.layer))
+        encoded_layers, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=True,
+                                      num_layers=self.exit_layers[-1])
+        # If we are on multi-GPU, split add a dimension
+        if len(start_positions.size()) > 1:
+            start_positions = start_positions.squeeze(-1)
+        if len(end_positions.size()) > 1:
+            end_positions = end_positions.squeeze(-1)
+        # sometimes the start/end positions are outside our model inputs, we ignore these terms
+        ignored_index = input_ids.size(1)
+        start_positions = start_positions.clamp(0, ignored_index)
+        end_positions = end_positions.clamp(0, ignored_index)
+
+        loss_fct = CrossEntropyLoss(ignore_index=ignored_index)
+        total_loss = 0
+        for layer in self.exit_layers:
+            logits = self.exit_outputs[str(layer)](encoded_layers[layer - 1])
+            start_logits, end_logits = logits.split(1, dim=-1)
+            total_loss = total_loss + (loss_fct(start_logits.squeeze(-1), start_positions) +
+                                       loss_fct(end_logits.squeeze(-1), end_positions)) / 2
+        return total_loss / len(self.exit_layers)
+
+    def _early_exit(self, input_ids, token_type_ids, attention_mask, exit_threshold):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        # same additive mask as BertModel
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+
+        hidden_states = self.bert.embeddings(input_ids, token_type_ids)
+        start_output = hidden_states.new_zeros(input_ids.size())
+        end_output = hidden_states.new_zeros(input_ids.size())
+        layers_output = torch.full((input_ids.size(0),), len(self.bert.encoder.layer), dtype=torch.long,
+                                   device=input_ids.device)
+        # inputs that have not exited yet, as indices into the batch
+        active = torch.arange(input_ids.size(0), device=input_ids.device)
+        for layer, layer_module in enumerate(self.bert.encoder.layer, 1):
+            hidden_states = layer_module(hidden_states, extended_attention_mask)
+            last = layer == len(self.bert.encoder.layer)
+            if not last and str(layer) not in self.exit_outputs:
+                continue
+            head = self.qa_outputs if last else self.exit_outputs[str(layer)]
+            start_logits, end_logits = head(hidden_states).split(1, dim=-1)
+            start_logits = start_logits.squeeze(-1)
+            end_logits = end_logits.squeeze(-1)
+            if last:
+                done = torch.ones_like(active, dtype=torch.bool)
+            else:
+                done = self.span_confidence(start_logits, end_logits, attention_mask[active]) >= exit_threshold
+            exited = active[done]
+            start_output[exited] = start_logits[done].to(dtype=start_output.dtype)
+            end_output[exited] = end_logits[done].to(dtype=end_output.dtype)
+            layers_output[exited] = layer
+            if bool(done.all()):
+                break
+            # only the remaining inputs go through the next layers
+            keep = ~done
+            active = active[keep]
+            hidden_states = hidden_states[keep]
+            extended_attention_mask = extended_attention_mask[keep]
+        return start_output, end_output, layers_output
+
+
+class TruncatedQuestionAnswering(nn.Module):
+    """Runs only the first `num_layers` encoder layers of a BertForQuestionAnsweringEarlyExit.
+
+    The span logits come from the exit head trained for that layer, so their n-best
+    probabilities are a usable confidence. All weights are shared with the wrapped
+    model, so truncating adds nothing on top of it; the wrapped model is however a
+    separate checkpoint, and keeping it next to a full BertForQuestionAnswering costs
+    a second copy of the encoder unless its weights are memory-mapped, in which case
+    only the layers actually run are paged in. Inputs and outputs are the same as
+    BertForQuestionAnswering at inference.
+    """
+    def __init__(self, model, num_layers):
+        super(TruncatedQuestionAnswering, self).__init__()
+        if not isinstance(model, BertForQuestionAnsweringEarlyExit):
+            raise ValueError("Truncation needs a BertForQuestionAnsweringEarlyExit, got %s" % type(model).__name__)
+        if str(num_layers) not in model.exit_outputs:
+            raise ValueError("No exit head at layer %d, exit layers are %s" % (num_layers, model.exit_layers))
+        self.model = model
+        self.num_layers = num_layers
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
+        return self.model(input_ids, token_type_ids, attention_mask, exit_layer=self.num_layers)
+
+
+class EarlyExitQuestionAnswering(nn.Module):
+    """Runs a BertForQuestionAnsweringEarlyExit with a fixed exit threshold.
+
+    Inputs and outputs are the same as BertForQuestionAnswering at inference, so it
+    can be used wherever that model is. The number of inputs leaving at each layer
+    is accumulated over calls; create one per request to get per-request statistics.
+    """
+    def __init__(self, model, exit_threshold):
+        super(EarlyExitQuestionAnswering, self).__init__()
+        if not isinstance(model, BertForQuestionAnsweringEarlyExit):
+            raise ValueError("Early exit needs a BertForQuestionAnsweringEarlyExit, got %s" % type(model).__name__)
+        self.model = model
+        self.exit_threshold = exit_threshold
+        self.exit_counts = collections.Counter()
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
+        start_logits, end_logits, layers = self.model(input_ids, token_type_ids, attention_mask,
+                                                      exit_threshold=self.exit_threshold)
+        self.exit_counts.update(layers.tolist())
+        return start_logits, end_logits
+
+    def stats(self):
+        """Inputs that exited at each layer and the average number of layers run."""
+        total = sum(self.exit_counts.values())
+        return {
+            'threshold': self.exit_threshold,
+            'exit_layers': {str(layer): count for layer, count in sorted(self.exit_counts.items())},
+            'average_layers': sum(layer * count for layer, count in self.exit_counts.items()) / total
+            if total else None,
+            'num_layers': len(self.model.bert.encoder.layer),
+        }
+
+
+class BertForMultiQuoteQA(BertForQuestionAnswering):
+    """Answers several marked quotes of one context window in a single encoder pass.
+
+    Every quote in the window is preceded by a marker token. On top of the shared
+    start/end logits of BertForQuestionAnswering, each quote adds a bilinear term
+    between the hidden state of its marker and every token. The bilinear weights are
+    zero-initialized, so a BertForQuestionAnswering checkpoint loads unchanged and
+    only the marker head has to be learned.
+
+    Inputs:
+        `marker_positions`: LongTensor [batch_size, num_quotes] with the position of each
+            quote's marker, -1 for padding.
+        `start_positions` / `end_positions`: optional LongTensor [batch_size, num_quotes],
+            -1 for padding.
+    Outputs:
+        the loss if positions are given, otherwise start/end logits of shape
+        [batch_size, num_quotes, sequence_length].
+    """
+    def __init__(self, config):
+        super(BertForMultiQuoteQA, self).__init__(config)
+        self.quote_start = nn.Linear(config.hidden_size, config.hidden_size, bias=False)
+        self.quote_end = nn.Linear(config.hidden_size, config.hidden_size, bias=False)
+        nn.init.zeros_(self.quote_start.weight)
+        nn.init.zeros_(self.quote_end.weight)
+
+    def has_marker_head(self):
+        """Whether the marker head was trained.
+
+        A checkpoint without it (e.g. a plain BertForQuestionAnswering one) leaves the
+        zero init, and every quote of a window then gets the same answer.
+        """
+        return bool(self.quote_start.weight.any()) and bool(self.quote_end.weight.any())
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, marker_positions=None,
+                start_positions=None, end_positions=None):
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+        logits = self.qa_outputs(sequence_output)
+        start_logits, end_logits = logits.split(1, dim=-1)
+
+        quote_mask = marker_positions >= 0
+        index = marker_positions.clamp(min=0).unsqueeze(-1).expand(-1, -1, sequence_output.size(-1))
+        marker_output = sequence_output.gather(1, index)
+        # [batch, num_quotes, hidden] x [batch, hidden, seq] -> [batch, num_quotes, seq]
+        start_logits = start_logits.transpose(1, 2) + \
+            torch.matmul(self.quote_start(marker_output), sequence_output.transpose(1, 2))
+        end_logits = end_logits.transpose(1, 2) + \
+            torch.matmul(self.quote_end(marker_output), sequence_output.transpose(1, 2))
+
+        if start_positions is not None and end_positions is not None:
+            # padded quotes and out-of-range positions are ignored
+            ignored_index = start_logits.size(-1)
+            ignored = ~quote_mask | (start_positions < 0) | (end_positions < 0)
+            start_positions = start_positions.clamp(0, ignored_index).masked_fill(ignored, ignored_index)
+            end_positions = end_positions.clamp(0, ignored_index).masked_fill(ignored, ignored_index)
+
+            loss_fct = CrossEntropyLoss(ignore_index=ignored_index)
+            start_loss = loss_fct(start_logits.reshape(-1, ignored_index), start_positions.reshape(-1))
+            end_loss = loss_fct(end_logits.reshape(-1, ignored_index), end_positions.reshape(-1))
+            total_loss = (start_loss + end_loss) / 2
+            return total_loss
+        else:
+            return start_logits, end_logits
+
+
 class BertForQA_CLS(PreTrainedBertModel):
     def __init__(self, config):
         super(BertForQA_CLS, self).__init__(config)
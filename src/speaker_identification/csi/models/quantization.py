@@ -0,0 +1,90 @@
+"""Dynamic INT8 quantization of the BERT QA model for CPU inference."""
+from __future__ import print_function
+
+import os
+import logging
+
+import torch
+from torch import nn
+from torch.ao.nn.quantized import dynamic as nnqd
+
+from .pytorch_modeling import BertForQuestionAnswering
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_SUFFIX = '.int8'
+
+
+def quantized_checkpoint_path(init_checkpoint):
+    """Path of the quantized artifact saved next to a fp32 checkpoint, e.g. csi-v1.int8.pth."""
+    root, ext = os.path.splitext(init_checkpoint)
+    return root + QUANTIZED_SUFFIX + (ext or '.pth')
+
+
+def encoder_linear_names(model):
+    """Names of the nn.Linear modules inside the encoder layers.
+
+    These are the attention query/key/value/output projections and the intermediate
+    and output feed-forward blocks; embeddings, pooler and the qa_outputs head stay fp32.
+    """
+    return {name for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and 'encoder.layer' in name}
+
+
+def quantize_model(model):
+    """Returns a copy of `model` with INT8 dynamic-quantized encoder linear layers."""
+    model = model.cpu().eval()
+    return torch.quantization.quantize_dynamic(model, qconfig_spec=encoder_linear_names(model),
+                                               dtype=torch.qint8)
+
+
+def save_quantized_model(model, output_file):
+    torch.save(model.state_dict(), output_file)
+    logger.info("Saved quantized model to %s", output_file)
+
+
+def quantized_skeleton(bert_config, model_class=BertForQuestionAnswering):
+    """Builds the module tree of `quantize_model(model_class(bert_config))` without fp32 weights.
+
+    The model is created on the meta device and its encoder linear layers are replaced
+    by empty dynamic-quantized ones, so the only memory allocated is the INT8 weights.
+    Everything outside the encoder linears stays on the meta device until a state dict
+    is assigned to it.
+    """
+    with torch.device('meta'):
+        model = model_class(bert_config)
+    for name in encoder_linear_names(model):
+        parent_name, _, child_name = name.rpartition('.')
+        parent = model.get_submodule(parent_name)
+        linear = getattr(parent, child_name)
+        setattr(parent, child_name, nnqd.Linear(linear.in_features, linear.out_features,
+                                                bias_=linear.bias is not None, dtype=torch.qint8))
+    return model
+
+
+def load_quantized_model(bert_config, quantized_file, model_class=BertForQuestionAnswering):
+    """Builds the quantized module tree and loads a saved INT8 state dict into it.
+
+    Loading never touches the fp32 checkpoint and never builds a fp32 model: the saved
+    tensors are assigned to a quantized skeleton, so peak memory is about the size of
+    the (about 4x smaller) quantized artifact.
+    """
+    model = quantized_skeleton(bert_config, model_class)
+    state_dict = torch.load(quantized_file, map_location='cpu')
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    return model
+
+
+def model_size_mb(model):
+    """Size of a model's serialized state dict in MB."""
+    total = 0
+    for value in model.state_dict().values():
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            # packed params of dynamic-quantized linear layers: (weight, bias)
+            for item in value:
+                if isinstance(item, torch.Tensor):
+                    total += item.numel() * item.element_size()
+    return total / (1024 * 1024)
@@ -1,7 +1,10 @@
 import json
 from tqdm import tqdm
 import collections
+import functools
+import multiprocessing
 import src.speaker_identification.csi.tokenizations.official_tokenization as tokenization
+from src.speaker_identification.csi.tokenizations import char_table
 import os
 import numpy as np
 from src.speaker_identification.csi.preprocess.prepro_utils import *
@@ -84,73 +87,92 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
     return cur_span_index == best_span_index
 
 
-def json2features(input_file, output_files, tokenizer, is_training=False, repeat_limit=3, max_query_length=64,
-                  max_seq_length=512, doc_stride=128):
-    with open(input_file, 'r', encoding='utf8') as f:
-        train_data = json.load(f)
-        train_data = train_data['data']
-
-    def _is_chinese_char(cp):
-        if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-                (cp >= 0x3400 and cp <= 0x4DBF) or  #
-                (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-                (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-                (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-                (cp >= 0x2B820 and cp <= 0x2CEAF) or
-                (cp >= 0xF900 and cp <= 0xFAFF) or  #
-                (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-            return True
-
-        return False
-
-    def is_fuhao(c):
-        if c == '。' or c == '，' or c == '！' or c == '？' or c == '；' or c == '、' or c == '：' or c == '（' or c == '）' \
-                or c == '－' or c == '~' or c == '「' or c == '《' or c == '》' or c == ',' or c == '」' or c == '"' or c == '“' or c == '”' \
-                or c == '$' or c == '『' or c == '』' or c == '—' or c == ';' or c == '。' or c == '(' or c == ')' or c == '-' or c == '～' or c == '。' \
-                or c == '‘' or c == '’':
-            return True
-        return False
-
-    def _tokenize_chinese_chars(text):
-        """Adds whitespace around any CJK character."""
-        output = []
-        for char in text:
-            cp = ord(char)
-            if _is_chinese_char(cp) or is_fuhao(char):
-                if len(output) > 0 and output[-1] != SPIECE_UNDERLINE:
-                    output.append(SPIECE_UNDERLINE)
-                output.append(char)
+def _max_context_owners(doc_spans, num_tokens):
+    """Index of the 'max context' doc span of every doc token, in one vectorised pass.
+
+    Same scoring and tie-breaking (first best span wins) as _check_is_max_context,
+    computed once per example instead of rescanning all spans for every token.
+    """
+    starts = np.array([doc_span.start for doc_span in doc_spans], dtype=np.int64)[:, None]
+    lengths = np.array([doc_span.length for doc_span in doc_spans], dtype=np.int64)[:, None]
+    ends = starts + lengths - 1
+    positions = np.arange(num_tokens, dtype=np.int64)[None, :]
+    scores = np.minimum(positions - starts, ends - positions) + 0.01 * lengths
+    scores[(positions < starts) | (positions > ends)] = -np.inf
+    return scores.argmax(axis=0)
+
+
+def _is_chinese_char(cp):
+    return bool(char_table.code_flags(cp) & char_table.CHINESE)
+
+
+def is_fuhao(c):
+    return bool(char_table.char_flags(c) & char_table.FUHAO)
+
+
+def _tokenize_chinese_chars(text):
+    """Adds whitespace around any CJK character."""
+    output = []
+    for char in text:
+        if char_table.char_flags(char) & (char_table.CHINESE | char_table.FUHAO):
+            if len(output) > 0 and output[-1] != SPIECE_UNDERLINE:
                 output.append(SPIECE_UNDERLINE)
+            output.append(char)
+            output.append(SPIECE_UNDERLINE)
+        else:
+            output.append(char)
+    return "".join(output)
+
+
+def is_whitespace(c):
+    return bool(char_table.char_flags(c) & char_table.DOC_WHITESPACE)
+
+
+def is_split_char(c):
+    """True if `c` never joins its neighbours into one doc token (see split_doc_tokens)."""
+    return bool(char_table.char_flags(c) & (char_table.DOC_WHITESPACE | char_table.CHINESE | char_table.FUHAO))
+
+
+def split_doc_tokens(context):
+    """Splits a context into doc tokens (CJK chars and punctuation on their own).
+
+    Returns (doc_tokens, char_to_word_offset), the latter mapping every char of the
+    context to the index of the doc token it belongs to. Same result as splitting
+    _tokenize_chinese_chars(context) on whitespace, in one pass over the context;
+    literal SPIECE_UNDERLINE chars are separators without an offset entry.
+    """
+    doc_tokens = []
+    char_to_word_offset = []
+    prev_is_whitespace = True
+    for c in context:
+        flags = char_table.char_flags(c)
+        if flags & (char_table.CHINESE | char_table.FUHAO):
+            doc_tokens.append(c)
+            prev_is_whitespace = True
+        elif flags & char_table.DOC_WHITESPACE:
+            prev_is_whitespace = True
+            if c == SPIECE_UNDERLINE:
+                continue
+        else:
+            if prev_is_whitespace:
+                doc_tokens.append(c)
             else:
-                output.append(char)
-        return "".join(output)
+                doc_tokens[-1] += c
+            prev_is_whitespace = False
+        char_to_word_offset.append(len(doc_tokens) - 1)
+    return doc_tokens, char_to_word_offset
 
-    def is_whitespace(c):
-        if c == " " or c == "\t" or c == "\r" or c == "\n" or ord(c) == 0x202F or c == SPIECE_UNDERLINE:
-            return True
-        return False
 
-    # to examples
-    examples = []
-    mis_match = 0
-    for article in tqdm(train_data):
+def iter_examples(train_data, is_training=False, repeat_limit=3, stats=None):
+    """Lazily yields the examples of the paragraphs in `train_data` (the dataset's 'data' list).
+
+    If `stats` is a dict, the number of answers that do not match their context is
+    counted in stats['mis_match'].
+    """
+    for article in train_data:
         for para in article['paragraphs']:
             context = para['context']
-            context_chs = _tokenize_chinese_chars(context)
-            doc_tokens = []
-            char_to_word_offset = []
-            prev_is_whitespace = True
-            for c in context_chs:
-                if is_whitespace(c):
-                    prev_is_whitespace = True
-                else:
-                    if prev_is_whitespace:
-                        doc_tokens.append(c)
-                    else:
-                        doc_tokens[-1] += c
-                    prev_is_whitespace = False
-                if c != SPIECE_UNDERLINE:
-                    char_to_word_offset.append(len(doc_tokens) - 1)
+            doc_tokens, char_to_word_offset = split_doc_tokens(context)
 
             for qas in para['qas']:
                 qid = qas['id']
@@ -184,147 +206,254 @@ def json2features(input_file, output_files, tokenizer, is_training=False, repeat
 
                     if actual_text != cleaned_answer_text:
                         #print(actual_text, 'V.S', cleaned_answer_text)
-                        mis_match += 1
+                        if stats is not None:
+                            stats['mis_match'] = stats.get('mis_match', 0) + 1
                         # ipdb.set_trace()
 
-                examples.append({'doc_tokens': doc_tokens,
-                                 'orig_answer_text': ans_text,
-                                 'qid': qid,
-                                 'question': ques_text,
-                                 'answer': ans_text,
-                                 'start_position': start_position_final,
-                                 'end_position': end_position_final})
+                yield {'doc_tokens': doc_tokens,
+                       'orig_answer_text': ans_text,
+                       'qid': qid,
+                       'question': ques_text,
+                       'answer': ans_text,
+                       'start_position': start_position_final,
+                       'end_position': end_position_final}
+
+
+def convert_example_to_features(example_index, example, tokenizer, is_training=False, max_query_length=64,
+                                max_seq_length=512, doc_stride=128, doc_sub_tokens=None):
+    """Tokenizes one example into its doc-span features (without unique_id).
+
+    `doc_sub_tokens` optionally holds the already known wordpieces of every doc token
+    (e.g. from a SentenceTokenCache), which are then not tokenized again.
+    """
+    features = []
+    query_tokens = tokenizer.tokenize(example['question'])
+    if len(query_tokens) > max_query_length:
+        query_tokens = query_tokens[0:max_query_length]
+
+    tok_to_orig_index = []
+    orig_to_tok_index = []
+    all_doc_tokens = []
+    for (i, token) in enumerate(example['doc_tokens']):
+        orig_to_tok_index.append(len(all_doc_tokens))
+        sub_tokens = tokenizer.tokenize(token) if doc_sub_tokens is None else doc_sub_tokens[i]
+        for sub_token in sub_tokens:
+            tok_to_orig_index.append(i)
+            all_doc_tokens.append(sub_token)
+
+    tok_start_position = None
+    tok_end_position = None
+    if is_training:
+        if example['start_position'] < len(example['doc_tokens']) - 1:
+            tok_start_position = orig_to_tok_index[example['start_position']]  # 原来token到新token的映射，这是新token的起点
+        else:
+            tok_start_position = len(all_doc_tokens) - 1
+        if example['end_position'] < len(example['doc_tokens']) - 1:
+            tok_end_position = orig_to_tok_index[example['end_position'] + 1] - 1
+        else:
+            tok_end_position = len(all_doc_tokens) - 1
+        (tok_start_position, tok_end_position) = _improve_answer_span(
+            all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
+            example['orig_answer_text'])
+
+    # The -3 accounts for [CLS], [SEP] and [SEP]
+    max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
+
+    doc_spans = []
+    _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
+    start_offset = 0
+    while start_offset < len(all_doc_tokens):
+        length = len(all_doc_tokens) - start_offset
+        if length > max_tokens_for_doc:
+            length = max_tokens_for_doc
+        doc_spans.append(_DocSpan(start=start_offset, length=length))
+        if start_offset + length == len(all_doc_tokens):
+            break
+        start_offset += min(length, doc_stride)
+
+    if doc_spans:
+        max_context_owners = _max_context_owners(doc_spans, len(all_doc_tokens))
+
+    for (doc_span_index, doc_span) in enumerate(doc_spans):
+        tokens = []
+        token_to_orig_map = {}
+        segment_ids = []
+        tokens.append("[CLS]")
+        segment_ids.append(0)
+        for token in query_tokens:
+            tokens.append(token)
+            segment_ids.append(0)
+        tokens.append("[SEP]")
+        segment_ids.append(0)
+
+        # 0/1 per token position instead of a dict keyed by position
+        doc_offset = len(tokens)
+        token_is_max_context = [0] * doc_offset
+        span_owners = max_context_owners[doc_span.start:doc_span.start + doc_span.length]
+        token_is_max_context.extend((span_owners == doc_span_index).astype(np.int8).tolist())
+        for i in range(doc_span.length):
+            split_token_index = doc_span.start + i
+            token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
+            tokens.append(all_doc_tokens[split_token_index])
+            segment_ids.append(1)
+        tokens.append("[SEP]")
+        segment_ids.append(1)
+        token_is_max_context.append(0)
+
+        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+
+        # The mask has 1 for real tokens and 0 for padding tokens. Only real
+        # tokens are stored; batches are padded to their longest member at
+        # collate time (see preprocess.utils.collate_features).
+        input_mask = [1] * len(input_ids)
+
+        assert len(input_ids) <= max_seq_length
+        assert len(segment_ids) == len(input_ids)
+
+        start_position = None
+        end_position = None
+        if is_training:
+            # For training, if our document chunk does not contain an annotation
+            # we throw it out, since there is nothing to predict.
+            if tok_start_position == -1 and tok_end_position == -1:
+                start_position = 0  # 问题本来没答案，0是[CLS]的位子
+                end_position = 0
+            else:  # 如果原本是有答案的，那么去除没有答案的feature
+                out_of_span = False
+                doc_start = doc_span.start  # 映射回原文的起点和终点
+                doc_end = doc_span.start + doc_span.length - 1
+
+                if not (tok_start_position >= doc_start and tok_end_position <= doc_end):  # 该划窗没答案作为无答案增强
+                    out_of_span = True
+                if out_of_span:
+                    start_position = 0
+                    end_position = 0
+                else:
+                    doc_offset = len(query_tokens) + 2
+                    start_position = tok_start_position - doc_start + doc_offset
+                    end_position = tok_end_position - doc_start + doc_offset
+
+        features.append({'example_index': example_index,
+                         'doc_span_index': doc_span_index,
+                         'tokens': tokens,
+                         'token_to_orig_map': token_to_orig_map,
+                         'token_is_max_context': token_is_max_context,
+                         'input_ids': input_ids,
+                         'input_mask': input_mask,
+                         'segment_ids': segment_ids,
+                         'start_position': start_position,
+                         'end_position': end_position})
+    return features
+
+
+_worker_tokenizer = None
+_worker_convert = None
+
+
+def _init_feature_worker(tokenizer, convert):
+    global _worker_tokenizer, _worker_convert
+    _worker_tokenizer = tokenizer
+    _worker_convert = convert
+
+
+def _tokenize_in_worker(text):
+    return _worker_tokenizer.tokenize(text)
+
+
+def _check_worker_tokenizer(pool, tokenizer, examples):
+    """Makes sure the tokenizer copied into the workers tokenizes like the parent's.
+
+    With the spawn start method (Windows/macOS) the tokenizer is pickled, and a copy
+    that lost its vocabulary lookups would silently turn every feature into [UNK].
+    """
+    probe = "".join(examples[0]['doc_tokens'])[:128] + examples[0]['question']
+    expected = tokenizer.tokenize(probe)
+    if pool.apply(_tokenize_in_worker, (probe,)) != expected:
+        raise RuntimeError("The tokenizer sent to the preprocessing workers does not tokenize like the original")
+
+
+def _convert_example_in_worker(indexed_example):
+    example_index, example = indexed_example
+    return _worker_convert(example_index, example, _worker_tokenizer)
+
+
+def _load_dataset(input_file):
+    if isinstance(input_file, dict):
+        return input_file['data']
+    with open(input_file, 'r', encoding='utf8') as f:
+        return json.load(f)['data']
+
+
+def json2features(input_file, output_files, tokenizer, is_training=False, repeat_limit=3, max_query_length=64,
+                  max_seq_length=512, doc_stride=128, num_workers=1, chunk_size=64):
+    """Converts a CMRC-style dataset into examples and model features.
+
+    `input_file` is either the path of the dataset json or the already loaded dataset
+    dict. `output_files` is an [examples_file, features_file] pair, or None to keep
+    everything in memory. With num_workers > 1 the examples are tokenized in a process
+    pool, `chunk_size` examples at a time. Returns (examples, features).
+    """
+    train_data = _load_dataset(input_file)
+
+    # to examples
+    stats = {'mis_match': 0}
+    examples = list(iter_examples(tqdm(train_data), is_training=is_training, repeat_limit=repeat_limit, stats=stats))
+    mis_match = stats['mis_match']
 
     print('examples num:', len(examples))
     print('mis_match:', mis_match)
     # os.makedirs('/'.join(output_files[0].split('/')[0:-1]), exist_ok=True)
-    json.dump(examples, open(output_files[0], 'w'))
+    if output_files is not None:
+        json.dump(examples, open(output_files[0], 'w'))
 
     # to features
+    convert = functools.partial(convert_example_to_features, is_training=is_training,
+                                max_query_length=max_query_length, max_seq_length=max_seq_length,
+                                doc_stride=doc_stride)
+    if num_workers > 1 and len(examples) > chunk_size:
+        # 按chunk_size分片交给进程池，每个子进程在初始化时拿到同一个分词器
+        with multiprocessing.Pool(num_workers, initializer=_init_feature_worker,
+                                  initargs=(tokenizer, convert)) as pool:
+            _check_worker_tokenizer(pool, tokenizer, examples)
+            example_features = list(tqdm(pool.imap(_convert_example_in_worker, enumerate(examples),
+                                                   chunksize=chunk_size),
+                                         total=len(examples)))
+    else:
+        example_features = [convert(example_index, example, tokenizer)
+                            for (example_index, example) in enumerate(tqdm(examples))]
+
+    # 合并后按顺序编号，保证和单进程结果一致
     features = []
     unique_id = 1000000000
-    for (example_index, example) in enumerate(tqdm(examples)):
-        query_tokens = tokenizer.tokenize(example['question'])
-        if len(query_tokens) > max_query_length:
-            query_tokens = query_tokens[0:max_query_length]
-
-        tok_to_orig_index = []
-        orig_to_tok_index = []
-        all_doc_tokens = []
-        for (i, token) in enumerate(example['doc_tokens']):
-            orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)
-            for sub_token in sub_tokens:
-                tok_to_orig_index.append(i)
-                all_doc_tokens.append(sub_token)
-
-        tok_start_position = None
-        tok_end_position = None
-        if is_training:
-            if example['start_position'] < len(example['doc_tokens']) - 1:
-                tok_start_position = orig_to_tok_index[example['start_position']]  # 原来token到新token的映射，这是新token的起点
-            else:
-                tok_start_position = len(all_doc_tokens) - 1
-            if example['end_position'] < len(example['doc_tokens']) - 1:
-                tok_end_position = orig_to_tok_index[example['end_position'] + 1] - 1
-            else:
-                tok_end_position = len(all_doc_tokens) - 1
-            (tok_start_position, tok_end_position) = _improve_answer_span(
-                all_doc_tokens, tok_start_position, tok_end_position, tokenizer,
-                example['orig_answer_text'])
-
-        # The -3 accounts for [CLS], [SEP] and [SEP]
-        max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
-
-        doc_spans = []
-        _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
-        start_offset = 0
-        while start_offset < len(all_doc_tokens):
-            length = len(all_doc_tokens) - start_offset
-            if length > max_tokens_for_doc:
-                length = max_tokens_for_doc
-            doc_spans.append(_DocSpan(start=start_offset, length=length))
-            if start_offset + length == len(all_doc_tokens):
-                break
-            start_offset += min(length, doc_stride)
-
-        for (doc_span_index, doc_span) in enumerate(doc_spans):
-            tokens = []
-            token_to_orig_map = {}
-            token_is_max_context = {}
-            segment_ids = []
-            tokens.append("[CLS]")
-            segment_ids.append(0)
-            for token in query_tokens:
-                tokens.append(token)
-                segment_ids.append(0)
-            tokens.append("[SEP]")
-            segment_ids.append(0)
+    for feature_list in example_features:
+        for feature in feature_list:
+            features.append(dict(unique_id=unique_id, **feature))
+            unique_id += 1
 
-            for i in range(doc_span.length):
-                split_token_index = doc_span.start + i
-                token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-                is_max_context = _check_is_max_context(doc_spans, doc_span_index, split_token_index)
-                token_is_max_context[len(tokens)] = is_max_context
-                tokens.append(all_doc_tokens[split_token_index])
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
+    print('features num:', len(features))
+    if output_files is not None:
+        json.dump(features, open(output_files[1], 'w'))
+    return examples, features
 
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            while len(input_ids) < max_seq_length:
-                input_ids.append(0)
-                input_mask.append(0)
-                segment_ids.append(0)
-
-            assert len(input_ids) == max_seq_length
-            assert len(input_mask) == max_seq_length
-            assert len(segment_ids) == max_seq_length
-
-            start_position = None
-            end_position = None
-            if is_training:
-                # For training, if our document chunk does not contain an annotation
-                # we throw it out, since there is nothing to predict.
-                if tok_start_position == -1 and tok_end_position == -1:
-                    start_position = 0  # 问题本来没答案，0是[CLS]的位子
-                    end_position = 0
-                else:  # 如果原本是有答案的，那么去除没有答案的feature
-                    out_of_span = False
-                    doc_start = doc_span.start  # 映射回原文的起点和终点
-                    doc_end = doc_span.start + doc_span.length - 1
 
-                    if not (tok_start_position >= doc_start and tok_end_position <= doc_end):  # 该划窗没答案作为无答案增强
-                        out_of_span = True
-                    if out_of_span:
-                        start_position = 0
-                        end_position = 0
-                    else:
-                        doc_offset = len(query_tokens) + 2
-                        start_position = tok_start_position - doc_start + doc_offset
-                        end_position = tok_end_position - doc_start + doc_offset
+def iter_features(input_file, tokenizer, is_training=False, repeat_limit=3, max_query_length=64,
+                  max_seq_length=512, doc_stride=128):
+    """Streaming form of json2features.
 
-            features.append({'unique_id': unique_id,
-                             'example_index': example_index,
-                             'doc_span_index': doc_span_index,
-                             'tokens': tokens,
-                             'token_to_orig_map': token_to_orig_map,
-                             'token_is_max_context': token_is_max_context,
-                             'input_ids': input_ids,
-                             'input_mask': input_mask,
-                             'segment_ids': segment_ids,
-                             'start_position': start_position,
-                             'end_position': end_position})
+    Lazily yields (example_index, example, features) one example at a time, so that
+    inference can start on the first features while the rest are still being built.
+    unique_id numbering is the same as in json2features.
+    """
+    unique_id = 1000000000
+    examples = iter_examples(_load_dataset(input_file), is_training=is_training, repeat_limit=repeat_limit)
+    for (example_index, example) in enumerate(examples):
+        features = []
+        for feature in convert_example_to_features(example_index, example, tokenizer, is_training=is_training,
+                                                   max_query_length=max_query_length,
+                                                   max_seq_length=max_seq_length, doc_stride=doc_stride):
+            features.append(dict(unique_id=unique_id, **feature))
             unique_id += 1
-
-    print('features num:', len(features))
-    json.dump(features, open(output_files[1], 'w'))
+        yield example_index, example, features
 
 
 def _convert_index(index, pos, M=None, is_start=True):
@@ -0,0 +1,186 @@
+"""Columnar, memory-mappable storage for CMRC-style features.
+
+A FeatureStore keeps all features of a dataset in a handful of contiguous arrays
+instead of one dict (with str tokens and dict maps) per feature:
+
+    input_ids      int32  all tokens of all features, back to back
+    segment_ids    int8   same layout as input_ids
+    token_codes    int32  index of every token string in `token_table`
+    token_to_orig  int32  original doc token index, -1 for query/special tokens
+    max_context    uint8  bitset, bit set when the token is in its max-context span
+    offsets        int64  feature i covers [offsets[i], offsets[i + 1])
+
+plus per-feature unique_id / example_index / doc_span_index / start/end_position
+(-1 for None). `save` writes one .npy file per array and a meta.json with the token
+table, `load` memory-maps the arrays back without building any Python objects.
+"""
+from __future__ import print_function
+
+import os
+import json
+
+import numpy as np
+import torch
+
+TOKEN_ARRAYS = ('input_ids', 'segment_ids', 'token_codes', 'token_to_orig')
+FEATURE_ARRAYS = ('offsets', 'unique_id', 'example_index', 'doc_span_index', 'start_position', 'end_position')
+
+
+def max_context_items(token_is_max_context):
+    """(position, is_max_context) pairs of a feature's token_is_max_context.
+
+    Handles both the 0/1 list written by json2features and the legacy dict keyed by
+    position (int keys in memory, str keys once loaded from json).
+    """
+    if isinstance(token_is_max_context, dict):
+        return [(int(key), value) for key, value in token_is_max_context.items()]
+    return list(enumerate(token_is_max_context))
+
+
+class FeatureStore(object):
+    def __init__(self, arrays, token_table):
+        self.arrays = arrays
+        self.token_table = token_table
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @classmethod
+    def from_features(cls, features):
+        """Builds a store from the list of feature dicts produced by json2features."""
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        for i, feature in enumerate(features):
+            offsets[i + 1] = offsets[i] + sum(feature['input_mask'])
+        n_tokens = int(offsets[-1])
+
+        input_ids = np.empty(n_tokens, dtype=np.int32)
+        segment_ids = np.empty(n_tokens, dtype=np.int8)
+        token_codes = np.empty(n_tokens, dtype=np.int32)
+        token_to_orig = np.full(n_tokens, -1, dtype=np.int32)
+        max_context = np.zeros(n_tokens, dtype=bool)
+
+        token_table = []
+        token_index = {}
+        for i, feature in enumerate(features):
+            start, end = offsets[i], offsets[i + 1]
+            length = end - start
+            input_ids[start:end] = feature['input_ids'][:length]
+            segment_ids[start:end] = feature['segment_ids'][:length]
+            for j, token in enumerate(feature['tokens'][:length]):
+                code = token_index.get(token)
+                if code is None:
+                    code = token_index[token] = len(token_table)
+                    token_table.append(token)
+                token_codes[start + j] = code
+            for key, orig_index in feature['token_to_orig_map'].items():
+                token_to_orig[start + int(key)] = orig_index
+            for position, is_max_context in max_context_items(feature['token_is_max_context']):
+                max_context[start + position] = bool(is_max_context)
+
+        def optional_int(name):
+            return np.array([-1 if f.get(name) is None else f[name] for f in features], dtype=np.int64)
+
+        arrays = {
+            'input_ids': input_ids,
+            'segment_ids': segment_ids,
+            'token_codes': token_codes,
+            'token_to_orig': token_to_orig,
+            'max_context': np.packbits(max_context),
+            'offsets': offsets,
+            'unique_id': np.array([f['unique_id'] for f in features], dtype=np.int64),
+            'example_index': np.array([f['example_index'] for f in features], dtype=np.int64),
+            'doc_span_index': np.array([f['doc_span_index'] for f in features], dtype=np.int64),
+            'start_position': optional_int('start_position'),
+            'end_position': optional_int('end_position'),
+        }
+        return cls(arrays, token_table)
+
+    def save(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(store_dir, name + '.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(store_dir, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump({'num_features': len(self), 'num_tokens': self.num_tokens,
+                       'token_table': self.token_table}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        """Opens a saved store; the arrays are memory-mapped unless mmap_mode is None."""
+        with open(os.path.join(store_dir, 'meta.json'), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in TOKEN_ARRAYS + FEATURE_ARRAYS + ('max_context',):
+            arrays[name] = np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode)
+        return cls(arrays, meta['token_table'])
+
+    @staticmethod
+    def is_store(path):
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_tokens(self):
+        return int(self.offsets[-1])
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def length(self, i):
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def _span(self, i):
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def feature_input_ids(self, i):
+        start, end = self._span(i)
+        return self.input_ids[start:end]
+
+    def feature_segment_ids(self, i):
+        start, end = self._span(i)
+        return self.segment_ids[start:end]
+
+    def feature_token_to_orig(self, i):
+        """Original doc token index of every token in feature i (-1 where unmapped)."""
+        start, end = self._span(i)
+        return self.token_to_orig[start:end]
+
+    def feature_max_context(self, i):
+        """Boolean max-context flag of every token in feature i."""
+        start, end = self._span(i)
+        byte_start = start // 8
+        bits = np.unpackbits(self.max_context[byte_start:(end + 7) // 8])
+        offset = start - byte_start * 8
+        return bits[offset:offset + end - start].astype(bool)
+
+    def feature_tokens(self, i, start_index=0, end_index=None):
+        """Token strings of feature i in [start_index, end_index)."""
+        start, end = self._span(i)
+        if end_index is None:
+            end_index = end - start
+        codes = self.token_codes[start + start_index:start + end_index]
+        return [self.token_table[code] for code in codes]
+
+    def collate(self, indices, with_positions=False):
+        """Pads the given features to the longest of them, like utils.collate_features."""
+        lengths = [self.length(i) for i in indices]
+        max_len = max(lengths)
+        input_ids = torch.zeros((len(indices), max_len), dtype=torch.long)
+        input_mask = torch.zeros((len(indices), max_len), dtype=torch.long)
+        segment_ids = torch.zeros((len(indices), max_len), dtype=torch.long)
+        for row, (i, length) in enumerate(zip(indices, lengths)):
+            input_ids[row, :length] = torch.from_numpy(self.feature_input_ids(i).astype(np.int64))
+            input_mask[row, :length] = 1
+            segment_ids[row, :length] = torch.from_numpy(self.feature_segment_ids(i).astype(np.int64))
+        if not with_positions:
+            return input_ids, input_mask, segment_ids
+        start_positions = torch.from_numpy(self.start_position[list(indices)].astype(np.int64))
+        end_positions = torch.from_numpy(self.end_position[list(indices)].astype(np.int64))
+        return input_ids, input_mask, segment_ids, start_positions, end_positions
+
+
+def as_feature_store(features):
+    """Returns `features` as a FeatureStore, converting a list of feature dicts if needed."""
+    if isinstance(features, FeatureStore):
+        return features
+    return FeatureStore.from_features(features)
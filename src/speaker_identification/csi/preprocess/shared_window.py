@@ -0,0 +1,262 @@
+"""Shared-window multi-quote inference.
+
+Adjacent quotes share most of their context, so instead of one feature per quote a
+window of sentences is encoded once with a marker token in front of every quote to
+identify, under a generic question. BertForMultiQuoteQA then reads one answer span
+per marker from that single encoder pass.
+"""
+import json
+import collections
+
+import torch
+
+from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import split_doc_tokens
+from src.speaker_identification.csi.preprocess import utils
+from src.speaker_identification.csi.evaluate.cmrc2018_output import write_predictions
+from src.speaker_identification.preprocess.text_preprocess import TextPreprocessor
+
+# an unused vocab entry, added as a token (not as text) so the basic tokenizer cannot split it
+MARKER_TOKEN = '[unused1]'
+QUESTION = '标记的引文是谁说的？'
+
+RawResult = collections.namedtuple("RawResult", ["unique_id", "start_logits", "end_logits"])
+
+
+def build_marker_feature(context, quote_starts, tokenizer, qids=None, question=QUESTION, max_query_length=64,
+                         answers=None):
+    """Builds one feature for a context with several marked quotes.
+
+    Args:
+        context: window text, every marked quote must start a new doc token (see
+            TextPreprocessor.get_shared_context)
+        quote_starts: char offset of every marked quote in `context`, ascending
+        qids: id of every marked quote
+        answers: optional (answer_start, answer_text) per quote, for training
+    """
+    doc_tokens, char_to_word_offset = split_doc_tokens(context)
+    quote_doc_starts = set(char_to_word_offset[start] for start in quote_starts)
+
+    query_tokens = tokenizer.tokenize(question)[:max_query_length]
+    tokens = ["[CLS]"] + query_tokens + ["[SEP]"]
+    segment_ids = [0] * len(tokens)
+    token_to_orig_map = {}
+    marker_positions = []
+    orig_to_tok_start = []
+    orig_to_tok_end = []
+    for (i, doc_token) in enumerate(doc_tokens):
+        if i in quote_doc_starts:
+            marker_positions.append(len(tokens))
+            tokens.append(MARKER_TOKEN)
+            segment_ids.append(1)
+        orig_to_tok_start.append(len(tokens))
+        for sub_token in tokenizer.tokenize(doc_token):
+            token_to_orig_map[len(tokens)] = i
+            tokens.append(sub_token)
+            segment_ids.append(1)
+        orig_to_tok_end.append(len(tokens) - 1)
+    tokens.append("[SEP]")
+    segment_ids.append(1)
+    assert len(marker_positions) == len(quote_starts)
+
+    input_ids = tokenizer.convert_tokens_to_ids(tokens)
+    feature = {'qids': list(qids) if qids is not None else [None] * len(quote_starts),
+               'doc_tokens': doc_tokens,
+               'tokens': tokens,
+               'token_to_orig_map': token_to_orig_map,
+               # one doc span per window, so every doc token is in its max context
+               'token_is_max_context': [1 if i in token_to_orig_map else 0 for i in range(len(tokens))],
+               'input_ids': input_ids,
+               'input_mask': [1] * len(input_ids),
+               'segment_ids': segment_ids,
+               'marker_positions': marker_positions}
+    if answers is not None:
+        feature['start_positions'] = []
+        feature['end_positions'] = []
+        for answer_start, answer_text in answers:
+            start_doc = char_to_word_offset[answer_start]
+            end_doc = char_to_word_offset[answer_start + len(answer_text) - 1]
+            feature['start_positions'].append(orig_to_tok_start[start_doc])
+            feature['end_positions'].append(orig_to_tok_end[end_doc])
+    return feature
+
+
+def collate_marker_features(features, with_positions=False):
+    """Pads a batch of marker features; missing quotes/positions are padded with -1."""
+    input_ids, input_mask, segment_ids = utils.collate_features(features)
+    max_quotes = max(len(f['marker_positions']) for f in features)
+
+    def pad_quotes(key):
+        padded = torch.full((len(features), max_quotes), -1, dtype=torch.long)
+        for i, f in enumerate(features):
+            padded[i, :len(f[key])] = torch.tensor(f[key], dtype=torch.long)
+        return padded
+
+    if not with_positions:
+        return input_ids, input_mask, segment_ids, pad_quotes('marker_positions')
+    return (input_ids, input_mask, segment_ids, pad_quotes('marker_positions'),
+            pad_quotes('start_positions'), pad_quotes('end_positions'))
+
+
+def _locate_quote(context, question):
+    """Char offset of the quote in a per-quote context (f"{pre} {quote} {post}").
+
+    The quote is the longest space-separated part of the context that also occurs in
+    the question, which is built from the quote and its adjacent narration.
+    """
+    best_start, best_length = None, 0
+    offset = 0
+    for part in context.split(' '):
+        if len(part) > best_length and part in question:
+            best_start, best_length = offset, len(part)
+        offset += len(part) + 1
+    return best_start
+
+
+def marker_features_from_dataset(input_file, tokenizer, max_seq_length=512, max_query_length=64, repeat_limit=3):
+    """Converts a per-quote CMRC-style dataset into single-quote marker features.
+
+    Used to train the marker head: every example keeps its context and answer, the
+    quote is marked and the question is replaced by the generic QUESTION.
+    """
+    if isinstance(input_file, dict):
+        data = input_file['data']
+    else:
+        with open(input_file, 'r', encoding='utf8') as f:
+            data = json.load(f)['data']
+
+    features = []
+    skipped = 0
+    for article in data:
+        for para in article['paragraphs']:
+            context = para['context']
+            for qas in para['qas']:
+                quote_start = _locate_quote(context, qas['question'])
+                answer_text = qas['answers'][0]['text']
+                answer_start = qas['answers'][0]['answer_start']
+                count_i = 0
+                while context[answer_start:answer_start + len(answer_text)] != answer_text and count_i < repeat_limit:
+                    answer_start -= 1
+                    count_i += 1
+                if context[answer_start:answer_start + len(answer_text)] != answer_text:
+                    answer_start = context.find(answer_text)
+                if quote_start is None or answer_start < 0 or not answer_text.strip():
+                    skipped += 1
+                    continue
+                # whitespace has no doc token, trim it off both ends of the answer
+                answer_end = answer_start + len(answer_text) - 1
+                while context[answer_start].isspace():
+                    answer_start += 1
+                while context[answer_end].isspace():
+                    answer_end -= 1
+                answer_text = context[answer_start:answer_end + 1]
+                feature = build_marker_feature(context, [quote_start], tokenizer, qids=[qas['id']],
+                                               max_query_length=max_query_length,
+                                               answers=[(answer_start, answer_text)])
+                if len(feature['input_ids']) > max_seq_length:
+                    skipped += 1
+                    continue
+                features.append(feature)
+    print('marker features num:', len(features), 'skipped:', skipped)
+    return features
+
+
+def build_shared_windows(sentences, quotes_idx, tokenizer, pre_size=3, post_size=3, max_seq_length=512,
+                         max_quotes_per_window=8):
+    """Greedily groups consecutive quotes with overlapping contexts into shared windows.
+
+    A quote joins the current window while the windows overlap, the window holds fewer
+    than max_quotes_per_window quotes and its feature still fits in max_seq_length.
+    Returns (features, fallback_idxs); quotes whose own window does not fit are left
+    to the per-quote mode.
+    """
+    def window_feature(group):
+        context, quote_starts = TextPreprocessor.get_shared_context(sentences, group, pre_size, post_size)
+        return build_marker_feature(context, quote_starts, tokenizer,
+                                    qids=[f"sentence_{idx}" for idx in group])
+
+    features = []
+    fallback_idxs = []
+    group, feature = [], None
+    for idx in quotes_idx:
+        if group and (len(group) < max_quotes_per_window and idx - pre_size <= group[-1] + post_size + 1):
+            candidate = window_feature(group + [idx])
+            if len(candidate['input_ids']) <= max_seq_length:
+                group, feature = group + [idx], candidate
+                continue
+        if group:
+            features.append(feature)
+        candidate = window_feature([idx])
+        if len(candidate['input_ids']) <= max_seq_length:
+            group, feature = [idx], candidate
+        else:
+            fallback_idxs.append(idx)
+            group, feature = [], None
+    if group:
+        features.append(feature)
+    return features, fallback_idxs
+
+
+def run_marker_model(model, features, device, n_batch=8):
+    """Returns (start_logits, end_logits) per feature, each a [num_quotes, seq_len] array."""
+    model.eval()
+    results = []
+    for i in range(0, len(features), n_batch):
+        batch = features[i:i + n_batch]
+        input_ids, input_mask, segment_ids, marker_positions = collate_marker_features(batch)
+        with torch.no_grad():
+            batch_start_logits, batch_end_logits = model(input_ids.to(device), segment_ids.to(device),
+                                                         input_mask.to(device), marker_positions.to(device))
+        for j, feature in enumerate(batch):
+            num_quotes = len(feature['marker_positions'])
+            length = len(feature['input_ids'])
+            results.append((batch_start_logits[j, :num_quotes, :length].detach().cpu().numpy(),
+                            batch_end_logits[j, :num_quotes, :length].detach().cpu().numpy()))
+    return results
+
+
+def marker_predictions(features, results, n_best_size, max_answer_length, output_prediction_file=None,
+                       output_nbest_file=None):
+    """Decodes the n-best answers of every marked quote with write_predictions.
+
+    Each quote is decoded as its own example over the shared window tokens, so the
+    answers are filtered and ranked exactly like in the per-quote mode.
+    """
+    examples = []
+    quote_features = []
+    quote_results = []
+    for feature, (start_logits, end_logits) in zip(features, results):
+        for q, qid in enumerate(feature['qids']):
+            index = len(examples)
+            examples.append({'qid': qid, 'doc_tokens': feature['doc_tokens']})
+            quote_features.append({'unique_id': index,
+                                   'example_index': index,
+                                   'doc_span_index': 0,
+                                   'tokens': feature['tokens'],
+                                   'token_to_orig_map': feature['token_to_orig_map'],
+                                   'token_is_max_context': feature['token_is_max_context'],
+                                   'input_ids': feature['input_ids'],
+                                   'input_mask': feature['input_mask'],
+                                   'segment_ids': feature['segment_ids']})
+            quote_results.append(RawResult(unique_id=index,
+                                           start_logits=start_logits[q],
+                                           end_logits=end_logits[q]))
+    return write_predictions(examples, quote_features, quote_results,
+                             n_best_size=n_best_size, max_answer_length=max_answer_length,
+                             do_lower_case=True, output_prediction_file=output_prediction_file,
+                             output_nbest_file=output_nbest_file, show_progress=False)
+
+
+def predict_shared_windows(model, sentences, quotes_idx, tokenizer, device, pre_size=3, post_size=3,
+                           max_seq_length=512, max_quotes_per_window=8, n_batch=8, n_best=6, max_ans_length=50):
+    """Identifies the speakers of `quotes_idx` with shared windows.
+
+    Returns (predictions, nbest, fallback_idxs, num_windows), keyed by "sentence_{idx}"
+    like the identify-speaker API; fallback_idxs still need the per-quote mode.
+    """
+    features, fallback_idxs = build_shared_windows(sentences, quotes_idx, tokenizer, pre_size, post_size,
+                                                   max_seq_length, max_quotes_per_window)
+    if not features:
+        return collections.OrderedDict(), collections.OrderedDict(), fallback_idxs, 0
+    results = run_marker_model(model, features, device, n_batch)
+    predictions, nbest = marker_predictions(features, results, n_best, max_ans_length)
+    return predictions, nbest, fallback_idxs, len(features)
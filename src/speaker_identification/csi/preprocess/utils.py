@@ -171,6 +171,91 @@ def torch_init_model(model, init_checkpoint, resumepar = False):
         print('error msgs:{}'.format(error_msgs), flush=True)
 
 
+def mmap_checkpoint_path(init_checkpoint):
+    """Path of the memory-mappable copy of a checkpoint, e.g. csi-v1.mmap.pth."""
+    return os.path.splitext(init_checkpoint)[0] + '.mmap.pth'
+
+
+def convert_checkpoint_to_mmap(init_checkpoint, output_file=None):
+    """Re-saves a checkpoint as a flat state dict that torch can memory-map.
+
+    Legacy (non-zipfile) checkpoints cannot be mapped, so the state dict is written
+    in torch's zipfile format with every tensor stored contiguously and the
+    DataParallel "module." prefix removed.
+    """
+    output_file = output_file or mmap_checkpoint_path(init_checkpoint)
+    state_dict = torch.load(init_checkpoint, map_location='cpu')
+    state_dict = collections.OrderedDict(
+        (k[len("module."):] if k.startswith("module.") else k, v.contiguous()) for k, v in state_dict.items())
+    tmp_file = output_file + '.tmp'
+    torch.save(state_dict, tmp_file)
+    os.replace(tmp_file, output_file)
+    print("Saving memory-mappable checkpoint to %s" % output_file)
+    return output_file
+
+
+def torch_load_model_mmap(model_class, bert_config, mmap_checkpoint):
+    """Builds a model whose weights are backed by a memory-mapped checkpoint.
+
+    The model is created on the meta device, so no weights are allocated before
+    loading, and the mapped tensors are assigned directly instead of being copied.
+    Pages are read lazily on first use and, being file-backed, are shared by every
+    process that maps the same checkpoint.
+    """
+    with torch.device('meta'):
+        model = model_class(bert_config)
+    state_dict = torch.load(mmap_checkpoint, map_location='cpu', mmap=True, weights_only=True)
+    prefix = '' if hasattr(model, 'bert') else 'bert.'
+    if prefix:
+        state_dict = {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False, assign=True)
+
+    # weights missing from the checkpoint are still on the meta device: materialise
+    # them, and initialise modules that were not loaded at all
+    for module in model.modules():
+        params = dict(module.named_parameters(recurse=False))
+        meta_names = [name for name, param in params.items() if param.is_meta]
+        for name in meta_names:
+            module._parameters[name] = torch.nn.Parameter(
+                torch.zeros_like(params[name], device='cpu'), requires_grad=params[name].requires_grad)
+        for name, buf in list(module.named_buffers(recurse=False)):
+            if buf.is_meta:
+                module._buffers[name] = torch.zeros_like(buf, device='cpu')
+        if meta_names and len(meta_names) == len(params) and hasattr(model, 'init_bert_weights'):
+            model.init_bert_weights(module)
+
+    print("missing keys:{}".format(missing_keys), flush=True)
+    print('unexpected keys:{}'.format(unexpected_keys), flush=True)
+    return model
+
+
+def feature_length(feature):
+    """Number of real (unpadded) tokens in a feature."""
+    return sum(feature['input_mask'])
+
+
+def collate_features(features, with_positions=False):
+    """Pads a batch of ragged features to the length of its longest member.
+
+    Features produced by json2features only store their real tokens; older feature
+    files padded to max_seq_length are trimmed to the same batch maximum.
+    """
+    lengths = [feature_length(f) for f in features]
+    max_len = max(lengths)
+    input_ids = torch.zeros((len(features), max_len), dtype=torch.long)
+    input_mask = torch.zeros((len(features), max_len), dtype=torch.long)
+    segment_ids = torch.zeros((len(features), max_len), dtype=torch.long)
+    for i, (f, length) in enumerate(zip(features, lengths)):
+        input_ids[i, :length] = torch.tensor(f['input_ids'][:length], dtype=torch.long)
+        input_mask[i, :length] = 1
+        segment_ids[i, :length] = torch.tensor(f['segment_ids'][:length], dtype=torch.long)
+    if not with_positions:
+        return input_ids, input_mask, segment_ids
+    start_positions = torch.tensor([f['start_position'] for f in features], dtype=torch.long)
+    end_positions = torch.tensor([f['end_position'] for f in features], dtype=torch.long)
+    return input_ids, input_mask, segment_ids, start_positions, end_positions
+
+
 def torch_save_model(model, output_dir, scores, max_save_num=1):
     # Save model checkpoint
     if not os.path.exists(output_dir):
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import argparse
+import torch
+
+from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering
+from src.speaker_identification.csi.models import quantization
+from src.speaker_identification.csi.tokenizations import official_tokenization as tokenization
+from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import json2features
+from src.speaker_identification.csi.preprocess import utils
+from src.speaker_identification.csi.test_si import evaluate
+
+
+def timed_evaluate(model, args, eval_examples, eval_features, output_dir):
+    """运行一次评估，返回(预测结果, 耗时秒数)"""
+    eval_args = argparse.Namespace(**vars(args))
+    eval_args.checkpoint_dir = output_dir
+    start_time = time.time()
+    predictions, _ = evaluate(model, eval_args, eval_examples, eval_features, torch.device('cpu'))
+    elapsed = time.time() - start_time
+    return predictions, elapsed
+
+
+def compare_predictions(reference, candidate):
+    """计算两组预测的top-1说话人一致率"""
+    agree = sum(1 for qid, text in reference.items() if candidate.get(qid) == text)
+    return agree / len(reference) if reference else 1.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Quantize the speaker identification model to INT8 and compare it with fp32 on a reference book')
+    parser.add_argument('--n_batch', type=int, default=8)
+    parser.add_argument('--bucket_by_length', action='store_true')
+    parser.add_argument('--max_batch_tokens', type=int, default=0)
+    parser.add_argument('--max_ans_length', type=int, default=50)
+    parser.add_argument('--n_best', type=int, default=6)
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help='Number of CPU threads used by torch (0 keeps the default)')
+
+    parser.add_argument('--dev_dir1', type=str, required=True,
+                        help='Path to the reference examples file')
+    parser.add_argument('--dev_dir2', type=str, required=True,
+                        help='Path to the reference features file')
+    parser.add_argument('--dev_file', type=str, required=True,
+                        help='Path to the reference book dataset file')
+    parser.add_argument('--bert_config_file', type=str, required=True,
+                        help='Path to the bert config file')
+    parser.add_argument('--vocab_file', type=str, required=True,
+                        help='Path to the vocab file')
+    parser.add_argument('--init_restore_dir', type=str, required=True,
+                        help='Path to the fp32 model checkpoint file')
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='Directory to save the predictions and the report')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Re-quantize even if the INT8 artifact already exists')
+
+    args = parser.parse_args()
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    bert_config = BertConfig.from_json_file(args.bert_config_file)
+    tokenizer = tokenization.get_tokenizer(args.vocab_file, do_lower_case=True)
+
+    if not os.path.exists(args.dev_dir1) or not os.path.exists(args.dev_dir2):
+        print('Converting examples to features...')
+        json2features(args.dev_file, [args.dev_dir1, args.dev_dir2], tokenizer, is_training=False,
+                      max_seq_length=bert_config.max_position_embeddings)
+    dev_examples = json.load(open(args.dev_dir1, 'r'))
+    dev_features = json.load(open(args.dev_dir2, 'r'))
+
+    # fp32 baseline
+    start_time = time.time()
+    fp32_model = BertForQuestionAnswering(bert_config)
+    utils.torch_init_model(fp32_model, args.init_restore_dir)
+    fp32_model.eval()
+    fp32_load_time = time.time() - start_time
+
+    quantized_file = quantization.quantized_checkpoint_path(args.init_restore_dir)
+    if args.overwrite or not os.path.exists(quantized_file):
+        print('Quantizing model...')
+        quantization.save_quantized_model(quantization.quantize_model(fp32_model), quantized_file)
+
+    start_time = time.time()
+    int8_model = quantization.load_quantized_model(bert_config, quantized_file)
+    int8_load_time = time.time() - start_time
+
+    fp32_predictions, fp32_time = timed_evaluate(fp32_model, args, dev_examples, dev_features,
+                                                 os.path.join(args.checkpoint_dir, 'fp32'))
+    int8_predictions, int8_time = timed_evaluate(int8_model, args, dev_examples, dev_features,
+                                                 os.path.join(args.checkpoint_dir, 'int8'))
+
+    report = {
+        'num_quotes': len(fp32_predictions),
+        'num_features': len(dev_features),
+        'top1_agreement': compare_predictions(fp32_predictions, int8_predictions),
+        'fp32': {'load_time': fp32_load_time, 'eval_time': fp32_time,
+                 'ms_per_feature': 1000 * fp32_time / max(len(dev_features), 1),
+                 'size_mb': quantization.model_size_mb(fp32_model)},
+        'int8': {'load_time': int8_load_time, 'eval_time': int8_time,
+                 'ms_per_feature': 1000 * int8_time / max(len(dev_features), 1),
+                 'size_mb': quantization.model_size_mb(int8_model),
+                 'artifact': quantized_file},
+        'speedup': fp32_time / int8_time if int8_time > 0 else None,
+    }
+    report_file = os.path.join(args.checkpoint_dir, 'quantization_report.json')
+    with open(report_file, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"Report saved to {report_file}")
@@ -4,17 +4,20 @@ import argparse
 import numpy as np
 import json
 import torch
-from models.pytorch_modeling import BertConfig, BertForQuestionAnswering
+from models.pytorch_modeling import BertConfig, BertForQuestionAnswering, BertForMultiQuoteQA, \
+    BertForQuestionAnsweringEarlyExit
 from optimizations.pytorch_optimization import get_optimization, warmup_linear
 from evaluate.cmrc2018_output import write_predictions
 from evaluate.cmrc2018_evaluate import get_eval
 import collections
+import functools
 from torch import nn
-from torch.utils.data import TensorDataset, DataLoader
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 from tokenizations import official_tokenization as tokenization
 from preprocess.cmrc2018_preprocess import json2features
 from preprocess import utils
+from preprocess import shared_window
 
 
 def evaluate(model, args, eval_examples, eval_features, device, global_steps, best_f1, best_em, best_f1_em):
@@ -37,38 +40,61 @@ def evaluate(model, args, eval_examples, eval_features, device, global_steps, be
                                           "predictions_steps" + str(global_steps) + ".json")
     output_nbest_file = output_prediction_file.replace('predictions', 'nbest')
 
-    all_input_ids = torch.tensor([f['input_ids'] for f in eval_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f['input_mask'] for f in eval_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f['segment_ids'] for f in eval_features], dtype=torch.long)
-    all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
+    if args.marker_training:
+        # eval_features are single-quote marker features, decoded per marked quote
+        model.eval()
+        results = shared_window.run_marker_model(model, eval_features, device, args.n_batch)
+        shared_window.marker_predictions(eval_features, results, args.n_best, args.max_ans_length,
+                                         output_prediction_file, output_nbest_file)
+        return _score_predictions(model, args, output_prediction_file, global_steps, best_f1, best_em, best_f1_em)
 
-    eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
-    eval_dataloader = DataLoader(eval_data, batch_size=args.n_batch, shuffle=False)
+    eval_dataloader = DataLoader(list(range(len(eval_features))), batch_size=args.n_batch, shuffle=False)
 
     model.eval()
     all_results = []
+    # exit training: evaluate the exit heads with early exit at args.exit_threshold
+    exit_counts = collections.Counter()
     print("Start evaluating")
-    for input_ids, input_mask, segment_ids, example_indices in tqdm(eval_dataloader, desc="Evaluating"):
+    for example_indices in tqdm(eval_dataloader, desc="Evaluating"):
+        # features only store real tokens, pad each batch to its longest member
+        input_ids, input_mask, segment_ids = utils.collate_features(
+            [eval_features[i] for i in example_indices.tolist()])
         input_ids = input_ids.to(device)
         input_mask = input_mask.to(device)
         segment_ids = segment_ids.to(device)
         with torch.no_grad():
-            batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
+            if args.exit_training:
+                batch_start_logits, batch_end_logits, batch_layers = model(
+                    input_ids, segment_ids, input_mask, exit_threshold=args.exit_threshold)
+                exit_counts.update(batch_layers.tolist())
+            else:
+                batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
+        batch_start_logits = batch_start_logits.detach().cpu().numpy()
+        batch_end_logits = batch_end_logits.detach().cpu().numpy()
 
         for i, example_index in enumerate(example_indices):
-            start_logits = batch_start_logits[i].detach().cpu().tolist()
-            end_logits = batch_end_logits[i].detach().cpu().tolist()
+            start_logits = batch_start_logits[i]
+            end_logits = batch_end_logits[i]
             eval_feature = eval_features[example_index.item()]
             unique_id = int(eval_feature['unique_id'])
             all_results.append(RawResult(unique_id=unique_id,
                                          start_logits=start_logits,
                                          end_logits=end_logits))
 
+    if exit_counts:
+        total = sum(exit_counts.values())
+        print('exit layers:', dict(sorted(exit_counts.items())),
+              'average layers: %.2f' % (sum(layer * count for layer, count in exit_counts.items()) / total))
+
     write_predictions(eval_examples, eval_features, all_results,
                       n_best_size=args.n_best, max_answer_length=args.max_ans_length,
                       do_lower_case=True, output_prediction_file=output_prediction_file,
                       output_nbest_file=output_nbest_file)
 
+    return _score_predictions(model, args, output_prediction_file, global_steps, best_f1, best_em, best_f1_em)
+
+
+def _score_predictions(model, args, output_prediction_file, global_steps, best_f1, best_em, best_f1_em):
     tmp_result = get_eval(args.dev_file, output_prediction_file)
     tmp_result['STEP'] = global_steps
     with open(args.log_file, 'a') as aw:
@@ -113,6 +139,20 @@ if __name__ == '__main__':
     parser.add_argument('--save_best', type=bool, default=True)
     parser.add_argument('--eval_only', type=bool, default=False)
     parser.add_argument('--vocab_size', type=int, default=21128)
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='Number of processes used to convert examples to features')
+    parser.add_argument('--preprocess_chunk_size', type=int, default=64,
+                        help='Number of examples sent to a preprocessing worker at a time')
+    parser.add_argument('--marker_training', default=False, action='store_true',
+                        help='Train the marker head of BertForMultiQuoteQA for shared-window inference: '
+                             'every quote is marked in its context and asked with a generic question')
+    parser.add_argument('--exit_training', default=False, action='store_true',
+                        help='Train the exit heads of BertForQuestionAnsweringEarlyExit on top of a fine-tuned '
+                             'BertForQuestionAnswering checkpoint, with every other weight frozen')
+    parser.add_argument('--exit_layers', type=str, default='6,12,18',
+                        help='Comma separated (1-based) encoder layers that get an exit head')
+    parser.add_argument('--exit_threshold', type=float, default=0.9,
+                        help='Confidence at which an input exits early when evaluating the exit heads')
 
     # data dir
     parser.add_argument('--train_dir', type=str,
@@ -154,35 +194,58 @@ if __name__ == '__main__':
 
     # load the bert setting
     bert_config = BertConfig.from_json_file(args.bert_config_file)
+    if args.exit_training:
+        assert not args.marker_training, '--exit_training and --marker_training cannot be combined'
+        bert_config.exit_layers = [int(layer) for layer in args.exit_layers.split(',') if layer.strip()]
+        assert bert_config.exit_layers, '--exit_layers must name at least one layer'
 
 
     # load data
     print('loading data...')
-    tokenizer = tokenization.BertTokenizer(vocab_file=args.vocab_file, do_lower_case=True)
+    tokenizer = tokenization.get_tokenizer(args.vocab_file, do_lower_case=True)
     assert args.vocab_size == len(tokenizer.vocab)
-    # 如果特征文件不存在，则进行特征提取
-    if not args.eval_only and not os.path.exists(args.train_dir):
-        '''
-        输入: train_file: 训练集文件 train.json
-        输出: output_files: 输出文件，包含两个文件，第一个文件是train_dir_example文件，第二个文件是train_dir_feature文件
-        构造为大模型可以接受的输入，example为人类可读，feature为向量化的数据
-        '''
-        json2features(args.train_file, [args.train_dir.replace('_features_', '_examples_'), args.train_dir],
-                      tokenizer, is_training=True,
-                      max_seq_length=bert_config.max_position_embeddings)
-
-    # 同理构建两个验证集数据
-    if not os.path.exists(args.dev_dir1) or not os.path.exists(args.dev_dir2):
-        json2features(args.dev_file, [args.dev_dir1, args.dev_dir2], tokenizer, is_training=False,
-                      max_seq_length=bert_config.max_position_embeddings)
-
-    if not args.eval_only:
-        train_features = json.load(open(args.train_dir, 'r')) # 加载模型可读的训练数据
-    dev_examples = json.load(open(args.dev_dir1, 'r')) # 加载人可读的验证数据，用于计算FI
-    dev_features = json.load(open(args.dev_dir2, 'r')) # 加载模型可读的验证数据
+    if args.marker_training:
+        # 标记引文+通用问题的特征直接在内存中构建
+        if not args.eval_only:
+            train_features = shared_window.marker_features_from_dataset(
+                args.train_file, tokenizer, max_seq_length=bert_config.max_position_embeddings)
+        dev_examples = None
+        dev_features = shared_window.marker_features_from_dataset(
+            args.dev_file, tokenizer, max_seq_length=bert_config.max_position_embeddings)
+    else:
+        # 如果特征文件不存在，则进行特征提取
+        if not args.eval_only and not os.path.exists(args.train_dir):
+            '''
+            输入: train_file: 训练集文件 train.json
+            输出: output_files: 输出文件，包含两个文件，第一个文件是train_dir_example文件，第二个文件是train_dir_feature文件
+            构造为大模型可以接受的输入，example为人类可读，feature为向量化的数据
+            '''
+            json2features(args.train_file, [args.train_dir.replace('_features_', '_examples_'), args.train_dir],
+                          tokenizer, is_training=True,
+                          max_seq_length=bert_config.max_position_embeddings,
+                          num_workers=args.preprocess_workers, chunk_size=args.preprocess_chunk_size)
+
+        # 同理构建两个验证集数据
+        if not os.path.exists(args.dev_dir1) or not os.path.exists(args.dev_dir2):
+            json2features(args.dev_file, [args.dev_dir1, args.dev_dir2], tokenizer, is_training=False,
+                          max_seq_length=bert_config.max_position_embeddings,
+                          num_workers=args.preprocess_workers, chunk_size=args.preprocess_chunk_size)
+
+        if not args.eval_only:
+            train_features = json.load(open(args.train_dir, 'r')) # 加载模型可读的训练数据
+        dev_examples = json.load(open(args.dev_dir1, 'r')) # 加载人可读的验证数据，用于计算FI
+        dev_features = json.load(open(args.dev_dir2, 'r')) # 加载模型可读的验证数据
     if os.path.exists(args.log_file):
         os.remove(args.log_file) 
 
+    if args.marker_training:
+        model_class = BertForMultiQuoteQA
+    elif args.exit_training:
+        model_class = BertForQuestionAnsweringEarlyExit
+    else:
+        model_class = BertForQuestionAnswering
+    collate_fn = shared_window.collate_marker_features if args.marker_training else utils.collate_features
+
     if not args.eval_only:
         steps_per_epoch = len(train_features) // args.n_batch
         eval_steps = int(steps_per_epoch * args.eval_epochs)
@@ -223,10 +286,14 @@ if __name__ == '__main__':
 
             # init model
             print('init model...')
-            model = BertForQuestionAnswering(bert_config)
+            model = model_class(bert_config)
 
             utils.torch_show_all_params(model)
             utils.torch_init_model(model, args.init_restore_dir, args.resumepar)
+            if args.exit_training:
+                # the backbone and the final span head stay as fine-tuned, only the exit heads learn
+                for name, param in model.named_parameters():
+                    param.requires_grad_(name.startswith('exit_outputs.'))
             if args.float16:
                 model.half()
             model.to(device)
@@ -241,21 +308,13 @@ if __name__ == '__main__':
                                          max_grad_norm=args.clip_norm,
                                          weight_decay_rate=args.weight_decay_rate)
 
-            all_input_ids = torch.tensor([f['input_ids'] for f in train_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f['input_mask'] for f in train_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f['segment_ids'] for f in train_features], dtype=torch.long)
-
-            seq_len = all_input_ids.shape[1]
+            seq_len = max(utils.feature_length(f) for f in train_features)
 
             assert seq_len <= bert_config.max_position_embeddings
 
-            # true label
-            all_start_positions = torch.tensor([f['start_position'] for f in train_features], dtype=torch.long)
-            all_end_positions = torch.tensor([f['end_position'] for f in train_features], dtype=torch.long)
-
-            train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                       all_start_positions, all_end_positions)
-            train_dataloader = DataLoader(train_data, batch_size=args.n_batch, shuffle=True)
+            # ragged features are padded per batch, together with the true labels
+            train_dataloader = DataLoader(train_features, batch_size=args.n_batch, shuffle=True,
+                                          collate_fn=functools.partial(collate_fn, with_positions=True))
 
             print('***** Training *****')
             model.train()
@@ -269,8 +328,13 @@ if __name__ == '__main__':
                 with tqdm(total=steps_per_epoch, desc='Epoch %d' % (i + 1)) as pbar:
                     for step, batch in enumerate(train_dataloader):
                         batch = tuple(t.to(device) for t in batch)
-                        input_ids, input_mask, segment_ids, start_positions, end_positions = batch
-                        loss = model(input_ids, segment_ids, input_mask, start_positions, end_positions)
+                        if args.marker_training:
+                            input_ids, input_mask, segment_ids, marker_positions, start_positions, end_positions = batch
+                            loss = model(input_ids, segment_ids, input_mask, marker_positions,
+                                         start_positions, end_positions)
+                        else:
+                            input_ids, input_mask, segment_ids, start_positions, end_positions = batch
+                            loss = model(input_ids, segment_ids, input_mask, start_positions, end_positions)
                         if n_gpu > 1:
                             loss = loss.mean()  # mean() to average on multi-gpu.
                         total_loss += loss.item()
@@ -311,7 +375,7 @@ if __name__ == '__main__':
             aw.write('Mean(Best) EM:{}({})\n'.format(np.mean(EMs), np.max(EMs)))
     else:
         print('init model...')
-        model = BertForQuestionAnswering(bert_config)
+        model = model_class(bert_config)
 
         utils.torch_show_all_params(model)
         utils.torch_init_model(model, args.init_restore_dir)
@@ -4,67 +4,269 @@ from tqdm import tqdm
 import torch
 import collections
 import argparse
-from torch.utils.data import TensorDataset, DataLoader
+import queue
+import threading
 
 from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering
 from src.speaker_identification.csi.evaluate.cmrc2018_output import write_predictions
+from src.speaker_identification.csi.evaluate.name_decoding import CastList, write_name_predictions
 from src.speaker_identification.csi.tokenizations import official_tokenization as tokenization
-from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import json2features
+from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import json2features, iter_features
 from src.speaker_identification.csi.preprocess import utils
+from src.speaker_identification.csi.preprocess.feature_store import FeatureStore, as_feature_store
 from src.utils import WebSocketTqdm
 
 
+def _length_bucketed_batches(lengths, n_batch, max_batch_tokens=0):
+    """Groups feature indices into batches of similar real length.
+
+    Features are sorted by their unpadded length and packed greedily, so a batch
+    holds at most `n_batch` features and, if `max_batch_tokens` > 0, at most
+    `max_batch_tokens` tokens once trimmed to its longest member.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    batch_max_len = 0
+    for i in order:
+        new_max_len = max(batch_max_len, lengths[i])
+        if batch and (len(batch) >= n_batch or
+                      (max_batch_tokens > 0 and new_max_len * (len(batch) + 1) > max_batch_tokens)):
+            batches.append(batch)
+            batch = []
+            new_max_len = lengths[i]
+        batch.append(i)
+        batch_max_len = new_max_len
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 def evaluate(model, args, eval_examples, eval_features, device, socketio=None, task_id=None):
     """评估函数：计算模型预测结果并输出到文件
     Args:
         model: BERT问答模型
-        args: 参数配置
+        args: 参数配置，设置bucket_by_length时按真实长度分桶组batch，
+            max_batch_tokens限制每个batch裁剪后的token总数(0表示不限制)
         eval_examples: 验证集原始样例
-        eval_features: 验证集特征
+        eval_features: 验证集特征，FeatureStore或特征字典列表(会先转换为FeatureStore)
         device: 计算设备
+    Returns:
+        (all_predictions, all_nbest_json)，args.checkpoint_dir为None时不写文件
     """
     print("***** Eval *****")
     RawResult = collections.namedtuple("RawResult",
                                      ["unique_id", "start_logits", "end_logits"])
-    if not os.path.exists(args.checkpoint_dir):
-        os.makedirs(args.checkpoint_dir)
-    output_prediction_file = os.path.join(args.checkpoint_dir, "predictions.json")
-    output_nbest_file = output_prediction_file.replace('predictions', 'nbest')
+    output_prediction_file = output_nbest_file = None
+    if getattr(args, 'checkpoint_dir', None) is not None:
+        if not os.path.exists(args.checkpoint_dir):
+            os.makedirs(args.checkpoint_dir)
+        output_prediction_file = os.path.join(args.checkpoint_dir, "predictions.json")
+        output_nbest_file = output_prediction_file.replace('predictions', 'nbest')
 
-    all_input_ids = torch.tensor([f['input_ids'] for f in eval_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f['input_mask'] for f in eval_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f['segment_ids'] for f in eval_features], dtype=torch.long)
-    all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
+    # 特征按列连续存储，组batch和解码时不再逐个访问特征字典
+    eval_features = as_feature_store(eval_features)
 
-    eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
-    eval_dataloader = DataLoader(eval_data, batch_size=args.n_batch, shuffle=False)
+    if getattr(args, 'bucket_by_length', False):
+        # 按真实长度分桶，每个batch只计算到其中最长的特征
+        lengths = eval_features.lengths().tolist()
+        batches = _length_bucketed_batches(lengths, args.n_batch, getattr(args, 'max_batch_tokens', 0))
+    else:
+        batches = [list(range(i, min(i + args.n_batch, len(eval_features))))
+                   for i in range(0, len(eval_features), args.n_batch)]
 
     model.eval()
-    all_results = []
+    all_results = [None] * len(eval_features)
     print("Start evaluating")
     # 使用WebSocketTqdm替代普通tqdm
-    for input_ids, input_mask, segment_ids, example_indices in WebSocketTqdm(eval_dataloader, desc="Evaluating", socketio=socketio, task_id=task_id):
+    for batch in WebSocketTqdm(batches, desc="Evaluating", socketio=socketio, task_id=task_id):
+        # 特征只保存真实token，在这里补齐到batch内最大长度
+        input_ids, input_mask, segment_ids = eval_features.collate(batch)
         input_ids = input_ids.to(device)
         input_mask = input_mask.to(device)
         segment_ids = segment_ids.to(device)
         with torch.no_grad():
             batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
+        # 整个batch一次拷贝成数组，解码时直接按行使用
+        batch_start_logits = batch_start_logits.detach().cpu().numpy()
+        batch_end_logits = batch_end_logits.detach().cpu().numpy()
+
+        # 按特征原始顺序写回结果
+        for i, feature_index in enumerate(batch):
+            start_logits = batch_start_logits[i]
+            end_logits = batch_end_logits[i]
+            unique_id = int(eval_features.unique_id[feature_index])
+            all_results[feature_index] = RawResult(unique_id=unique_id,
+                                                   start_logits=start_logits,
+                                                   end_logits=end_logits)
+
+    all_predictions, all_nbest_json = decode_predictions(
+        args, eval_examples, eval_features, all_results,
+        output_prediction_file=output_prediction_file, output_nbest_file=output_nbest_file)
+
+    if output_prediction_file is not None:
+        print(f"Predictions saved to {output_prediction_file}")
+    return all_predictions, all_nbest_json
+
+
+def decode_predictions(args, examples, features, results, output_prediction_file=None, output_nbest_file=None,
+                       show_progress=True):
+    """解码n-best答案，args.cast(CastList)不为空时只在已知角色名的位置中选择说话人"""
+    if getattr(args, 'cast', None) is not None:
+        return write_name_predictions(examples, features, results, args.cast,
+                                      n_best_size=args.n_best, max_answer_length=args.max_ans_length,
+                                      do_lower_case=True, output_prediction_file=output_prediction_file,
+                                      output_nbest_file=output_nbest_file, show_progress=show_progress)
+    return write_predictions(examples, features, results,
+                             n_best_size=args.n_best, max_answer_length=args.max_ans_length,
+                             do_lower_case=True, output_prediction_file=output_prediction_file,
+                             output_nbest_file=output_nbest_file, show_progress=show_progress)
+
+
+_STREAM_END = object()
+
+
+def evaluate_stream(model, args, feature_stream, device, queue_size=4, lookahead_batches=8):
+    """流式评估：特征提取、模型推理和n-best解码在三个线程中流水线执行，逐个样例产出结果
+    Args:
+        model: BERT问答模型
+        args: 参数配置，使用n_batch、n_best和max_ans_length；设置bucket_by_length时
+            在lookahead窗口内按真实长度分桶组batch，max_batch_tokens限制每个batch的token总数
+        feature_stream: iter_features产出的(example_index, example, features)
+        device: 计算设备
+        queue_size: 各阶段之间最多缓存的batch数，内存占用与书的长度无关
+        lookahead_batches: 分桶时每次最多取n_batch * lookahead_batches个特征一起分桶
+    Yields:
+        (qid, prediction, nbest)，按样例顺序产出
+    """
+    RawResult = collections.namedtuple("RawResult",
+                                     ["unique_id", "start_logits", "end_logits"])
+    batch_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    output_queue = queue.Queue(maxsize=queue_size * args.n_batch)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        # 下游已停止时放弃写入，避免线程阻塞
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-        for i, example_index in enumerate(example_indices):
-            start_logits = batch_start_logits[i].detach().cpu().tolist()
-            end_logits = batch_end_logits[i].detach().cpu().tolist()
-            eval_feature = eval_features[example_index.item()]
-            unique_id = int(eval_feature['unique_id'])
-            all_results.append(RawResult(unique_id=unique_id,
-                                       start_logits=start_logits,
-                                       end_logits=end_logits))
+    def get(q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _STREAM_END
 
-    write_predictions(eval_examples, eval_features, all_results,
-                     n_best_size=args.n_best, max_answer_length=args.max_ans_length,
-                     do_lower_case=True, output_prediction_file=output_prediction_file,
-                     output_nbest_file=output_nbest_file)
+    bucket_by_length = getattr(args, 'bucket_by_length', False)
 
-    print(f"Predictions saved to {output_prediction_file}")
+    def flush(window):
+        if not bucket_by_length:
+            return put(batch_queue, window)
+        # 窗口内按真实长度分桶，没有特征的条目长度记为0
+        lengths = [utils.feature_length(entry[3]) if entry[3] is not None else 0 for entry in window]
+        batches = _length_bucketed_batches(lengths, args.n_batch, getattr(args, 'max_batch_tokens', 0))
+        return all(put(batch_queue, [window[i] for i in batch]) for batch in batches)
+
+    def batching():
+        # 每个条目为(example_index, example, 样例的特征数, feature)，没有特征的样例也要传给解码线程
+        window_size = args.n_batch * lookahead_batches if bucket_by_length else args.n_batch
+        window = []
+        for example_index, example, features in feature_stream:
+            for feature in features or [None]:
+                window.append((example_index, example, len(features), feature))
+                if len(window) >= window_size:
+                    if not flush(window):
+                        return
+                    window = []
+        if window:
+            flush(window)
+
+    def forward():
+        while True:
+            batch = get(batch_queue)
+            if batch is _STREAM_END:
+                return
+            features = [entry[3] for entry in batch if entry[3] is not None]
+            results = []
+            if features:
+                input_ids, input_mask, segment_ids = utils.collate_features(features)
+                input_ids = input_ids.to(device)
+                input_mask = input_mask.to(device)
+                segment_ids = segment_ids.to(device)
+                with torch.no_grad():
+                    batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
+                batch_start_logits = batch_start_logits.detach().cpu().numpy()
+                batch_end_logits = batch_end_logits.detach().cpu().numpy()
+                for i, feature in enumerate(features):
+                    results.append(RawResult(unique_id=int(feature['unique_id']),
+                                             start_logits=batch_start_logits[i],
+                                             end_logits=batch_end_logits[i]))
+            if not put(result_queue, (batch, results)):
+                return
+
+    def decode():
+        pending = {}
+        # 分桶后样例完成的顺序会被打乱，按样例顺序输出
+        finished = {}
+        next_index = 0
+        while True:
+            item = get(result_queue)
+            if item is _STREAM_END:
+                return
+            batch, results = item
+            results = iter(results)
+            for example_index, example, n_features, feature in batch:
+                example_features, example_results = pending.setdefault(example_index, ([], []))
+                if feature is not None:
+                    # 单个样例解码，样例下标统一为0
+                    example_features.append(dict(feature, example_index=0))
+                    example_results.append(next(results))
+                if len(example_features) < n_features:
+                    continue
+                del pending[example_index]
+                predictions, nbest_json = decode_predictions(args, [example], example_features, example_results,
+                                                             show_progress=False)
+                qid = example['qid']
+                finished[example_index] = (qid, predictions[qid], nbest_json[qid])
+                while next_index in finished:
+                    if not put(output_queue, finished.pop(next_index)):
+                        return
+                    next_index += 1
+
+    def run_stage(stage, out_queue):
+        try:
+            stage()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(out_queue, _STREAM_END)
+
+    model.eval()
+    threads = [threading.Thread(target=run_stage, args=(stage, out_queue), daemon=True)
+               for stage, out_queue in ((batching, batch_queue), (forward, result_queue), (decode, output_queue))]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(output_queue)
+            if item is _STREAM_END:
+                break
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
 
 
 if __name__ == '__main__':
@@ -73,9 +275,22 @@ if __name__ == '__main__':
 
     # evaluation parameters
     parser.add_argument('--n_batch', type=int, default=32)
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help='Group features of similar length into batches trimmed to their longest member')
+    parser.add_argument('--max_batch_tokens', type=int, default=0,
+                        help='Token budget per length-bucketed batch (0 means no limit)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream features from the dev file straight into inference instead of '
+                             'building the examples/features files first')
+    parser.add_argument('--queue_size', type=int, default=4,
+                        help='Number of batches buffered between the streaming pipeline stages')
     parser.add_argument('--max_ans_length', type=int, default=50)
     parser.add_argument('--n_best', type=int, default=6)
     parser.add_argument('--vocab_size', type=int, default=21128)
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='Number of processes used to convert examples to features')
+    parser.add_argument('--preprocess_chunk_size', type=int, default=64,
+                        help='Number of examples sent to a preprocessing worker at a time')
 
     # data paths
     parser.add_argument('--dev_dir1', type=str, required=True,
@@ -84,6 +299,9 @@ if __name__ == '__main__':
                         help='Path to the dev features file')
     parser.add_argument('--dev_file', type=str, required=True,
                         help='Path to the original dev file')
+    parser.add_argument('--feature_store_dir', type=str, default=None,
+                        help='Directory of the memory-mapped binary feature store '
+                             '(built from the dev features file if it does not exist yet)')
     parser.add_argument('--bert_config_file', type=str, required=True,
                         help='Path to the bert config file')
     parser.add_argument('--vocab_file', type=str, required=True,
@@ -92,8 +310,15 @@ if __name__ == '__main__':
                         help='Path to the model checkpoint file')
     parser.add_argument('--checkpoint_dir', type=str, required=True,
                         help='Directory to save the predictions')
+    parser.add_argument('--cast_file', type=str, default=None,
+                        help='Optional json cast list (a list of names, or a dict of name to aliases); '
+                             'only spans of these names are decoded')
 
     args = parser.parse_args()
+    args.cast = None
+    if args.cast_file:
+        with open(args.cast_file, 'r', encoding='utf-8') as f:
+            args.cast = CastList(json.load(f))
     
     # 设置GPU
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_ids
@@ -106,19 +331,27 @@ if __name__ == '__main__':
 
     # 加载分词器
     print('Loading tokenizer...')
-    tokenizer = tokenization.BertTokenizer(vocab_file=args.vocab_file, do_lower_case=True)
+    tokenizer = tokenization.get_tokenizer(args.vocab_file, do_lower_case=True)
     assert args.vocab_size == len(tokenizer.vocab)
 
-    # 如果特征文件不存在，则进行特征提取
-    if not os.path.exists(args.dev_dir1) or not os.path.exists(args.dev_dir2):
-        print('Converting examples to features...')
-        json2features(args.dev_file, [args.dev_dir1, args.dev_dir2], tokenizer, is_training=False,
-                     max_seq_length=bert_config.max_position_embeddings)
+    if not args.stream:
+        # 如果特征文件不存在，则进行特征提取
+        if not os.path.exists(args.dev_dir1) or not os.path.exists(args.dev_dir2):
+            print('Converting examples to features...')
+            json2features(args.dev_file, [args.dev_dir1, args.dev_dir2], tokenizer, is_training=False,
+                         max_seq_length=bert_config.max_position_embeddings,
+                         num_workers=args.preprocess_workers, chunk_size=args.preprocess_chunk_size)
 
-    # 加载开发集数据
-    print('Loading development data...')
-    dev_examples = json.load(open(args.dev_dir1, 'r'))
-    dev_features = json.load(open(args.dev_dir2, 'r'))
+        # 加载开发集数据
+        print('Loading development data...')
+        dev_examples = json.load(open(args.dev_dir1, 'r'))
+        if args.feature_store_dir and FeatureStore.is_store(args.feature_store_dir):
+            dev_features = FeatureStore.load(args.feature_store_dir)
+        else:
+            dev_features = json.load(open(args.dev_dir2, 'r'))
+            if args.feature_store_dir:
+                dev_features = FeatureStore.from_features(dev_features)
+                dev_features.save(args.feature_store_dir)
 
     # 初始化模型
     print('Initializing model...')
@@ -130,4 +363,22 @@ if __name__ == '__main__':
         model = torch.nn.DataParallel(model)
 
     # 进行评估
-    evaluate(model, args, dev_examples, dev_features, device)
\ No newline at end of file
+    if args.stream:
+        # 边提取特征边推理，不生成特征文件
+        all_predictions = collections.OrderedDict()
+        all_nbest_json = collections.OrderedDict()
+        feature_stream = iter_features(args.dev_file, tokenizer, is_training=False,
+                                       max_seq_length=bert_config.max_position_embeddings)
+        for qid, prediction, nbest in tqdm(evaluate_stream(model, args, feature_stream, device,
+                                                           queue_size=args.queue_size), desc="Evaluating"):
+            all_predictions[qid] = prediction
+            all_nbest_json[qid] = nbest
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+        output_prediction_file = os.path.join(args.checkpoint_dir, "predictions.json")
+        with open(output_prediction_file, "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n")
+        with open(os.path.join(args.checkpoint_dir, "nbest.json"), "w", encoding='utf8') as writer:
+            writer.write(json.dumps(all_nbest_json, indent=4, ensure_ascii=False) + "\n")
+        print(f"Predictions saved to {output_prediction_file}")
+    else:
+        evaluate(model, args, dev_examples, dev_features, device)
\ No newline at end of file
@@ -0,0 +1,169 @@
+# coding=utf-8
+"""Precomputed Unicode character classes shared by the tokenizer and the CMRC preprocessing.
+
+Every BMP code point gets a byte of flags, computed once at import; code points
+beyond the BMP are classified on demand. `basic_tokenize` uses the table to run
+BasicTokenizer's clean / CJK spacing / whitespace split / lower casing / accent
+stripping / punctuation split as a single pass over the text.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import unicodedata
+
+SPIECE_UNDERLINE = '▁'
+
+CHINESE = 1  # CJK Unified Ideographs (see BasicTokenizer._is_chinese_char)
+FUHAO = 2  # punctuation kept as separate doc tokens by cmrc2018_preprocess
+WHITESPACE = 4  # whitespace for BERT: " ", \t, \n, \r and Zs
+CONTROL = 8  # removed by BasicTokenizer._clean_text: NUL, U+FFFD and Cx except \t, \n, \r
+PUNCTUATION = 16  # non-letter/number ASCII and Px
+DOC_WHITESPACE = 32  # whitespace for cmrc2018_preprocess doc tokens
+SPACE = 64  # str.isspace(), what whitespace_tokenize splits on
+
+_CHINESE_RANGES = ((0x4E00, 0x9FFF), (0x3400, 0x4DBF), (0x20000, 0x2A6DF), (0x2A700, 0x2B73F),
+                   (0x2B740, 0x2B81F), (0x2B820, 0x2CEAF), (0xF900, 0xFAFF), (0x2F800, 0x2FA1F))
+_FUHAO_CHARS = frozenset('。，！？；、：（）－~「《》,」"“”$『』—;。()-～。‘’')
+
+
+def _compute_flags(cp):
+    char = chr(cp)
+    cat = unicodedata.category(char)
+    flags = 0
+    if any(start <= cp <= end for start, end in _CHINESE_RANGES):
+        flags |= CHINESE
+    if char in _FUHAO_CHARS:
+        flags |= FUHAO
+    if char in " \t\n\r" or cat == "Zs":
+        flags |= WHITESPACE
+    if cp == 0 or cp == 0xfffd or (cat.startswith("C") and char not in "\t\n\r"):
+        flags |= CONTROL
+    if (33 <= cp <= 47) or (58 <= cp <= 64) or (91 <= cp <= 96) or (123 <= cp <= 126) or cat.startswith("P"):
+        flags |= PUNCTUATION
+    if char in " \t\r\n" or cp == 0x202F or char == SPIECE_UNDERLINE:
+        flags |= DOC_WHITESPACE
+    if char.isspace():
+        flags |= SPACE
+    return flags
+
+
+_BMP_FLAGS = bytearray(_compute_flags(cp) for cp in range(0x10000))
+
+
+@functools.lru_cache(maxsize=4096)
+def _astral_flags(cp):
+    return _compute_flags(cp)
+
+
+def code_flags(cp):
+    """Flags of the code point `cp`."""
+    return _BMP_FLAGS[cp] if cp < 0x10000 else _astral_flags(cp)
+
+
+def char_flags(char):
+    """Flags of the character `char`."""
+    return code_flags(ord(char))
+
+
+# per-character actions of the single-pass basic tokenizer
+_DROP = 0  # removed without ending the current word
+_SPLIT = 1  # ends the current word
+_WORD = 2  # value is appended to the current word
+_ISOLATE = 3  # value is a tuple of tokens emitted on their own
+_COMPLEX = 4  # depends on the neighbouring characters, fall back to the step-by-step path
+
+
+def _normalize(char, do_lower_case):
+    """What lower casing and accent stripping turn a lone character into.
+
+    Returns None when the result can depend on the neighbouring characters: the
+    final-sigma rule of str.lower and canonical reordering of kept combining marks.
+    """
+    if not do_lower_case:
+        return char
+    if char == 'Σ':
+        return None
+    text = unicodedata.normalize("NFD", char.lower())
+    output = []
+    for c in text:
+        if unicodedata.category(c) == "Mn":
+            continue
+        if unicodedata.combining(c):
+            return None
+        output.append(c)
+    return "".join(output)
+
+
+def _split_normalized(text):
+    """Punctuation split of a normalized token, as in BasicTokenizer._run_split_on_punc."""
+    tokens = []
+    start_new_word = True
+    for c in text:
+        if char_flags(c) & PUNCTUATION:
+            tokens.append(c)
+            start_new_word = True
+        else:
+            if start_new_word:
+                tokens.append("")
+            start_new_word = False
+            tokens[-1] += c
+    return tuple(tokens)
+
+
+def _basic_action(char, do_lower_case):
+    flags = char_flags(char)
+    if flags & CONTROL:
+        return _DROP, None
+    if flags & (WHITESPACE | SPACE):
+        return _SPLIT, None
+    text = _normalize(char, do_lower_case)
+    if text is None or any(char_flags(c) & SPACE for c in text):
+        return _COMPLEX, None
+    if flags & CHINESE:
+        return _ISOLATE, _split_normalized(text)
+    if not any(char_flags(c) & PUNCTUATION for c in text):
+        return _WORD, text
+    if len(text) == 1:
+        return _ISOLATE, (text,)
+    return _COMPLEX, None
+
+
+_BASIC_ACTIONS = ({}, {})
+
+
+def basic_tokenize(text, do_lower_case=True):
+    """Single-pass equivalent of BasicTokenizer.tokenize.
+
+    Returns None if the text contains a character whose output depends on its
+    neighbours; the caller then runs the step-by-step tokenizer instead.
+    """
+    actions = _BASIC_ACTIONS[bool(do_lower_case)]
+    tokens = []
+    word = []
+    for char in text:
+        action = actions.get(char)
+        if action is None:
+            action = actions[char] = _basic_action(char, do_lower_case)
+        kind, value = action
+        if kind == _WORD:
+            word.append(value)
+        elif kind == _DROP:
+            continue
+        elif kind == _COMPLEX:
+            return None
+        else:
+            if word:
+                word = "".join(word)
+                if word:
+                    tokens.append(word)
+                word = []
+            if kind == _ISOLATE:
+                tokens.extend(value)
+    if word:
+        word = "".join(word)
+        if word:
+            tokens.append(word)
+    return tokens
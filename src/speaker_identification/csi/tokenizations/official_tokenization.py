@@ -22,9 +22,11 @@ import collections
 import unicodedata
 import os
 import logging
+import threading
 import six
 
 from src.speaker_identification.csi.models.file_utils import cached_path
+from src.speaker_identification.csi.tokenizations import char_table
 
 logger = logging.getLogger(__name__)
 
@@ -42,17 +44,34 @@ VOCAB_NAME = 'vocab.txt'
 
 def load_vocab(vocab_file):
     """Loads a vocabulary file into a dictionary."""
-    vocab = collections.OrderedDict()
-    index = 0
     with open(vocab_file, "r", encoding="utf-8") as reader:
-        while True:
-            token = reader.readline()
-            if not token:
-                break
-            token = token.strip()
-            vocab[token] = index
-            index += 1
-    return vocab
+        lines = reader.read().split("\n")
+    if lines and not lines[-1]:
+        # the newline that ends the last line does not start another token
+        lines.pop()
+    return collections.OrderedDict((token.strip(), index) for index, token in enumerate(lines))
+
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(vocab_file, do_lower_case=True):
+    """Returns the process-wide BertTokenizer for a vocab file and casing.
+
+    The tokenizer (vocab, inverse vocab, wordpiece tries and memo caches) is built
+    on first use and shared afterwards; a rewritten vocab file gets a new one.
+    """
+    vocab_file = os.path.abspath(vocab_file)
+    mtime = os.path.getmtime(vocab_file) if os.path.isfile(vocab_file) else None
+    key = (vocab_file, mtime, bool(do_lower_case))
+    tokenizer = _tokenizers.get(key)
+    if tokenizer is None:
+        with _tokenizers_lock:
+            tokenizer = _tokenizers.get(key)
+            if tokenizer is None:
+                tokenizer = _tokenizers[key] = BertTokenizer(vocab_file, do_lower_case=do_lower_case)
+    return tokenizer
 
 
 def whitespace_tokenize(text):
@@ -110,37 +129,43 @@ def convert_to_unicode(text):
 class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
-    def __init__(self, vocab_file, do_lower_case=True):
+    def __init__(self, vocab_file, do_lower_case=True, cache_size=100000, max_cached_text_length=32):
         if not os.path.isfile(vocab_file):
             raise ValueError(
                 "Can't find a vocabulary file at path '{}'. To load the vocabulary from a Google pretrained "
                 "model use `tokenizer = BertTokenizer.from_pretrained(PRETRAINED_MODEL_NAME)`".format(vocab_file))
         self.vocab = load_vocab(vocab_file)
-        self.ids_to_tokens = collections.OrderedDict(
-            [(ids, tok) for tok, ids in self.vocab.items()])
+        self.ids_to_tokens = collections.OrderedDict(zip(self.vocab.values(), self.vocab.keys()))
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab, cache_size=cache_size)
+        # json2features tokenizes every doc character separately, so short texts
+        # repeat a lot and their full (basic + wordpiece) result is memoized.
+        self.max_cached_text_length = max_cached_text_length
+        self._cache = LRUCache(cache_size)
 
     def tokenize(self, text):
+        cacheable = len(text) <= self.max_cached_text_length
+        if cacheable:
+            cached = self._cache.get(text)
+            if cached is not None:
+                return list(cached)
         split_tokens = []
         for token in self.basic_tokenizer.tokenize(text):
             for sub_token in self.wordpiece_tokenizer.tokenize(token):
                 split_tokens.append(sub_token)
+        if cacheable:
+            self._cache.put(text, tuple(split_tokens))
         return split_tokens
 
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
-        ids = []
-        for token in tokens:
-            ids.append(self.vocab[token])
-        return ids
+        vocab = self.vocab
+        return [vocab[token] for token in tokens]
 
     def convert_ids_to_tokens(self, ids):
         """Converts a sequence of ids in wordpiece tokens using the vocab."""
-        tokens = []
-        for i in ids:
-            tokens.append(self.ids_to_tokens[i])
-        return tokens
+        ids_to_tokens = self.ids_to_tokens
+        return [ids_to_tokens[i] for i in ids]
 
     @classmethod
     def from_pretrained(cls, pretrained_model_name, cache_dir=None, *inputs, **kwargs):
@@ -189,6 +214,13 @@ class BasicTokenizer(object):
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        output_tokens = char_table.basic_tokenize(text, self.do_lower_case)
+        if output_tokens is not None:
+            return output_tokens
+        return self._tokenize_by_steps(text)
+
+    def _tokenize_by_steps(self, text):
+        """Step-by-step tokenization, for text that the single-pass tokenizer cannot handle."""
         text = self._clean_text(text)
         # This was added on November 1st, 2018 for the multilingual and Chinese
         # models. This is also applied to the English models now, but it doesn't
@@ -262,24 +294,13 @@ class BasicTokenizer(object):
         # as is Japanese Hiragana and Katakana. Those alphabets are used to write
         # space-separated words, so they are not treated specially and handled
         # like the all of the other languages.
-        if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-                (cp >= 0x3400 and cp <= 0x4DBF) or  #
-                (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-                (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-                (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-                (cp >= 0x2B820 and cp <= 0x2CEAF) or
-                (cp >= 0xF900 and cp <= 0xFAFF) or  #
-                (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-            return True
-
-        return False
+        return bool(char_table.code_flags(cp) & char_table.CHINESE)
 
     def _clean_text(self, text):
         """Performs invalid character removal and whitespace cleanup on text."""
         output = []
         for char in text:
-            cp = ord(char)
-            if cp == 0 or cp == 0xfffd or _is_control(char):
+            if char_table.char_flags(char) & char_table.CONTROL:
                 continue
             if _is_whitespace(char):
                 output.append(" ")
@@ -288,13 +309,89 @@ class BasicTokenizer(object):
         return "".join(output)
 
 
+class LRUCache(object):
+    """A small thread-safe least-recently-used cache (cache_size <= 0 disables it)."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if self.maxsize <= 0:
+            return None
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getstate__(self):
+        # locks cannot be pickled (e.g. when sending a tokenizer to worker processes),
+        # the copy starts with an empty cache
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+
+class VocabTrie(object):
+    """Prefix trie over vocabulary pieces, for greedy longest-match lookups."""
+
+    # Children are keyed by single characters, so the empty string can never clash with
+    # one. Unlike an object() sentinel it survives pickling, e.g. when the tokenizer is
+    # sent to spawned worker processes.
+    _END = ''
+
+    def __init__(self, pieces=()):
+        self.root = {}
+        for piece in pieces:
+            self.add(piece)
+
+    def add(self, piece):
+        if not piece:
+            return
+        node = self.root
+        for char in piece:
+            node = node.setdefault(char, {})
+        node[self._END] = True
+
+    def longest_match(self, text, start):
+        """Returns the end of the longest vocabulary piece text[start:end], or None."""
+        node = self.root
+        match_end = None
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if self._END in node:
+                match_end = i + 1
+        return match_end
+
+
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=100, cache_size=100000):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # A word-initial piece is looked up verbatim, a continuation piece as "##" + piece.
+        self.start_trie = VocabTrie(vocab)
+        self.continuation_trie = VocabTrie(token[2:] for token in vocab if token.startswith("##"))
+        self._cache = LRUCache(cache_size)
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -316,60 +413,46 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
+            sub_tokens = self._cache.get(token)
+            if sub_tokens is None:
+                sub_tokens = self._tokenize_word(token)
+                self._cache.put(token, sub_tokens)
+            output_tokens.extend(sub_tokens)
+        return output_tokens
+
+    def _tokenize_word(self, token):
+        """Greedy longest-match-first split of a single word, walking the vocab tries."""
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
 
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
+        start = 0
+        sub_tokens = []
+        while start < len(token):
+            if start == 0:
+                end = self.start_trie.longest_match(token, start)
             else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+                end = self.continuation_trie.longest_match(token, start)
+            if end is None:
+                return (self.unk_token,)
+            piece = token[start:end]
+            sub_tokens.append(piece if start == 0 else "##" + piece)
+            start = end
+        return tuple(sub_tokens)
 
 
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
     # as whitespace since they are generally considered as such.
-    if char == " " or char == "\t" or char == "\n" or char == "\r":
-        return True
-    cat = unicodedata.category(char)
-    if cat == "Zs":
-        return True
-    return False
+    return bool(char_table.char_flags(char) & char_table.WHITESPACE)
 
 
 def _is_control(char):
     """Checks whether `chars` is a control character."""
     # These are technically control characters but we count them as whitespace
     # characters.
-    if char == "\t" or char == "\n" or char == "\r":
-        return False
-    cat = unicodedata.category(char)
-    if cat.startswith("C"):
-        return True
-    return False
+    cp = ord(char)
+    return cp != 0xfffd and bool(char_table.code_flags(cp) & char_table.CONTROL)
 
 
 def _is_punctuation(char):
@@ -379,10 +462,4 @@ def _is_punctuation(char):
     # Characters such as "^", "$", and "`" are not in the Unicode
     # Punctuation class but we treat them as punctuation anyways, for
     # consistency.
-    if ((cp >= 33 and cp <= 47) or (cp >= 58 and cp <= 64) or
-            (cp >= 91 and cp <= 96) or (cp >= 123 and cp <= 126)):
-        return True
-    cat = unicodedata.category(char)
-    if cat.startswith("P"):
-        return True
-    return False
+    return bool(char_table.code_flags(cp) & char_table.PUNCTUATION)
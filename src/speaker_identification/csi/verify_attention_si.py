@@ -0,0 +1,53 @@
+import copy
+import json
+import argparse
+import torch
+
+from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering
+from src.speaker_identification.csi.models.exported import example_inputs
+from src.speaker_identification.csi.preprocess import utils
+from src.speaker_identification.csi.export_si import measure_latency, max_logit_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check the fused scaled-dot-product attention path against the reference attention')
+    parser.add_argument('--bert_config_file', type=str, required=True,
+                        help='Path to the bert config file')
+    parser.add_argument('--init_restore_dir', type=str, default=None,
+                        help='Path to the model checkpoint file (random weights if omitted)')
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='Maximum absolute logit difference accepted between the two paths')
+    parser.add_argument('--seq_lengths', type=int, nargs='+', default=[48, 128, 256, 512])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--n_runs', type=int, default=5)
+
+    args = parser.parse_args()
+
+    bert_config = BertConfig.from_json_file(args.bert_config_file)
+    model = BertForQuestionAnswering(bert_config)
+    if args.init_restore_dir:
+        utils.torch_init_model(model, args.init_restore_dir)
+    model.eval()
+
+    fused_config = copy.deepcopy(bert_config)
+    fused_config.use_fused_attention = True
+    fused_model = BertForQuestionAnswering(fused_config)
+    fused_model.load_state_dict(model.state_dict())
+    fused_model.eval()
+
+    results = []
+    passed = True
+    for seq_length in args.seq_lengths:
+        inputs = example_inputs(args.batch_size, seq_length, bert_config.vocab_size)
+        diff = max_logit_diff(model, fused_model, inputs)
+        passed = passed and diff <= args.atol
+        results.append({
+            'seq_length': seq_length,
+            'max_abs_diff': diff,
+            'reference_ms_per_feature': measure_latency(model, inputs, args.n_runs),
+            'fused_ms_per_feature': measure_latency(fused_model, inputs, args.n_runs),
+        })
+    print(json.dumps({'passed': passed, 'lengths': results}, indent=2))
+    if not passed:
+        raise SystemExit(f'Fused attention logits differ from the reference path by more than {args.atol}')
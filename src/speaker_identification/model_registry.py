@@ -0,0 +1,266 @@
+import os
+import time
+import threading
+from typing import Dict, List, Optional
+
+import torch
+
+from src.speaker_identification.csi.models.pytorch_modeling import BertConfig, BertForQuestionAnswering, \
+    BertForQuestionAnsweringEarlyExit, BertForMultiQuoteQA
+from src.speaker_identification.csi.models import quantization
+from src.speaker_identification.csi.models import exported
+from src.speaker_identification.csi.tokenizations import official_tokenization as tokenization
+from src.speaker_identification.csi.preprocess import utils
+
+
+def get_resident_memory_mb() -> Optional[float]:
+    """获取当前进程的常驻内存(RSS)，单位MB，无法获取时返回None"""
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        # Linux下没有psutil时直接读取/proc
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class LoadedModel:
+    """已加载到内存中的说话人识别模型，所有请求只读共享"""
+
+    def __init__(self, backend: str, bert_config, tokenizer, model, device, checkpoint_mtime: float):
+        self.backend = backend
+        self.bert_config = bert_config
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.checkpoint_mtime = checkpoint_mtime
+        self.load_time = 0.0
+        self.warmup_time = 0.0
+        self.memory_before_mb = None
+        self.memory_after_mb = None
+        self.loaded_at = time.time()
+
+    def status(self) -> Dict:
+        """返回模型加载信息"""
+        memory_delta_mb = None
+        if self.memory_before_mb is not None and self.memory_after_mb is not None:
+            memory_delta_mb = self.memory_after_mb - self.memory_before_mb
+        return {
+            'backend': self.backend,
+            'device': str(self.device),
+            'loaded_at': self.loaded_at,
+            'checkpoint_mtime': self.checkpoint_mtime,
+            'load_time': self.load_time,
+            'warmup_time': self.warmup_time,
+            'model_memory_mb': memory_delta_mb,
+        }
+
+
+class ModelRegistry:
+    BACKENDS = ('fp32', 'int8', 'torchscript', 'onnx', 'early_exit')
+    # 共享窗口模型的输入带引文标记位置，不能作为逐条引文的推理后端
+    SHARED_WINDOW = 'shared_window'
+
+    def __init__(self, model_dir: str, checkpoint_name: str = 'csi-v1.pth', gpu_ids: str = '0',
+                 warmup_length: int = 64, auto_reload: bool = True, fused_attention: bool = True,
+                 mmap_weights: bool = True, exit_checkpoint_name: str = 'csi-v1-exits.pth',
+                 marker_checkpoint_name: str = 'csi-v1-marker.pth'):
+        """说话人识别模型注册表，进程内每种推理后端只加载一次模型和分词器
+        支持的后端:
+            fp32: 原始的PyTorch模型
+            int8: 编码器线性层做INT8动态量化的CPU模型，量化结果保存在权重文件旁边
+            torchscript/onnx: 由export_si.py导出的冻结计算图，在CPU上运行(onnx需要onnxruntime)
+            early_exit: 带中间层退出头的模型(run_si --exit_training训练)，置信度足够时提前结束前向
+        另外可以用SHARED_WINDOW获取共享窗口模型(run_si --marker_training训练)，一次前向识别窗口内的多条引文
+        Args:
+            model_dir: 模型目录，包含config.json、vocab.txt和模型权重
+            checkpoint_name: 模型权重文件名
+            gpu_ids: 使用的GPU编号
+            warmup_length: 预热时使用的输入长度
+            auto_reload: 权重文件更新后是否在下次获取模型时自动重新加载
+            fused_attention: 是否使用PyTorch融合的scaled-dot-product attention推理
+            mmap_weights: 是否通过内存映射加载权重(首次使用时把权重转换为可映射的格式)，
+                多个进程映射同一文件时共享物理内存
+            exit_checkpoint_name: early_exit后端的模型权重文件名
+            marker_checkpoint_name: 共享窗口模型的权重文件名
+        """
+        self.bert_config_file = os.path.join(model_dir, 'config.json')
+        self.vocab_file = os.path.join(model_dir, 'vocab.txt')
+        self.init_restore_dir = os.path.join(model_dir, checkpoint_name)
+        self.exit_restore_dir = os.path.join(model_dir, exit_checkpoint_name)
+        self.marker_restore_dir = os.path.join(model_dir, marker_checkpoint_name)
+        self.warmup_length = warmup_length
+        self.auto_reload = auto_reload
+        self.fused_attention = fused_attention
+        self.mmap_weights = mmap_weights
+
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_ids
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        self._loaded: Dict[str, LoadedModel] = {}
+        self._lock = threading.Lock()
+
+    def get(self, backend: str = 'fp32') -> LoadedModel:
+        """获取已加载的模型，首次调用或权重文件更新时才会(重新)加载
+        Args:
+            backend: 推理后端，见BACKENDS，或SHARED_WINDOW
+        """
+        if backend not in self.BACKENDS and backend != self.SHARED_WINDOW:
+            raise ValueError(f"Unsupported backend: {backend}")
+        loaded = self._loaded.get(backend)
+        if loaded is not None and not (self.auto_reload and self._checkpoint_changed(loaded)):
+            return loaded
+        with self._lock:
+            # 其他线程可能已经完成加载
+            loaded = self._loaded.get(backend)
+            if loaded is None or (self.auto_reload and self._checkpoint_changed(loaded)):
+                loaded = self._load(backend)
+                self._loaded[backend] = loaded
+            return loaded
+
+    def reload(self, backend: Optional[str] = None) -> List[LoadedModel]:
+        """强制重新加载模型
+        Args:
+            backend: 需要重新加载的后端，为None时重新加载所有已加载的后端(至少包括fp32)
+        """
+        with self._lock:
+            backends = [backend] if backend else (list(self._loaded) or ['fp32'])
+            for name in backends:
+                self._loaded[name] = self._load(name)
+            return [self._loaded[name] for name in backends]
+
+    def status(self) -> Dict:
+        """返回注册表和已加载模型的状态"""
+        return {
+            'loaded': sorted(self._loaded),
+            'checkpoint': self.init_restore_dir,
+            'resident_memory_mb': get_resident_memory_mb(),
+            'models': {name: loaded.status() for name, loaded in self._loaded.items()},
+        }
+
+    def _checkpoint_file(self, backend: str) -> str:
+        if backend == 'early_exit':
+            return self.exit_restore_dir
+        if backend == self.SHARED_WINDOW:
+            return self.marker_restore_dir
+        return self.init_restore_dir
+
+    def _checkpoint_changed(self, loaded: LoadedModel) -> bool:
+        try:
+            return os.path.getmtime(self._checkpoint_file(loaded.backend)) != loaded.checkpoint_mtime
+        except OSError:
+            # 权重文件暂时不可用(例如正在被替换)时继续使用旧模型
+            return False
+
+    def _load(self, backend: str) -> LoadedModel:
+        memory_before = get_resident_memory_mb()
+        start_time = time.time()
+        checkpoint_mtime = os.path.getmtime(self._checkpoint_file(backend))
+
+        bert_config = BertConfig.from_json_file(self.bert_config_file)
+        bert_config.use_fused_attention = self.fused_attention
+        tokenizer = tokenization.get_tokenizer(self.vocab_file, do_lower_case=True)
+
+        if backend == 'int8':
+            model, device = self._load_int8_model(bert_config, checkpoint_mtime), torch.device('cpu')
+        elif backend == 'early_exit':
+            model, device = self._load_early_exit_model(bert_config), self.device
+        elif backend == self.SHARED_WINDOW:
+            model, device = self._load_fp32_model(bert_config, BertForMultiQuoteQA, self.marker_restore_dir), self.device
+        elif backend in exported.EXPORT_FORMATS:
+            model, device = self._load_exported_model(bert_config, backend, checkpoint_mtime), torch.device('cpu')
+        else:
+            model, device = self._load_fp32_model(bert_config), self.device
+        model.eval()
+        # 模型在请求间共享，只用于推理
+        for param in model.parameters():
+            param.requires_grad_(False)
+
+        loaded = LoadedModel(backend, bert_config, tokenizer, model, device, checkpoint_mtime)
+        loaded.load_time = time.time() - start_time
+
+        warmup_start = time.time()
+        self._warmup(loaded)
+        loaded.warmup_time = time.time() - warmup_start
+
+        loaded.memory_before_mb = memory_before
+        loaded.memory_after_mb = get_resident_memory_mb()
+        print(f"Speaker identification model ({backend}) loaded in {loaded.load_time:.2f}s, "
+              f"warmup {loaded.warmup_time:.2f}s, resident memory {loaded.memory_after_mb} MB")
+        return loaded
+
+    def _load_fp32_model(self, bert_config, model_class=BertForQuestionAnswering, checkpoint=None):
+        checkpoint = checkpoint or self.init_restore_dir
+        if not self.mmap_weights:
+            model = model_class(bert_config)
+            utils.torch_init_model(model, checkpoint)
+            return model.to(self.device)
+        mmap_file = utils.mmap_checkpoint_path(checkpoint)
+        if not os.path.exists(mmap_file) or os.path.getmtime(mmap_file) < os.path.getmtime(checkpoint):
+            utils.convert_checkpoint_to_mmap(checkpoint, mmap_file)
+        model = utils.torch_load_model_mmap(model_class, bert_config, mmap_file)
+        return model.to(self.device)
+
+    def _load_early_exit_model(self, bert_config):
+        """加载带退出头的模型，退出头所在的层由权重文件中的exit_outputs确定
+
+        这是与fp32后端不同的另一份权重，同时加载两者时常驻内存相应增加一份BERT。通过内存映射加载时
+        权重页按需读入，只用作级联的廉价模型时只有嵌入层、前cascade_layers层和退出头会被读入内存。
+        """
+        if not self.mmap_weights:
+            state_dict = torch.load(self.exit_restore_dir, map_location='cpu')
+            state_dict = {k[len("module."):] if k.startswith("module.") else k: v for k, v in state_dict.items()}
+            bert_config.exit_layers = BertForQuestionAnsweringEarlyExit.exit_layers_from_state_dict(state_dict)
+            model = BertForQuestionAnsweringEarlyExit(bert_config)
+            missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+            print("missing keys:{}".format(missing_keys), flush=True)
+            print('unexpected keys:{}'.format(unexpected_keys), flush=True)
+            return model.to(self.device)
+        mmap_file = utils.mmap_checkpoint_path(self.exit_restore_dir)
+        if not os.path.exists(mmap_file) or os.path.getmtime(mmap_file) < os.path.getmtime(self.exit_restore_dir):
+            utils.convert_checkpoint_to_mmap(self.exit_restore_dir, mmap_file)
+        # 映射加载只读入键名，不会读入权重
+        state_dict = torch.load(mmap_file, map_location='cpu', mmap=True, weights_only=True)
+        bert_config.exit_layers = BertForQuestionAnsweringEarlyExit.exit_layers_from_state_dict(state_dict)
+        del state_dict
+        model = utils.torch_load_model_mmap(BertForQuestionAnsweringEarlyExit, bert_config, mmap_file)
+        return model.to(self.device)
+
+    def _load_int8_model(self, bert_config, checkpoint_mtime: float):
+        """加载INT8量化模型，量化结果不存在或比原始权重旧时重新量化并保存"""
+        quantized_file = quantization.quantized_checkpoint_path(self.init_restore_dir)
+        if os.path.exists(quantized_file) and os.path.getmtime(quantized_file) >= checkpoint_mtime:
+            return quantization.load_quantized_model(bert_config, quantized_file)
+        model = quantization.quantize_model(self._load_fp32_model(bert_config))
+        quantization.save_quantized_model(model, quantized_file)
+        return model
+
+    def _load_exported_model(self, bert_config, export_format: str, checkpoint_mtime: float):
+        """加载导出的计算图，不存在或比原始权重旧时重新导出"""
+        model_file = exported.exported_model_path(self.init_restore_dir, export_format)
+        if not os.path.exists(model_file) or os.path.getmtime(model_file) < checkpoint_mtime:
+            model = self._load_fp32_model(bert_config)
+            exported.export_model(model, model_file, export_format, vocab_size=bert_config.vocab_size)
+            del model
+        return exported.load_exported_model(model_file, export_format)
+
+    def _warmup(self, loaded: LoadedModel):
+        """用一条假输入跑一遍前向，提前完成内存分配和算子初始化"""
+        seq_length = min(self.warmup_length, loaded.bert_config.max_position_embeddings)
+        input_ids = torch.zeros((1, seq_length), dtype=torch.long, device=loaded.device)
+        input_ids[0, 0] = loaded.tokenizer.vocab.get('[CLS]', 0)
+        input_ids[0, -1] = loaded.tokenizer.vocab.get('[SEP]', 0)
+        input_mask = torch.ones_like(input_ids)
+        segment_ids = torch.zeros_like(input_ids)
+        with torch.no_grad():
+            if loaded.backend == self.SHARED_WINDOW:
+                # 一条引文，标记放在[CLS]的位置
+                marker_positions = torch.zeros((1, 1), dtype=torch.long, device=loaded.device)
+                loaded.model(input_ids, segment_ids, input_mask, marker_positions)
+            else:
+                loaded.model(input_ids, segment_ids, input_mask)
@@ -1,6 +1,6 @@
-import re
 import json
-from typing import List, Set
+from typing import List, Set, Tuple
+from .name_matcher import NameMatcher
 
 class NameExtractor:
     def __init__(self, name_file: str):
@@ -9,6 +9,22 @@ class NameExtractor:
             name_list: 预定义的人名列表
         """
         self.name_list = self.load_name_list(name_file)  # 修改这里，使用 self 调用
+        # 人名列表加载时构建一次多模式匹配自动机
+        self.matcher = NameMatcher(self.name_list)
+
+    def add_name(self, name: str):
+        """新增一个人名，无需重建整个匹配自动机"""
+        name = name.strip()
+        if name:
+            self.name_list.add(name)
+            self.matcher.add(name)
+
+    def find_names(self, context: str) -> List[Tuple[str, int, int]]:
+        """一次扫描找出文本中出现的所有人名及其位置
+        Returns:
+            List[Tuple[str, int, int]]: (人名, 开始位置, 结束位置)
+        """
+        return self.matcher.find_names(context)
 
     def extract_names(self, pre_context: str = "", post_context: str = "") -> List[str]:
         """从前后文中提取人名
@@ -23,12 +39,7 @@ class NameExtractor:
             context = f"{pre_context}\n{post_context}"
             
             # 从预定义名单中查找匹配的人名
-            names = set()
-            for name in self.name_list:
-                # 使用正则表达式进行精确匹配
-                pattern = re.compile(re.escape(name))
-                if pattern.search(context):
-                    names.add(name)
+            names = {name for name, _, _ in self.matcher.find_names(context)}
             
             # 始终添加"其他人"作为候选项
             names.add("其他人")
@@ -0,0 +1,101 @@
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+class _Automaton:
+    def __init__(self, names: Iterable[str]):
+        """由一组人名构建的Aho-Corasick自动机，构建后不再修改"""
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # 到达该状态时结束的所有人名，包括沿失败指针可达状态的人名
+        self.output: List[Tuple[str, ...]] = [()]
+        for name in names:
+            self._insert(name)
+        self._link()
+
+    def _insert(self, name: str):
+        state = 0
+        for char in name:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = next_state
+        self.output[state] = (name,)
+
+    def _link(self):
+        """按广度优先顺序计算失败指针，并合并失败指针上的输出"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output[next_state] = self.output[next_state] + self.output[fail]
+                queue.append(next_state)
+
+    def matches(self, text: str) -> List[Tuple[str, int, int]]:
+        goto, fail, output = self.goto, self.fail, self.output
+        found = []
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for name in output[state]:
+                found.append((name, i + 1 - len(name), i + 1))
+        return found
+
+
+class NameMatcher:
+    def __init__(self, names: Iterable[str] = (), merge_ratio: float = 0.125, min_merge_size: int = 64):
+        """多个人名的一次扫描匹配
+        人名列表加载时构建一次自动机；之后新增的人名先放入一个小的待合并自动机，
+        其人名数超过主自动机的merge_ratio倍(且不少于min_merge_size)时才合并重建
+        Args:
+            names: 初始人名列表
+            merge_ratio: 待合并人名数与已有人名数之比超过该值时合并
+            min_merge_size: 待合并人名数不超过该值时不合并
+        """
+        self.merge_ratio = merge_ratio
+        self.min_merge_size = min_merge_size
+        self._names: Set[str] = {name for name in names if name}
+        self._pending: Set[str] = set()
+        self._automaton = _Automaton(self._names)
+        self._pending_automaton = None
+
+    def __len__(self) -> int:
+        return len(self._names) + len(self._pending)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names or name in self._pending
+
+    def add(self, name: str):
+        """新增一个人名，只重建待合并的小自动机"""
+        if not name or name in self:
+            return
+        self._pending.add(name)
+        if len(self._pending) > max(self.min_merge_size, self.merge_ratio * len(self._names)):
+            self._names |= self._pending
+            self._pending = set()
+            self._automaton = _Automaton(self._names)
+            self._pending_automaton = None
+        else:
+            self._pending_automaton = _Automaton(self._pending)
+
+    def find_names(self, text: str) -> List[Tuple[str, int, int]]:
+        """找出文本中出现的所有人名(包括重叠的出现)
+        Returns:
+            List[Tuple[str, int, int]]: (人名, 开始位置, 结束位置)，按开始位置、再按结束位置排序
+        """
+        found = self._automaton.matches(text)
+        if self._pending_automaton is not None:
+            found.extend(self._pending_automaton.matches(text))
+        found.sort(key=lambda match: (match[1], match[2]))
+        return found
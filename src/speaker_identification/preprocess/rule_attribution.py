@@ -0,0 +1,138 @@
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .name_matcher import NameMatcher
+
+# 说话动词，较长的放在前面，保证"笑道"不会被拆成"笑"+"道"
+SPEECH_VERBS = sorted({
+    '说', '道', '问', '答', '喊', '叫', '嚷', '吼', '骂', '叹', '笑',
+    '说道', '问道', '答道', '笑道', '叫道', '喊道', '骂道', '叹道', '怒道', '哭道', '喝道', '嚷道', '吼道',
+    '回答', '回答道', '解释道', '补充道', '嘀咕道', '嘟囔道', '低语道', '喃喃道', '催促道', '命令道',
+    '大喊', '大叫', '开口', '开口道', '插嘴', '插话', '接口道', '接着说', '继续说', '问他', '问她',
+}, key=len, reverse=True)
+
+# 名字和说话动词之间允许出现的状语
+ADVERBIALS = sorted({
+    '笑着', '哭着', '喊着', '叫着', '冷笑着', '微笑着', '苦笑着', '点头', '摇头', '皱眉',
+    '冷冷地', '淡淡地', '轻轻地', '慢慢地', '缓缓地', '低声', '大声', '轻声', '小声', '高声', '柔声', '沉声',
+    '忙', '连忙', '急忙', '赶忙', '又', '也', '便', '就', '才', '却', '突然', '忽然', '终于', '立刻', '马上', '还',
+}, key=len, reverse=True)
+
+# 人称代词开头的主语需要结合上文理解，交给模型
+PRONOUN_CHARS = set('我你他她它您咱俺')
+# 出现在名字末尾时更可能是状语、介词或说话动词的开头，例如"张三又说"、"张三对李四说"、"老人叹道"
+NAME_STOP_CHARS = set('都还再只不没对向跟和与同给朝冲把被在着了地的') | \
+    {word[0] for word in SPEECH_VERBS + ADVERBIALS}
+
+# 无人名表时会被误当作名字的连词、时间词和泛指的人，例如"于是说"、"今天说"、"众人说"，
+# 以这些词开头的候选名字一律交给模型
+NON_NAME_WORDS = {
+    '于是', '然后', '接着', '随后', '后来', '最后', '最终', '不过', '但是', '可是', '只是', '然而', '而且',
+    '并且', '所以', '因此', '因为', '如果', '虽然', '或者', '还是', '于是乎', '同时', '其实', '果然', '当然',
+    '今天', '明天', '昨天', '今晚', '今日', '明日', '昨日', '早上', '上午', '中午', '下午', '晚上', '夜里',
+    '这时', '那时', '此时', '当时', '刚才', '现在', '如今', '一会', '片刻', '半晌', '良久',
+    '众人', '大家', '人们', '有人', '别人', '旁人', '对方', '两人', '二人', '三人', '几人', '一人', '那人',
+    '这人', '所有', '每个', '其他', '一个', '另一',
+}
+
+_CLAUSE_SEPARATORS = '，,。！？!?；;：:…—'
+_QUOTE_OPENERS = '“"「『'
+
+
+def _alternation(words: Iterable[str]) -> str:
+    return '|'.join(re.escape(word) for word in words)
+
+
+class RuleAttributor:
+    def __init__(self, names: Optional[Dict[str, str]] = None, matcher: Optional[NameMatcher] = None):
+        """根据引文相邻的叙述句和说话动词表直接确定说话人，无需模型
+        只处理"张三说：“……”"、"“……”李四笑道。"这类主语紧挨说话动词的明确归属，
+        其余情况(代词、对话对象、前后两侧结果不一致等)返回None，交给模型识别
+        Args:
+            names: 已知角色名或别名到输出名字的映射(可选)；给出时只接受其中的名字，
+                否则按2~3个汉字的人名模式匹配并排除NON_NAME_WORDS开头的候选，仍可能误判，只适合离线评估
+            matcher: 包含names中所有名字的NameMatcher(可选，例如CastList.matcher)，不给出时按names构建
+        """
+        self.names = names
+        self.matcher = None
+        if names:
+            self.matcher = matcher if matcher is not None else NameMatcher(names)
+        # 名字之后的部分恰好是"状语(可选)+说话动词"
+        self._speech = re.compile(f'(?:{_alternation(ADVERBIALS)})?(?:{_alternation(SPEECH_VERBS)})')
+        self._han_name = re.compile(r'[\u4e00-\u9fff]{2,3}')
+
+    def _match_clause(self, clause: str) -> Optional[str]:
+        """分句是明确的"名字+说话动词"时返回名字，有多种切分方式时返回None"""
+        clause = clause.strip()
+        if not clause:
+            return None
+        if self.names:
+            # 一次扫描找出分句开头的所有名字
+            lengths = {end for name, start, end in self.matcher.find_names(clause) if start == 0}
+        else:
+            # 无人名表时名字长度不确定，逐个长度尝试，只接受唯一合理的切分
+            lengths = (2, 3)
+        candidates = {clause[:length] for length in lengths
+                      if self._is_name(clause[:length]) and self._speech.fullmatch(clause[length:])}
+        if len(candidates) != 1:
+            return None
+        name = candidates.pop()
+        return self.names[name] if self.names else name
+
+    def _is_name(self, name: str) -> bool:
+        if self.names:
+            return name in self.names
+        return (self._han_name.fullmatch(name) is not None and not PRONOUN_CHARS.intersection(name)
+                and name[-1] not in NAME_STOP_CHARS and '们' not in name and name[:2] not in NON_NAME_WORDS)
+
+    @staticmethod
+    def _last_clause(text: str) -> str:
+        text = text.rstrip().rstrip('：:，,')
+        return re.split(f'[{_CLAUSE_SEPARATORS}]', text)[-1]
+
+    @staticmethod
+    def _first_clause(text: str) -> str:
+        return re.split(f'[{_CLAUSE_SEPARATORS}]', text.lstrip(), maxsplit=1)[0]
+
+    @staticmethod
+    def _introduces_quote(sentences: List[Tuple[str, int, int, int, bool]], idx: int) -> bool:
+        """第idx句的首个分句以冒号结束并且后面紧跟引文，即"张三说：“……”"，说的是后一条引文"""
+        text = sentences[idx][0].lstrip()
+        rest = text[len(RuleAttributor._first_clause(text)):]
+        if not rest.startswith(('：', ':')):
+            return False
+        rest = rest[1:].strip()
+        if rest:
+            return rest[0] in _QUOTE_OPENERS
+        return idx + 1 < len(sentences) and sentences[idx + 1][4]
+
+    def attribute(self, sentences: List[Tuple[str, int, int, int, bool]], quote_idx: int) -> Optional[str]:
+        """返回引文的说话人，无法确定时返回None
+        后文以冒号引出下一条引文时(如"张三说：")，该叙述句不算作当前引文的归属
+        Args:
+            sentences: split_sentences得到的句子列表
+            quote_idx: 引文所在句子的索引
+        Examples:
+            >>> sentences = [('李四走进屋来。', 0, 7, 0, False), ('“你好。”', 7, 12, 1, True),
+            ...              ('张三说：', 12, 17, 2, False), ('“我也好。”', 17, 23, 3, True)]
+            >>> [RuleAttributor().attribute(sentences, idx) for idx in (1, 3)]
+            [None, '张三']
+            >>> RuleAttributor().attribute([('“走吧。”', 0, 5, 0, True), ('李四笑道。', 5, 10, 1, False)], 0)
+            '李四'
+        """
+        found = set()
+        if quote_idx > 0 and not sentences[quote_idx - 1][4]:
+            name = self._match_clause(self._last_clause(sentences[quote_idx - 1][0]))
+            if name is not None:
+                found.add(name)
+        if quote_idx < len(sentences) - 1 and not sentences[quote_idx + 1][4] \
+                and not self._introduces_quote(sentences, quote_idx + 1):
+            name = self._match_clause(self._first_clause(sentences[quote_idx + 1][0]))
+            if name is not None:
+                found.add(name)
+        return found.pop() if len(found) == 1 else None
+
+    @staticmethod
+    def nbest(name: str) -> List[Dict]:
+        """与模型n-best格式一致的结果，规则确定的说话人概率记为1"""
+        return [{"text": name, "probability": 1.0, "start_logit": None, "end_logit": None, "source": "rule"}]
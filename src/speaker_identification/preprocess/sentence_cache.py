@@ -0,0 +1,131 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .text_preprocess import TextPreprocessor
+from src.speaker_identification.csi.preprocess.cmrc2018_preprocess import split_doc_tokens, is_split_char, \
+    convert_example_to_features
+
+
+class SentenceTokenCache:
+    def __init__(self, sentences: List[Tuple[str, int, int, int, bool]], tokenizer):
+        """按句缓存分词结果，相邻引文的上下文共用同一份句子分词
+        Args:
+            sentences: split_sentences得到的句子列表
+            tokenizer: BertTokenizer
+        """
+        self.sentences = sentences
+        self.tokenizer = tokenizer
+        # 句子索引 -> (doc_tokens, 每个doc token的wordpiece)，首次用到时才分词
+        self._entries: Dict[int, Tuple[List[str], List[List[str]]]] = {}
+
+    def _tokenize(self, text: str) -> Tuple[List[str], List[List[str]]]:
+        doc_tokens, _ = split_doc_tokens(text)
+        return doc_tokens, [self.tokenizer.tokenize(token) for token in doc_tokens]
+
+    def sentence_tokens(self, idx: int) -> Tuple[List[str], List[List[str]]]:
+        """第idx句的(doc_tokens, sub_tokens)，每句只分词一次"""
+        entry = self._entries.get(idx)
+        if entry is None:
+            entry = self._entries[idx] = self._tokenize(self.sentences[idx][0])
+        return entry
+
+    def join(self, idxs: List[int], strip: bool = True) -> Tuple[List[str], List[List[str]]]:
+        """拼接若干句子的分词结果，与直接对拼接后的文本分词完全一致
+        Args:
+            idxs: 按顺序拼接的句子索引
+            strip: 是否和get_context一样去掉拼接结果首尾的空白
+        Returns:
+            Tuple[List[str], List[List[str]]]: (doc_tokens, 每个doc token的wordpiece)
+        """
+        texts = [self.sentences[i][0] for i in idxs]
+        joined = "".join(texts)
+        if strip and joined != joined.strip():
+            # 首尾有空白时去掉空白会改变切分，直接对去掉空白后的文本分词
+            return self._tokenize(joined.strip())
+
+        doc_tokens: List[str] = []
+        sub_tokens: List[List[str]] = []
+        last_char = " "
+        for i, text in zip(idxs, texts):
+            if not text:
+                continue
+            sentence_doc_tokens, sentence_sub_tokens = self.sentence_tokens(i)
+            if not is_split_char(last_char) and not is_split_char(text[0]):
+                # 句子边界两侧的字符会连成同一个doc token，只对合并后的token重新分词
+                merged = doc_tokens.pop() + sentence_doc_tokens[0]
+                sub_tokens.pop()
+                doc_tokens.append(merged)
+                sub_tokens.append(self.tokenizer.tokenize(merged))
+                doc_tokens.extend(sentence_doc_tokens[1:])
+                sub_tokens.extend(sentence_sub_tokens[1:])
+            else:
+                doc_tokens.extend(sentence_doc_tokens)
+                sub_tokens.extend(sentence_sub_tokens)
+            last_char = text[-1]
+        return doc_tokens, sub_tokens
+
+    def context_tokens(self, quote_idx: int, pre_size: int = 3,
+                       post_size: int = 3) -> Tuple[List[str], List[List[str]]]:
+        """f"{pre_context} {quote_sentence} {post_context}"的(doc_tokens, 每个doc token的wordpiece)"""
+        # 三段之间以空格分隔，不会跨段合并doc token
+        doc_tokens: List[str] = []
+        sub_tokens: List[List[str]] = []
+        for idxs, strip in ((range(max(0, quote_idx - pre_size), quote_idx), True),
+                            ([quote_idx], False),
+                            (range(quote_idx + 1, min(len(self.sentences), quote_idx + post_size + 1)), True)):
+            part_doc_tokens, part_sub_tokens = self.join(list(idxs), strip=strip)
+            doc_tokens.extend(part_doc_tokens)
+            sub_tokens.extend(part_sub_tokens)
+        return doc_tokens, sub_tokens
+
+    def count_tokens(self, quote_idx: int, pre_size: int, post_size: int) -> int:
+        """上下文窗口的wordpiece数，可作为TextPreprocessor.select_context_sizes的count_tokens"""
+        return sum(len(tokens) for tokens in self.context_tokens(quote_idx, pre_size, post_size)[1])
+
+    def build_example(self, quote_idx: int, pre_size: int = 3, post_size: int = 3,
+                      answer_text: str = "说话人") -> Tuple[dict, List[List[str]]]:
+        """构造与f"{pre_context} {quote_sentence} {post_context}"数据集样本相同的样例
+        Returns:
+            Tuple[dict, List[List[str]]]: (样例, 每个doc token的wordpiece)
+        """
+        question_context = TextPreprocessor.get_context(sentences=self.sentences, quote_idx=quote_idx,
+                                                        pre_size=pre_size, post_size=post_size)[3]
+        doc_tokens, sub_tokens = self.context_tokens(quote_idx, pre_size, post_size)
+        qid = f"sentence_{quote_idx}"
+        example = {'doc_tokens': doc_tokens,
+                   'orig_answer_text': answer_text,
+                   'qid': qid,
+                   'question': question_context,
+                   'answer': answer_text,
+                   'start_position': None,
+                   'end_position': None}
+        return example, sub_tokens
+
+    def iter_features(self, quotes_idx: List[int], pre_size: int = 3, post_size: int = 3,
+                      max_query_length: int = 64, max_seq_length: int = 512, doc_stride: int = 128,
+                      context_sizes: Optional[Dict[int, Tuple[int, int]]] = None
+                      ) -> Iterator[Tuple[int, dict, List[dict]]]:
+        """与cmrc2018_preprocess.iter_features相同，逐条产出(example_index, example, features)
+        context_sizes可按引文索引给出各自的(前文句子数量, 后文句子数量)，覆盖pre_size和post_size
+        """
+        unique_id = 1000000000
+        for example_index, quote_idx in enumerate(quotes_idx):
+            quote_pre_size, quote_post_size = (pre_size, post_size) if context_sizes is None \
+                else context_sizes[quote_idx]
+            example, doc_sub_tokens = self.build_example(quote_idx, quote_pre_size, quote_post_size)
+            features = []
+            for feature in convert_example_to_features(example_index, example, self.tokenizer,
+                                                       max_query_length=max_query_length,
+                                                       max_seq_length=max_seq_length, doc_stride=doc_stride,
+                                                       doc_sub_tokens=doc_sub_tokens):
+                features.append(dict(unique_id=unique_id, **feature))
+                unique_id += 1
+            yield example_index, example, features
+
+    def json2features(self, quotes_idx: List[int], pre_size: int = 3, post_size: int = 3,
+                      **kwargs) -> Tuple[List[dict], List[dict]]:
+        """与cmrc2018_preprocess.json2features相同，返回(examples, features)"""
+        examples, features = [], []
+        for _, example, example_features in self.iter_features(quotes_idx, pre_size, post_size, **kwargs):
+            examples.append(example)
+            features.extend(example_features)
+        return examples, features
@@ -1,5 +1,5 @@
 import re
-from typing import List, Tuple, Dict, Set
+from typing import List, Tuple, Dict, Set, Callable, Optional
 from pathlib import Path
 import argparse
 from .name_extractor import NameExtractor
@@ -9,7 +9,7 @@ class TextPreprocessor:
         """初始化预处理器
         Args:
             context_size: 初始上下文窗口大小（单侧），表示句子数量，默认为3句
-            max_context_size: 最大上下文窗口大小（单侧），表示token数量，默认为1024个token
+            max_context_size: 最大上下文窗口大小（前文+引文+后文），表示token数量，默认为1024个token
         """
         self.context_size = context_size
         self.max_context_size = max_context_size
@@ -190,10 +190,11 @@ class TextPreprocessor:
         post_context = post_context.strip()
         
         question_context = ""
-        if quote_idx > 0 and not sentences[quote_idx-1][4]:
+        narration_offset = TextPreprocessor.question_narration_offset(sentences, quote_idx)
+        if narration_offset < 0:
             question_context += sentences[quote_idx-1][0]
             question_context += quote_sentence
-        elif quote_idx < len(sentences)-1 and not sentences[quote_idx+1][4]:
+        elif narration_offset > 0:
             question_context += quote_sentence
             question_context += sentences[quote_idx+1][0]
         else:
@@ -201,4 +202,132 @@ class TextPreprocessor:
         question_context = question_context.strip()
         
         
-        return pre_context, quote_sentence, post_context, question_context
\ No newline at end of file
+        return pre_context, quote_sentence, post_context, question_context
+
+    @staticmethod
+    def question_narration_offset(sentences: List[Tuple[str, int, int, int, bool]], quote_idx: int) -> int:
+        """get_context放进问题的相邻叙述句相对引文的位置：-1为前一句，1为后一句，0为没有"""
+        if quote_idx > 0 and not sentences[quote_idx-1][4]:
+            return -1
+        if quote_idx < len(sentences)-1 and not sentences[quote_idx+1][4]:
+            return 1
+        return 0
+
+    @staticmethod
+    def count_context_chars(sentences: List[Tuple[str, int, int, int, bool]],
+                            quote_idx: int,
+                            pre_size: int,
+                            post_size: int) -> int:
+        """上下文窗口中非空白字符的数量，每个wordpiece至少包含一个字符，可作为token数的上界"""
+        start = max(0, quote_idx - pre_size)
+        end = min(len(sentences), quote_idx + post_size + 1)
+        return sum(len("".join(sentences[i][0].split())) for i in range(start, end))
+
+    @staticmethod
+    def select_context_sizes(sentences: List[Tuple[str, int, int, int, bool]],
+                             quote_idx: int,
+                             max_tokens: int,
+                             pre_size: int = 3,
+                             post_size: int = 3,
+                             count_tokens: Optional[Callable[[int, int, int], int]] = None,
+                             grow: bool = False) -> Tuple[int, int]:
+        """按token预算逐句调整引文的上下文窗口
+        从pre_size句前文和post_size句后文开始，超出预算时从token数较多的一侧逐句收缩；
+        grow为true时，未超出预算则前后交替逐句扩展，直到再加一句就会超出预算。
+        扩展会把窗口撑满整个预算(512长度的模型约445个token，固定前后各3句通常只有一百多个)，
+        每条引文的计算量成倍增加，只在需要更远的上下文时使用。
+        get_context放进问题的相邻叙述句即使不在窗口内也占用序列长度，按窗口包含该句计算token数
+        Args:
+            sentences: 句子列表
+            quote_idx: 引文所在句子的索引
+            max_tokens: 前文+引文+后文的最大token数
+            pre_size: 初始的前文句子数量
+            post_size: 初始的后文句子数量
+            count_tokens: count_tokens(quote_idx, pre_size, post_size)返回窗口的token数，
+                默认按非空白字符数估计
+            grow: 是否在预算内扩展窗口，默认只收缩
+        Returns:
+            Tuple[int, int]: (前文句子数量, 后文句子数量)，只有引文本身超出预算时才会超出
+        """
+        if count_tokens is None:
+            def count_tokens(idx, pre, post):
+                return TextPreprocessor.count_context_chars(sentences, idx, pre, post)
+        narration_offset = TextPreprocessor.question_narration_offset(sentences, quote_idx)
+        window_tokens = count_tokens
+
+        def count_tokens(idx, pre, post):
+            return window_tokens(idx, max(pre, int(narration_offset < 0)), max(post, int(narration_offset > 0)))
+
+        max_pre = quote_idx
+        max_post = len(sentences) - quote_idx - 1
+        pre_size = min(pre_size, max_pre)
+        post_size = min(post_size, max_post)
+
+        # 超出预算时从token数较多的一侧收缩，两侧相同时收缩后文
+        while count_tokens(quote_idx, pre_size, post_size) > max_tokens and (pre_size > 0 or post_size > 0):
+            if pre_size > 0 and (post_size == 0 or
+                                 count_tokens(quote_idx, pre_size, 0) > count_tokens(quote_idx, 0, post_size)):
+                pre_size -= 1
+            else:
+                post_size -= 1
+
+        # 未超出预算时前后交替扩展
+        grow_pre = grow and pre_size < max_pre
+        grow_post = grow and post_size < max_post
+        while grow_pre or grow_post:
+            if grow_pre:
+                if count_tokens(quote_idx, pre_size + 1, post_size) <= max_tokens:
+                    pre_size += 1
+                    grow_pre = pre_size < max_pre
+                else:
+                    grow_pre = False
+            if grow_post:
+                if count_tokens(quote_idx, pre_size, post_size + 1) <= max_tokens:
+                    post_size += 1
+                    grow_post = post_size < max_post
+                else:
+                    grow_post = False
+        return pre_size, post_size
+
+    def get_context_by_budget(self,
+                              sentences: List[Tuple[str, int, int, int, bool]],
+                              quote_idx: int,
+                              max_tokens: Optional[int] = None,
+                              count_tokens: Optional[Callable[[int, int, int], int]] = None,
+                              grow: bool = False) -> Tuple[str, str, str, str]:
+        """按token预算（默认为max_context_size）选取上下文，返回值与get_context相同"""
+        pre_size, post_size = self.select_context_sizes(
+            sentences, quote_idx,
+            max_tokens=self.max_context_size if max_tokens is None else max_tokens,
+            pre_size=self.context_size, post_size=self.context_size, count_tokens=count_tokens, grow=grow)
+        return self.get_context(sentences, quote_idx, pre_size, post_size)
+
+    @staticmethod
+    def get_shared_context(sentences: List[Tuple[str, int, int, int, bool]],
+                           quote_idxs: List[int],
+                           pre_size: int = 3,
+                           post_size: int = 3) -> Tuple[str, List[int]]:
+        """获取多条相邻引文共用的上下文窗口
+        Args:
+            sentences: 句子列表
+            quote_idxs: 窗口内需要识别的引文句子索引，按顺序排列
+            pre_size: 第一条引文的前文句子数量
+            post_size: 最后一条引文的后文句子数量
+        Returns:
+            Tuple[str, List[int]]: (窗口内容, 每条引文在窗口内容中的起始字符位置)
+            与get_context一致，需要识别的引文前后各加一个空格
+        """
+        start = max(0, quote_idxs[0] - pre_size)
+        end = min(len(sentences), quote_idxs[-1] + post_size + 1)
+        marked = set(quote_idxs)
+
+        context = ""
+        quote_starts = []
+        for i in range(start, end):
+            if i in marked:
+                context += " "
+                quote_starts.append(len(context))
+                context += sentences[i][0] + " "
+            else:
+                context += sentences[i][0]
+        return context, quote_starts
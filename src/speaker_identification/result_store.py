@@ -0,0 +1,51 @@
+import os
+import json
+import hashlib
+from typing import Dict, Iterable, Optional
+
+
+class ResultStore:
+    def __init__(self, store_file: str, model_tag: str):
+        """按样本内容哈希保存说话人识别结果的持久化存储，每本书一个文件
+        Args:
+            store_file: 存储文件路径
+            model_tag: 模型及解码参数的标识，与已保存的标识不一致时丢弃旧结果
+        """
+        self.store_file = store_file
+        self.model_tag = model_tag
+        self.results: Dict[str, Dict] = {}
+        if os.path.exists(store_file):
+            try:
+                with open(store_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('model_tag') == model_tag:
+                    self.results = data.get('results', {})
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"读取识别结果缓存失败，将重新识别: {e}")
+
+    @staticmethod
+    def sample_key(context: str, question: str) -> str:
+        """计算样本(上下文+问题)的内容哈希"""
+        content = json.dumps([context, question], ensure_ascii=False)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.results
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.results.get(key)
+
+    def put(self, key: str, prediction: str, nbest: list):
+        self.results[key] = {'prediction': prediction, 'nbest': nbest}
+
+    def prune(self, keys: Iterable[str]):
+        """只保留给定样本的结果，避免存储随修改次数无限增长"""
+        keys = set(keys)
+        self.results = {k: v for k, v in self.results.items() if k in keys}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.store_file), exist_ok=True)
+        tmp_file = self.store_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'model_tag': self.model_tag, 'results': self.results}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.store_file)